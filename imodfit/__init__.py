@@ -26,8 +26,12 @@
 from os.path import join
 import pwem
 import os
-import urllib.request
+import sys
+import shutil
+import tempfile
+import functools
 
+from contextlib import nullcontext
 from pyworkflow.utils import Environ
 from .constants import *
 
@@ -42,10 +46,19 @@ class Plugin(pwem.Plugin):
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(IMODFIT_HOME, IMODFIT + '-' + IMODFIT_DEFAULT_VERSION)
+        cls._defineVar(IMODFIT_CACHE, join(pwem.Config.SCIPION_USER_DATA, 'cache', IMODFIT))
+        cls._defineVar(IMODFIT_CACHE_SIZE, IMODFIT_CACHE_DEFAULT_SIZE)
+        cls._defineVar(IMODFIT_RESULTS, join(pwem.Config.SCIPION_USER_DATA, 'cache', IMODFIT + '_results'))
+        cls._defineVar(IMODFIT_RESULTS_SIZE, IMODFIT_RESULTS_DEFAULT_SIZE)
+        cls._defineVar(IMODFIT_CALIBRATION, join(pwem.Config.SCIPION_USER_DATA, 'cache', IMODFIT + '_calibration.jsonl'))
+        # Local to the node and shared by the jobs of all its users
+        cls._defineVar(IMODFIT_CORES_FILE, join(tempfile.gettempdir(), 'imodfit', 'cores.json'))
+        cls._defineVar(IMODFIT_MIRROR, '')
 
     @classmethod
-    def getImodfitEnviron(cls):
-        """ Setup the environment variables needed to launch imodfit. """
+    def getImodfitEnviron(cls, numberOfThreads=None):
+        """ Setup the environment variables needed to launch imodfit.
+        If numberOfThreads is given, MKL and OpenMP are limited to that number of threads. """
         environ = Environ(os.environ)
         runtimePath = join(pwem.Config.EM_ROOT, IMODFIT + '-' + IMODFIT_DEFAULT_VERSION)
 
@@ -54,18 +67,22 @@ class Plugin(pwem.Plugin):
         environ.update({'LD_LIBRARY_PATH': os.pathsep.join([userHomePath+'/intel/oneapi/mkl/latest/lib/intel64',
                                                             userHomePath+'/intel/oneapi/mkl/latest/lib/ia32'])
                         })
+        if numberOfThreads is not None:
+            environ.update({'MKL_NUM_THREADS': str(numberOfThreads),
+                            'OMP_NUM_THREADS': str(numberOfThreads),
+                            'MKL_DYNAMIC': 'FALSE'})
         return environ
 
     @classmethod
     def defineBinaries(cls, env):
-        # At this point of the installation execution cls.getHome() is None, so the em path should be provided
-        pluginHome = join(pwem.Config.EM_ROOT, IMODFIT + '-' + IMODFIT_DEFAULT_VERSION)
-        installationCmd = 'wget %s -O %s && ' % (cls._getImodfitDownloadUrl(), cls._getImodfitTxz())
+        # The archives are fetched when the installation runs, from the IMODFIT_MIRROR folder if they are there
+        fetchCmd = '%s -m imodfit.install fetch' % sys.executable
+        installationCmd = '%s %s %s && ' % (fetchCmd, IMODFIT_ARCHIVE, cls._getImodfitTxz())
         installationCmd += 'tar -xf %s --strip-components 1 && ' % cls._getImodfitTxz()
         installationCmd += 'rm %s && ' % cls._getImodfitTxz()
 
         #Installing required libraries
-        installationCmd += 'wget %s -O %s && ' % (cls._getLibrariesDownloadUrl(), cls._getMKLsh())
+        installationCmd += '%s %s %s && ' % (fetchCmd, MKL_ARCHIVE, cls._getMKLsh())
         installationCmd += 'chmod +x %s && ' % cls._getMKLsh()
         installationCmd += 'sh %s -a -s --eula accept && ' % \
                            (cls._getMKLsh())
@@ -78,13 +95,82 @@ class Plugin(pwem.Plugin):
                        version=IMODFIT_DEFAULT_VERSION,
                        tar='void.tgz',
                        commands=[(installationCmd, IMODFIT_INSTALLED)],
-                       neededProgs=["wget", "tar"],
+                       neededProgs=["tar"],
                        default=True)
 
     @classmethod
-    def runIMODfit(cls, protocol, program, args, cwd=None):
-        """ Run IMODFIT command from a given protocol. """
-        protocol.runJob(join(cls.getHome('bin', program)), args, cwd=cwd, env=cls.getImodfitEnviron())
+    def runIMODfit(cls, protocol, program, args, cwd=None, logFile=None, monitor=None,
+                   numberOfThreads=None, pinCores=False, usageFile=None):
+        """ Run IMODFIT command from a given protocol.
+        If logFile is given, the program output is saved in it and then copied to the protocol log.
+        A monitor (imodfit.monitor.ImodfitMonitor) following the logFile runs while the program is running.
+        numberOfThreads limits the MKL threads and, with pinCores, the program waits for that number of
+        free cores of the node and is pinned to them (imodfit.scheduler.CoreScheduler).
+        If usageFile is given, the CPU time, peak memory and I/O of the program are measured into it
+        (imodfit.profiling). """
+        if logFile is not None:
+            args = ' '.join('"%s"' % arg for arg in args)
+            args += ' > "%s" 2>&1' % os.path.abspath(logFile)
+        programPath = cls.getHome('bin', program)
+        if usageFile is not None:
+            from .profiling import getUsageCommand
+            programPath = getUsageCommand(usageFile, programPath)
+        pinCores = pinCores and numberOfThreads is not None and cls.getTasksetProgram() is not None
+        with cls.getCoreScheduler().allocate(numberOfThreads, log=print) if pinCores else nullcontext() as cores:
+            if cores is not None:
+                programPath = '%s -c %s %s' % (cls.getTasksetProgram(), ','.join(map(str, cores)), programPath)
+            if monitor is not None:
+                monitor.start()
+            try:
+                protocol.runJob(programPath, args, cwd=cwd, env=cls.getImodfitEnviron(numberOfThreads))
+            finally:
+                if monitor is not None:
+                    monitor.stop()
+                if logFile is not None and os.path.exists(logFile):
+                    with open(logFile) as f:
+                        shutil.copyfileobj(f, sys.stdout)
+                    sys.stdout.flush()
+
+    @classmethod
+    def getInputCache(cls):
+        """ Returns the cache of converted input files shared between runs """
+        from .cache import FileCache
+        maxSize = float(cls.getVar(IMODFIT_CACHE_SIZE)) * 1024 ** 3
+        return FileCache(cls.getVar(IMODFIT_CACHE), maxSize)
+
+    @classmethod
+    def getResultsCache(cls):
+        """ Returns the cache of fitting results shared between runs """
+        from .cache import FileCache
+        maxSize = float(cls.getVar(IMODFIT_RESULTS_SIZE)) * 1024 ** 3
+        return FileCache(cls.getVar(IMODFIT_RESULTS), maxSize)
+
+    @classmethod
+    def getCoreScheduler(cls):
+        """ Returns the scheduler of the cores used by the iMODfit jobs of the node """
+        from .scheduler import CoreScheduler
+        return CoreScheduler(cls.getVar(IMODFIT_CORES_FILE))
+
+    @classmethod
+    def getCalibrationFile(cls):
+        """ Returns the file with the measurements of the past iMODfit executions """
+        return cls.getVar(IMODFIT_CALIBRATION)
+
+    @classmethod
+    def getResourceModel(cls):
+        """ Returns the model of the time and memory of iMODfit calibrated with the past executions """
+        from .prediction import ResourceModel
+        return ResourceModel.fromFile(cls.getCalibrationFile())
+
+    @classmethod
+    def getTasksetProgram(cls):
+        return cls.findProgram('taskset')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def findProgram(program):
+        """ Returns the path of program in the PATH, or None. Lookups are cached for the whole process """
+        return shutil.which(program)
 
     @classmethod
     def getMCRPath(cls):
@@ -92,24 +178,8 @@ class Plugin(pwem.Plugin):
 
     @staticmethod
     def _getImodfitTxz():
-        return 'iMODFIT_v1.51_Linux_20190228.txz'
+        return IMODFIT_ARCHIVE
 
     @staticmethod
     def _getMKLsh():
-      return 'intel_mkl_lib.sh'
-
-    @classmethod
-    def _getImodfitDownloadUrl(cls):
-        html = urllib.request.urlopen("https://chaconlab.org/hybrid4em/imodfit/imodfit-donwload/item/imodfit-linux64")
-        htmlStr = html.read().decode('utf-8')
-        for line in htmlStr.split('\n'):
-            if 'href="/hybrid4em/imodfit/imodfit-donwload?task=callelement&amp;format=raw&amp;item_id=23' in line:
-                for element in line.split(' '):
-                    if element.startswith('href='):
-                        url = '\"https://chaconlab.org' + element.split('href="')[1]
-                        return url
-        print('Could not find the package url in the https://chaconlab.org web')
-
-    @classmethod
-    def _getLibrariesDownloadUrl(cls):
-        return 'https://registrationcenter-download.intel.com/akdlm/irc_nas/17757/l_onemkl_p_2021.2.0.296_offline.sh'
\ No newline at end of file
+      return MKL_ARCHIVE
@@ -0,0 +1,211 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Analysis of the fitting movie.
+
+The frames are read from a DCD trajectory (the movie is converted to one first if it was kept as a Multi-PDB)
+in chunks of bounded size. For every frame, the RMSD to the start and final
+models, the radius of gyration and the largest displacement of a residue centroid from the start are computed
+over whole chunks with numpy. The principal components of the motion of the residue centroids are computed
+from a bounded sample of evenly spaced frames, and every frame is then projected on them.
+"""
+import os
+import csv
+import json
+
+import numpy as np
+
+from .scoring import getResidues
+from .trajectory import DcdTrajectory, iterPdbModels, convertMovieToDcd
+
+CHUNK_BYTES = 64 * 1024 ** 2
+MAX_PCA_FRAMES = 1000
+N_COMPONENTS = 3
+
+
+class _ResidueCentroids:
+    """ Computes the residue centroids of stacks of frames as a product with a sparse averaging matrix """
+    def __init__(self, atomResidues):
+        from scipy.sparse import csr_matrix
+        nAtoms, nResidues = len(atomResidues), int(atomResidues.max()) + 1
+        counts = np.bincount(atomResidues, minlength=nResidues)
+        self.averaging = csr_matrix((1.0 / counts[atomResidues], (np.arange(nAtoms), atomResidues)),
+                                    shape=(nAtoms, nResidues), dtype=np.float32)
+
+    def __call__(self, blocks):
+        """ (nFrames, 3, nAtoms) -> (nFrames, 3, nResidues) """
+        nFrames = len(blocks)
+        return np.asarray(blocks.reshape(nFrames * 3, -1) @ self.averaging).reshape(nFrames, 3, -1)
+
+
+def _norms(blocks, reference):
+    """ Distances between the points of each frame and the reference, (nFrames, 3, n) -> (nFrames, n) """
+    diff = blocks - reference
+    return np.sqrt(np.einsum('fkn,fkn->fn', diff, diff))
+
+
+def _rmsd(blocks, reference):
+    diff = blocks - reference
+    return np.sqrt(np.einsum('fkn,fkn->f', diff, diff) / blocks.shape[2])
+
+
+def analyseTrajectory(trajectory, atomLines, maxPcaFrames=MAX_PCA_FRAMES, nComponents=N_COMPONENTS,
+                      chunkBytes=CHUNK_BYTES):
+    """ Analyses the frames of a DcdTrajectory of the atoms of atomLines. Returns a dict with the per frame
+    arrays rmsdStart, rmsdFinal, radiusGyration, maxDisplacement and projections (nFrames, nComponents),
+    the per residue arrays residues, residueMaxDisplacement and residueAmplitudes (of each component) and the
+    explainedVariance ratios of the components """
+    nFrames = len(trajectory)
+    residues, atomResidues = getResidues(atomLines)
+    centroids = _ResidueCentroids(atomResidues)
+    chunk = max(1, chunkBytes // (12 * trajectory.nAtoms))
+    first, final = trajectory.readBlocks(0, 1), trajectory.readBlocks(nFrames - 1)
+    firstCentroids = centroids(first)
+    pcaFrames = np.unique(np.linspace(0, nFrames - 1, min(nFrames, maxPcaFrames)).astype(int))
+
+    result = {key: np.empty(nFrames, dtype=np.float32)
+              for key in ('rmsdStart', 'rmsdFinal', 'radiusGyration', 'maxDisplacement')}
+    residueMaxDisplacement = np.zeros(len(residues), dtype=np.float32)
+    samples = []
+    for start in range(0, nFrames, chunk):
+        blocks = trajectory.readBlocks(start, start + chunk)
+        stop = start + len(blocks)
+        result['rmsdStart'][start:stop] = _rmsd(blocks, first)
+        result['rmsdFinal'][start:stop] = _rmsd(blocks, final)
+        result['radiusGyration'][start:stop] = _rmsd(blocks, blocks.mean(axis=2, keepdims=True))
+
+        frameCentroids = centroids(blocks)
+        displacements = _norms(frameCentroids, firstCentroids)
+        result['maxDisplacement'][start:stop] = displacements.max(axis=1)
+        residueMaxDisplacement = np.maximum(residueMaxDisplacement, displacements.max(axis=0))
+        inChunk = pcaFrames[(pcaFrames >= start) & (pcaFrames < stop)] - start
+        samples.append(frameCentroids[inChunk].reshape(len(inChunk), -1))
+
+    # Principal components of the sampled frames, on which all the frames are then projected
+    samples = np.concatenate(samples)
+    mean = samples.mean(axis=0)
+    nComponents = min(nComponents, len(samples) - 1)
+    nResidues = len(residues)
+    projections = np.zeros((nFrames, max(nComponents, 0)), dtype=np.float32)
+    if nComponents <= 0:
+        # A single frame has no motion
+        result.update(projections=projections, explainedVariance=np.zeros(0), residues=residues,
+                      residueMaxDisplacement=residueMaxDisplacement,
+                      residueAmplitudes=np.zeros((0, nResidues), dtype=np.float32))
+        return result
+
+    _, singular, components = np.linalg.svd(samples - mean, full_matrices=False)
+    variance = np.square(singular)
+    explained = variance[:nComponents] / variance.sum() if variance.sum() > 0 else np.zeros(nComponents)
+    components = components[:nComponents]
+    for start in range(0, nFrames, chunk):
+        frameCentroids = centroids(trajectory.readBlocks(start, start + chunk))
+        projections[start:start + len(frameCentroids)] = \
+            (frameCentroids.reshape(len(frameCentroids), -1) - mean) @ components.T
+
+    result.update(projections=projections, explainedVariance=explained, residues=residues,
+                  residueMaxDisplacement=residueMaxDisplacement,
+                  residueAmplitudes=np.linalg.norm(components.reshape(nComponents, 3, nResidues), axis=1))
+    return result
+
+
+def analyseMovie(movieFile, topologyFile=None, **kwargs):
+    """ Analyses a DCD trajectory with its topology pdb or a Multi-PDB movie, which is converted into a
+    temporary DCD in a single pass. See analyseTrajectory """
+    if topologyFile is None:
+        dcdFile, topologyFile = movieFile + '.analysis.dcd', movieFile + '.analysis_topology.pdb'
+        try:
+            convertMovieToDcd(movieFile, dcdFile, topologyFile)
+            return analyseMovie(dcdFile, topologyFile, **kwargs)
+        finally:
+            for fn in (dcdFile, topologyFile):
+                if os.path.exists(fn):
+                    os.remove(fn)
+    return analyseTrajectory(DcdTrajectory(movieFile), next(iterPdbModels(topologyFile)), **kwargs)
+
+
+def writeAnalysis(analysis, framesFile, residuesFile, summaryFile):
+    """ Writes the per frame and per residue tables (csv) and a JSON summary of an analysis """
+    nComponents = analysis['projections'].shape[1]
+    pcs = ['pc%d' % (i + 1) for i in range(nComponents)]
+    with open(framesFile, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frame', 'rmsdStart', 'rmsdFinal', 'radiusGyration', 'maxDisplacement'] + pcs)
+        for i, row in enumerate(zip(analysis['rmsdStart'], analysis['rmsdFinal'], analysis['radiusGyration'],
+                                    analysis['maxDisplacement'], *analysis['projections'].T), 1):
+            writer.writerow([i] + ['%.4f' % value for value in row])
+
+    with open(residuesFile, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['chain', 'residue', 'resName', 'maxDisplacement'] + [pc + 'Amplitude' for pc in pcs])
+        for i, (chain, resSeq, resName) in enumerate(analysis['residues']):
+            writer.writerow([chain, resSeq, resName, '%.4f' % analysis['residueMaxDisplacement'][i]] +
+                            ['%.4f' % amplitude for amplitude in analysis['residueAmplitudes'][:, i]])
+
+    with open(summaryFile, 'w') as f:
+        json.dump({'nFrames': len(analysis['rmsdStart']), 'finalRmsd': float(analysis['rmsdStart'][-1]),
+                   'maxDisplacement': float(analysis['maxDisplacement'].max()),
+                   'explainedVariance': [float(v) for v in analysis['explainedVariance']]}, f, indent=2)
+
+
+def readFrameAnalysis(framesFile):
+    """ Returns the columns of the per frame table as a dict of float arrays """
+    with open(framesFile) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        values = np.array([row for row in reader], dtype=float).reshape(-1, len(header))
+    return {column: values[:, i] for i, column in enumerate(header)}
+
+
+def plotFrameAnalysis(columns, createSubPlot):
+    """ Plots the per frame analysis in the axes given by createSubPlot(title, xLabel, yLabel), e.g. the
+    method of a pwem EmPlotter """
+    frames = columns['frame']
+    ax = createSubPlot('RMSD', 'Frame', 'RMSD (A)')
+    ax.plot(frames, columns['rmsdStart'], label='To start')
+    ax.plot(frames, columns['rmsdFinal'], label='To final')
+    ax.legend()
+    ax = createSubPlot('Radius of gyration', 'Frame', 'Rg (A)')
+    ax.plot(frames, columns['radiusGyration'])
+    ax = createSubPlot('Largest residue displacement', 'Frame', 'Displacement (A)')
+    ax.plot(frames, columns['maxDisplacement'])
+    if 'pc2' in columns:
+        ax = createSubPlot('Principal components', 'PC1', 'PC2')
+        ax.scatter(columns['pc1'], columns['pc2'], c=frames, s=4, cmap='viridis')
+
+
+def saveFramePlot(columns, plotFile):
+    """ Saves the plots of the per frame analysis as an image """
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(10, 8), tight_layout=True)
+    axes = iter(figure.subplots(2, 2).flat)
+
+    def createSubPlot(title, xLabel, yLabel):
+        ax = next(axes)
+        ax.set(title=title, xlabel=xLabel, ylabel=yLabel)
+        return ax
+    plotFrameAnalysis(columns, createSubPlot)
+    figure.savefig(plotFile)
@@ -0,0 +1,34 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmarks of the iMODfit protocols over synthetic structures and maps of increasing size.
+
+The steps of imodfitFlexFitting are run one by one, recording their time and the peak memory of the
+plugin process and of iMODfit, and the results are written to a JSON file to track the overhead of the
+plugin across releases. iMODfit can be replaced by a stand-in executable that mimics its outputs, e.g:
+
+    scipion3 python -m imodfit.benchmarks --standin --cases 1000x64,10000x128 -o benchmark.json
+"""
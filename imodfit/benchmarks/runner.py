@@ -0,0 +1,140 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Runs the benchmark cases and writes their results to a JSON file.
+
+Each case generates a synthetic structure of nAtoms and its simulated map of boxSize^3 voxels and runs
+the steps of imodfitFlexFitting on them, outside a Scipion project, measuring the time of each step and
+the peak resident memory of the plugin process and of its child processes (iMODfit).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+
+from ..profiling import ResourceSampler, MB
+from .synthetic import generateCase
+from .standin import createStandinHome
+
+DEFAULT_CASES = '1000x64,10000x128,100000x256,500000x512'
+
+
+def parseCases(text):
+    """ Parses a list of cases like '1000x64,10000x128' into [(nAtoms, boxSize), ...] """
+    return [tuple(int(v) for v in case.split('x')) for case in text.split(',') if case.strip()]
+
+
+def runCase(nAtoms, boxSize, caseDir, iterations, **protParams):
+    """ Generates the case inputs in caseDir and runs the fitting protocol steps on them. Returns its record """
+    from pwem.objects import Volume, AtomStruct
+    from pyworkflow.protocol.executor import StepExecutor
+    from pyworkflow.protocol.hosts import HostConfig
+    from ..protocols import imodfitFlexFitting
+
+    os.makedirs(caseDir, exist_ok=True)
+    pdbFile, mapFile = os.path.join(caseDir, 'synthetic.pdb'), os.path.join(caseDir, 'synthetic.mrc')
+    t0 = time.time()
+    sampling, resolution = generateCase(pdbFile, mapFile, nAtoms, boxSize)
+    record = {'nAtoms': nAtoms, 'boxSize': boxSize, 'sampling': sampling, 'resolution': resolution,
+              'generationTime': time.time() - t0, 'steps': []}
+
+    inputVolume = Volume(location=mapFile)
+    inputVolume.setSamplingRate(sampling)
+    protParams = dict({'resolution': int(round(resolution)), 'maxIter': iterations, 'useCache': False,
+                       'reuseResults': False},
+                      **protParams)
+    prot = imodfitFlexFitting(workingDir=os.path.join(caseDir, 'run'), **protParams)
+    prot.inputVolume.set(inputVolume)
+    prot.inputAtomStruct.set(AtomStruct(pdbFile))
+    prot.makeWorkingDir()
+    hostConfig = HostConfig(label='localhost', hostName='localhost')
+    prot.setHostConfig(hostConfig)
+    prot._stepsExecutor = StepExecutor(hostConfig)
+    prot._stepsExecutor.setProtocol(prot)
+    prot._insertAllSteps()
+
+    for step in prot._steps:
+        with ResourceSampler(interval=0.05) as memory:
+            t0 = time.time()
+            step._runFunc()
+            stepTime = time.time() - t0
+        record['steps'].append({'step': step.funcName.get(), 'args': json.loads(step.argsStr.get()),
+                                'time': stepTime, 'peakMemoryMB': memory.peak / MB,
+                                'peakChildMemoryMB': memory.peakChildren / MB})
+    record['totalTime'] = sum(step['time'] for step in record['steps'])
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m imodfit.benchmarks', description=__doc__)
+    parser.add_argument('--cases', default=DEFAULT_CASES,
+                        help='Comma separated cases nAtoms x boxSize (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=100, help='iMODfit maximum iterations')
+    parser.add_argument('--threads', type=int, default=1, help='iMODfit MKL threads')
+    parser.add_argument('--standin', action='store_true',
+                        help='Use the stand-in executable instead of the installed iMODfit')
+    parser.add_argument('--workdir', help='Folder for the cases (default: a temporary folder, removed at the end)')
+    parser.add_argument('-o', '--output', default='imodfit_benchmark.json', help='Output JSON file')
+    args = parser.parse_args(argv)
+
+    workDir = args.workdir or tempfile.mkdtemp(prefix='imodfit_benchmark_')
+    # Before the plugin variables are defined. The benchmark fittings are kept out of the calibration of the
+    # time and memory predictions of the user
+    os.environ['IMODFIT_CALIBRATION'] = os.path.join(workDir, 'calibration.jsonl')
+    if args.standin:
+        os.environ['IMODFIT_HOME'] = createStandinHome(os.path.join(workDir, 'standin'))
+
+    # Registers the plugin, defining its variables, and its protocols
+    from pwem import Domain
+    Domain.getPluginModule('imodfit')
+    Domain.getProtocols()
+    from .. import Plugin, __version__
+    results = {'plugin': __version__, 'executable': 'standin' if args.standin else Plugin.getHome('bin'),
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(), 'cpus': os.cpu_count(),
+               'python': platform.python_version(), 'numpy': np.__version__,
+               'iterations': args.iterations, 'threads': args.threads, 'cases': []}
+    try:
+        for nAtoms, boxSize in parseCases(args.cases):
+            print('Case %d atoms, %d^3 voxels' % (nAtoms, boxSize))
+            sys.stdout.flush()
+            record = runCase(nAtoms, boxSize, os.path.join(workDir, 'case_%d_%d' % (nAtoms, boxSize)),
+                             args.iterations, numberOfThreads=args.threads)
+            for step in record['steps']:
+                print('    %-20s %8.2f s  %8.1f MB  (iMODfit %8.1f MB)'
+                      % (step['step'], step['time'], step['peakMemoryMB'], step['peakChildMemoryMB']))
+            results['cases'].append(record)
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workDir, ignore_errors=True)
+    return results
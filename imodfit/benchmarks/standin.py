@@ -0,0 +1,123 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Stand-in of the imodfit_mkl executable for benchmarks and tests without the real binary.
+
+It accepts the same arguments as iMODfit and writes the same outputs: the iteration lines with the
+score, <basename>_fitted.pdb and, with -t, the <basename>_movie.pdb Multi-PDB movie. The structure
+is just moved a little at each iteration. IMODFIT_STANDIN_DELAY seconds are waited per iteration.
+"""
+import os
+import sys
+import time
+import shlex
+
+from ..trajectory import getMovieInterval
+
+FLAGS = {'-x', '-F', '-t'}
+REPORTED_ITERATIONS = 50
+
+
+def parseArgs(argv):
+    """ Returns the positional arguments and the options dict. The arguments may be quoted together,
+    as Plugin.runIMODfit does when the output is saved in a file """
+    tokens = [token for arg in argv for token in shlex.split(arg)]
+    positional, options = [], {}
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if len(token) == 2 and token.startswith('-') and not token[1].isdigit():
+            if token in FLAGS:
+                options[token] = True
+                i += 1
+            else:
+                options[token] = tokens[i + 1]
+                i += 2
+        else:
+            positional.append(token)
+            i += 1
+    return positional, options
+
+
+def writeModel(f, atomLines, shift):
+    for line in atomLines:
+        f.write('%s%8.3f%s\n' % (line[:30], float(line[30:38]) + shift, line[38:].rstrip('\n')))
+
+
+def main(argv=None):
+    positional, options = parseArgs(sys.argv[1:] if argv is None else argv)
+    pdbFile, mapFile = positional[0], positional[1]
+    if not (os.path.exists(pdbFile) and os.path.exists(mapFile)):
+        sys.exit('Missing input files: %s %s' % (pdbFile, mapFile))
+    basename = options.get('-o', 'imodfit')
+    nIter = int(options.get('-i', 100))
+    delay = float(os.environ.get('IMODFIT_STANDIN_DELAY', '0'))
+    with open(pdbFile) as f:
+        atomLines = [line for line in f if line.startswith(('ATOM', 'HETATM'))]
+
+    movie = open(basename + '_movie.pdb', 'w') if options.get('-t') else None
+    frameStep = getMovieInterval(nIter)
+    if movie is not None:
+        # The starting model
+        movie.write('MODEL        1\n')
+        writeModel(movie, atomLines, 0.0)
+        movie.write('ENDMDL\n')
+    reportStep = max(1, nIter // REPORTED_ITERATIONS)
+    score, t0 = 0.5, time.time()
+    for it in range(1, nIter + 1):
+        score += (0.95 - score) * 0.05
+        if it % reportStep == 0 or it == nIter:
+            print('  %6d  %.6f  %.2f' % (it, score, time.time() - t0))
+            sys.stdout.flush()
+        if movie is not None and it % frameStep == 0:
+            movie.write('MODEL     %4d\n' % (it // frameStep + 1))
+            writeModel(movie, atomLines, 0.01 * it / nIter)
+            movie.write('ENDMDL\n')
+            movie.flush()
+        if delay:
+            time.sleep(delay)
+
+    with open(basename + '_fitted.pdb', 'w') as f:
+        writeModel(f, atomLines, 0.01)
+        f.write('END\n')
+    if movie is not None:
+        movie.close()
+
+
+def createStandinHome(homeDir):
+    """ Creates an iMODfit home folder whose bin/imodfit_mkl runs this stand-in with the current python.
+    It is a python script, so the process is found by its name as the real program (monitor.terminateProgram) """
+    binDir = os.path.join(homeDir, 'bin')
+    os.makedirs(binDir, exist_ok=True)
+    program = os.path.join(binDir, 'imodfit_mkl')
+    with open(program, 'w') as f:
+        f.write('#!%s\nfrom imodfit.benchmarks.standin import main\nmain()\n' % sys.executable)
+    os.chmod(program, 0o755)
+    return homeDir
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Generators of synthetic structures made of alpha helices and of their simulated maps.
+"""
+import numpy as np
+
+from ..convert import createMapFile, _SectionStats
+from ..scoring import simulateMap
+
+# Alpha helix geometry: rise (A) and turn (radians) per residue and radius (A) of each backbone atom
+HELIX_RISE, HELIX_TURN = 1.5, 2 * np.pi / 3.6
+BACKBONE = [('N', 1.55, -0.5), ('CA', 2.3, 0.0), ('C', 1.6, 0.5), ('O', 2.0, 0.9)]
+HELIX_RESIDUES = 30
+HELIX_SPACING = 10.0
+
+
+def generateHelices(nAtoms):
+    """ Returns the coordinates ((nAtoms, 3) array) and atom names of a structure of parallel helices of
+    HELIX_RESIDUES residues, packed in a cube centered at the origin """
+    nResidues = int(np.ceil(nAtoms / float(len(BACKBONE))))
+    nHelices = int(np.ceil(nResidues / float(HELIX_RESIDUES)))
+    helixLength = HELIX_RESIDUES * HELIX_RISE + HELIX_SPACING
+    side = (nHelices * HELIX_SPACING ** 2 * helixLength) ** (1 / 3.0)
+    nLayers = max(1, int(round(side / helixLength)))
+    nColumns = int(np.ceil(np.sqrt(nHelices / float(nLayers))))
+
+    res = np.arange(nResidues)
+    helix, resInHelix = res // HELIX_RESIDUES, res % HELIX_RESIDUES
+    layer, column = helix // nColumns ** 2, helix % nColumns ** 2
+    center = np.stack([(column % nColumns) * HELIX_SPACING, (column // nColumns) * HELIX_SPACING,
+                       layer * helixLength + resInHelix * HELIX_RISE], axis=1)
+
+    coords = []
+    for _, radius, phase in BACKBONE:
+        angle = resInHelix * HELIX_TURN + phase
+        coords.append(center + np.stack([radius * np.cos(angle), radius * np.sin(angle),
+                                         np.full(nResidues, phase * HELIX_RISE / HELIX_TURN)], axis=1))
+    coords = np.stack(coords, axis=1).reshape(-1, 3)[:nAtoms]
+    coords -= (coords.min(axis=0) + coords.max(axis=0)) / 2
+    names = [BACKBONE[i % len(BACKBONE)][0] for i in range(nAtoms)]
+    return coords.astype(np.float32), names
+
+
+def writeStructure(pdbFile, coords, names):
+    """ Writes the synthetic structure as alanine residues, in chains of 9999 residues """
+    chains = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    nBackbone = len(BACKBONE)
+    with open(pdbFile, 'w') as f:
+        for i, ((x, y, z), name) in enumerate(zip(coords, names)):
+            res = i // nBackbone
+            f.write('ATOM  %5d  %-3s ALA %s%4d    %8.3f%8.3f%8.3f  1.00  0.00           %s\n'
+                    % (i % 100000, name, chains[(res // 9999) % len(chains)], res % 9999 + 1, x, y, z, name[0]))
+        f.write('END\n')
+
+
+def writeSimulatedMap(mapFile, coords, boxSize, sampling, resolution, noise=0.05, seed=0):
+    """ Writes a boxSize^3 map centered at the origin with the simulated density of the atoms plus gaussian
+    noise of noise times the maximum density. The map is written section by section """
+    dims = (boxSize,) * 3
+    origin = [-boxSize / 2.0 * sampling] * 3
+    header = {'dims': dims, 'sampling': (sampling,) * 3, 'origin': origin}
+    (x0, y0, z0), density = simulateMap(coords, np.full(len(coords), 6, dtype=np.float32), header, resolution)
+    nz, ny, nx = density.shape
+    noiseStd = noise * float(density.max()) if density.size else noise
+
+    rng = np.random.default_rng(seed)
+    data = createMapFile(mapFile, dims, header['sampling'], origin)
+    stats = _SectionStats()
+    for k in range(boxSize):
+        section = rng.normal(0, noiseStd, (boxSize, boxSize)).astype(np.float32)
+        if z0 <= k < z0 + nz:
+            section[y0:y0 + ny, x0:x0 + nx] += density[k - z0]
+        data[k] = section
+        stats.add(section)
+    data.flush()
+    del data
+    stats.writeHeader(mapFile)
+
+
+def generateCase(pdbFile, mapFile, nAtoms, boxSize):
+    """ Writes a synthetic structure of nAtoms and its simulated map of boxSize^3 voxels, with a sampling
+    rate such that the structure fills 80% of the box. Returns the sampling rate and resolution """
+    coords, names = generateHelices(nAtoms)
+    extent = float((coords.max(axis=0) - coords.min(axis=0)).max()) + 2 * HELIX_SPACING
+    sampling = round(max(extent / (0.8 * boxSize), 0.5), 3)
+    resolution = max(3.0, 5 * sampling)
+    writeStructure(pdbFile, coords, names)
+    writeSimulatedMap(mapFile, coords, boxSize, sampling, resolution)
+    return sampling, resolution
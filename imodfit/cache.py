@@ -0,0 +1,190 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Content addressed file cache shared between iMODfit runs.
+
+Converted inputs (header corrected ccp4 maps, pdb files converted from mmCIF) are stored once
+in the cache directory, keyed by the hash of the input file and the conversion parameters,
+and hardlinked into the working directory of each run, or copied if the run is in another file system,
+so evicting an entry never removes the file of a run. Fitting results are stored the same way in a
+second cache, keyed by the hashes of the inputs and the iMODfit arguments, and copied into the runs,
+as they may be modified in place by later steps.
+"""
+import os
+import fcntl
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+HASH_BLOCK = 16 * 1024 * 1024
+LOCK_FILE = '.lock'
+HASHES_DIR = '.hashes'
+TMP_PREFIX = 'tmp.'
+
+
+class FileCache:
+    """ Directory of files addressed by key, evicted by LRU once their total size exceeds maxSize (bytes).
+    The last access time of an entry is kept as its modification time. """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        os.makedirs(os.path.join(self.path, HASHES_DIR), exist_ok=True)
+
+    # --------------------------- KEYS ------------------------------
+    def fileHash(self, fileName):
+        """ Returns the content hash of a file. The hash is remembered for the file path, size and
+        modification time, so unchanged files are only read once """
+        fileName = os.path.realpath(fileName)
+        st = os.stat(fileName)
+        stamp = '{} {}'.format(st.st_size, st.st_mtime_ns)
+        record = os.path.join(self.path, HASHES_DIR, hashlib.sha1(fileName.encode()).hexdigest())
+        if os.path.exists(record):
+            with open(record) as f:
+                recStamp, _, recHash = f.read().strip().rpartition(' ')
+            if recStamp == stamp:
+                return recHash
+
+        sha = hashlib.sha1()
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                sha.update(block)
+        fileHash = sha.hexdigest()
+        self._atomicWrite(record, '{} {}\n'.format(stamp, fileHash))
+        return fileHash
+
+    def getKey(self, fileName, *params):
+        """ Returns the cache key of a file converted with the given parameters """
+        key = hashlib.sha1(self.fileHash(fileName).encode())
+        for param in params:
+            key.update(repr(param).encode())
+        return key.hexdigest()
+
+    # --------------------------- ENTRIES ------------------------------
+    def getEntryPath(self, key, ext):
+        return os.path.join(self.path, key[:2], '{}.{}'.format(key, ext))
+
+    def fetch(self, key, ext, destFile, createFunc):
+        """ Links the entry key into destFile (see link). If the entry is not in the cache yet, it is created
+        calling createFunc(fileName) and the cache is then evicted to its maximum size.
+        Returns True if the entry was already cached """
+        entry = self.getEntryPath(key, ext)
+        try:
+            os.utime(entry)
+            self.link(entry, destFile)
+            return True
+        except FileNotFoundError:
+            # Not cached yet or evicted meanwhile
+            pass
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmpFile = self._getTmpPath(entry)
+        try:
+            createFunc(tmpFile)
+            os.replace(tmpFile, entry)
+        finally:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+        self.link(entry, destFile)
+        self.evict(keep=entry)
+        return False
+
+    def get(self, key, ext, destFile):
+        """ Copies the entry key into destFile. Returns False if it is not cached """
+        entry = self.getEntryPath(key, ext)
+        try:
+            os.utime(entry)
+            shutil.copyfile(entry, destFile)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, key, ext, fileName):
+        """ Stores a copy of fileName as the entry key, so later changes of fileName do not alter it.
+        The cache is not evicted """
+        entry = self.getEntryPath(key, ext)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmpFile = self._getTmpPath(entry)
+        try:
+            shutil.copyfile(fileName, tmpFile)
+            os.replace(tmpFile, entry)
+        finally:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+
+    @staticmethod
+    def link(src, dst):
+        """ Hardlinks src into dst, copying it if both are not in the same file system. A symbolic link would
+        break once the entry is evicted """
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def evict(self, keep=None):
+        """ Removes the least recently used entries until the cache fits in its maximum size """
+        with self._lock():
+            entries = []
+            for root, dirs, files in os.walk(self.path):
+                dirs[:] = [d for d in dirs if d != HASHES_DIR]
+                for fn in files:
+                    if fn == LOCK_FILE or fn.startswith(TMP_PREFIX):
+                        continue
+                    fullFn = os.path.join(root, fn)
+                    st = os.stat(fullFn)
+                    entries.append((st.st_mtime, st.st_size, fullFn))
+
+            totalSize = sum(e[1] for e in entries)
+            for mtime, size, fullFn in sorted(entries):
+                if totalSize <= self.maxSize:
+                    break
+                if fullFn != keep:
+                    os.remove(fullFn)
+                    totalSize -= size
+
+    # --------------------------- UTILS ------------------------------
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.path, LOCK_FILE), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _getTmpPath(fileName):
+        """ Temporary path in the same folder of fileName, keeping its extension """
+        return os.path.join(os.path.dirname(fileName), '{}{}.{}.{}'.format(
+            TMP_PREFIX, os.getpid(), threading.get_ident(), os.path.basename(fileName)))
+
+    def _atomicWrite(self, fileName, content):
+        tmpFile = self._getTmpPath(fileName)
+        with open(tmpFile, 'w') as f:
+            f.write(content)
+        os.replace(tmpFile, fileName)
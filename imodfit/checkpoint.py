@@ -0,0 +1,153 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Checkpoints of long iMODfit runs.
+
+While iMODfit runs, the last complete model of its movie is saved every interval iterations with the
+iteration count, so an interrupted fitting can be started again from it with the remaining iterations.
+The movie written before each restart is kept as a numbered part, and the parts are stitched into a
+single movie once the fitting finishes.
+"""
+import os
+import glob
+import json
+import itertools
+
+from .convert import readPdbAtoms
+from .trajectory import iterPdbModels, writeModels, writeTopology, getModelIteration
+
+PART_FORMAT = '{}_part{:03d}{}'
+
+
+class Checkpointer:
+    """ Monitor callback (imodfit.monitor.ImodfitMonitor) that saves a checkpoint with the last complete
+    model of the movie every interval iterations. Iterations and elapsed times are counted from the start
+    of the fitting, which resumed at startIteration after startElapsed seconds and ends at endIteration.
+    Each model is saved with its own iteration, given by the movieInterval of the run
+    (trajectory.getMovieInterval) """
+    def __init__(self, checkpointFile, moviePdb, interval, startIteration=0, endIteration=None, startElapsed=0.0,
+                 movieInterval=1):
+        self.checkpointFile = checkpointFile
+        self.moviePdb = moviePdb
+        self.interval = interval
+        self.startIteration, self.endIteration = startIteration, endIteration
+        self.startElapsed = startElapsed
+        self.movieInterval = movieInterval
+        self.iteration = startIteration
+        self._pos, self._nModels = 0, 0
+        self._lastModel, self._lastModelEnd = None, None
+
+    def __call__(self, iteration, score, elapsed):
+        if not self.interval or iteration - self.iteration < self.interval:
+            return
+        self._readNewModels()
+        modelIteration = getModelIteration(self._nModels, self.movieInterval, self.startIteration)
+        if self._lastModel is not None and modelIteration > self.iteration:
+            saveCheckpoint(self.checkpointFile, self._lastModel, modelIteration, elapsed, self._lastModelEnd)
+            self.iteration = modelIteration
+
+    def _readNewModels(self):
+        """ Reads the models completed in the movie since the last call, keeping the last one and the
+        offset where it ends """
+        if not os.path.exists(self.moviePdb):
+            return
+        atomLines = []
+        with open(self.moviePdb, 'rb') as f:
+            f.seek(self._pos)
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    break
+                if line.startswith((b'ATOM', b'HETATM')):
+                    atomLines.append(line.decode())
+                elif line.startswith(b'ENDMDL'):
+                    self._pos = f.tell()
+                    if atomLines:
+                        self._lastModel, self._lastModelEnd = atomLines, self._pos
+                        self._nModels += 1
+                    atomLines = []
+
+    def saveFinal(self, fittedPdb, iteration, elapsed):
+        """ Saves the checkpoint of a finished fitting, which allows extending it with more iterations """
+        saveCheckpoint(self.checkpointFile, readPdbAtoms(fittedPdb), iteration, elapsed, None)
+
+
+def saveCheckpoint(checkpointFile, atomLines, iteration, elapsed, movieOffset):
+    """ Saves the model of a checkpoint into its own pdb and then replaces the checkpoint file pointing to it,
+    so a checkpoint is never left half written. movieOffset is the size of the movie up to the model,
+    or None if the whole movie is valid """
+    previous = readCheckpoint(checkpointFile)
+    pdbFile = '{}_{}.pdb'.format(os.path.splitext(checkpointFile)[0], iteration)
+    writeTopology(atomLines, pdbFile)
+    tmpFile = checkpointFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump({'iteration': iteration, 'elapsed': elapsed, 'pdbFile': os.path.abspath(pdbFile),
+                   'movieOffset': movieOffset}, f, indent=2)
+    os.replace(tmpFile, checkpointFile)
+    if previous is not None and previous['pdbFile'] != os.path.abspath(pdbFile) \
+            and os.path.exists(previous['pdbFile']):
+        os.remove(previous['pdbFile'])
+
+
+def readCheckpoint(checkpointFile):
+    """ Returns the checkpoint dict with the iteration, elapsed seconds, model pdbFile and movieOffset, or None """
+    if not os.path.exists(checkpointFile):
+        return None
+    with open(checkpointFile) as f:
+        return json.load(f)
+
+
+def getPartFiles(fileName):
+    root, ext = os.path.splitext(fileName)
+    return sorted(glob.glob(glob.escape(root) + '_part[0-9][0-9][0-9]' + glob.escape(ext)))
+
+
+def archivePart(fileName, size=None):
+    """ Renames fileName as its next numbered part (<root>_partNNN<ext>), truncated to size bytes if given """
+    if not os.path.exists(fileName):
+        return None
+    if size is not None:
+        with open(fileName, 'rb+') as f:
+            f.truncate(size)
+    root, ext = os.path.splitext(fileName)
+    partFile = PART_FORMAT.format(root, len(getPartFiles(fileName)) + 1, ext)
+    os.replace(fileName, partFile)
+    return partFile
+
+
+def stitchMovie(moviePdb):
+    """ Joins the movie parts and the last movie into moviePdb, numbering their models consecutively,
+    and removes the parts. Each movie after the first one starts with the model of the restart point, which
+    already ends the previous one, so its first model is left out """
+    parts = getPartFiles(moviePdb)
+    if not parts:
+        return
+    movies = [movieFile for movieFile in parts + [moviePdb] if os.path.exists(movieFile)]
+    tmpFile = moviePdb + '.tmp'
+    writeModels((atomLines for i, movieFile in enumerate(movies)
+                 for atomLines in itertools.islice(iterPdbModels(movieFile), 1 if i else 0, None)), tmpFile)
+    os.replace(tmpFile, moviePdb)
+    for part in parts:
+        os.remove(part)
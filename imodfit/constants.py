@@ -31,3 +31,34 @@ IMODFIT = 'iMODfit'
 # Supported versions:
 V1_51 = '1.51'
 IMODFIT_DEFAULT_VERSION = V1_51
+
+# Installation archives. A local mirror folder with the archives and their SHA256SUMS is preferred to downloading
+IMODFIT_MIRROR = 'IMODFIT_MIRROR'
+IMODFIT_ARCHIVE = 'iMODFIT_v1.51_Linux_20190228.txz'
+IMODFIT_DOWNLOAD_PAGE = 'https://chaconlab.org/hybrid4em/imodfit/imodfit-donwload/item/imodfit-linux64'
+MKL_ARCHIVE = 'intel_mkl_lib.sh'
+MKL_URL = 'https://registrationcenter-download.intel.com/akdlm/irc_nas/17757/l_onemkl_p_2021.2.0.296_offline.sh'
+
+# Cache of converted inputs shared between runs
+IMODFIT_CACHE = 'IMODFIT_CACHE'
+IMODFIT_CACHE_SIZE = 'IMODFIT_CACHE_SIZE'  # GB
+IMODFIT_CACHE_DEFAULT_SIZE = 50
+
+# Cache of fitting results, reused by identical fittings
+IMODFIT_RESULTS = 'IMODFIT_RESULTS'
+IMODFIT_RESULTS_SIZE = 'IMODFIT_RESULTS_SIZE'  # GB
+IMODFIT_RESULTS_DEFAULT_SIZE = 20
+
+# Measurements of past iMODfit executions, used to predict the time and memory of new ones
+IMODFIT_CALIBRATION = 'IMODFIT_CALIBRATION'
+
+# State file of the scheduler of the cores used by the iMODfit jobs of a node
+IMODFIT_CORES_FILE = 'IMODFIT_CORES_FILE'
+
+# iMODfit prints one line per reported iteration starting with the iteration number
+# followed by the correlation score, e.g. "    120  0.853210  ..."
+IMODFIT_ITER_REGEX = r'^\s*(\d+)\s+(-?\d+\.\d+)\b'
+
+# With -t, iMODfit writes the starting model as the first model of its movie and then one model every
+# maxIter // IMODFIT_MOVIE_FRAMES iterations (at least one)
+IMODFIT_MOVIE_FRAMES = 20
@@ -0,0 +1,308 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Conversion helpers for the iMODfit input and output files.
+
+Maps are accessed through numpy memory maps, so only the sections that are actually used are read
+from disk, and structures are parsed line by line from their pdb files. SPIDER (and Xmipp .vol) volumes
+are read the same way, so they are converted to CCP4 one section at a time.
+"""
+import os
+import struct
+
+import numpy as np
+
+MRC_HEADER_SIZE = 1024
+MRC_DTYPES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16}
+SPIDER_EXTENSIONS = ('.spi', '.vol', '.xmp')
+SPIDER_VOLUME = 3
+
+
+# --------------------------- MAPS ------------------------------
+def readMapHeader(mapFile):
+    """ Reads the main fields of a MRC/CCP4 map header.
+    Returns a dict with the dimensions (nc, nr, ns), the data type and endianness, the axis order, the sampling rate and
+    origin (Angstroms) per axis and the offset of the data in the file """
+    with open(mapFile, 'rb') as f:
+        raw = f.read(MRC_HEADER_SIZE)
+
+    # Machine stamp 0x11 0x11 means big endian data
+    endian = '>' if raw[212] == 0x11 else '<'
+    nc, nr, ns, mode, ncstart, nrstart, nsstart, nx, ny, nz = struct.unpack_from(endian + '10i', raw, 0)
+    cell = struct.unpack_from(endian + '3f', raw, 40)
+    axes = struct.unpack_from(endian + '3i', raw, 64)
+    nsymbt = struct.unpack_from(endian + 'i', raw, 92)[0]
+    origin = struct.unpack_from(endian + '3f', raw, 196)
+
+    grid = (nx or nc, ny or nr, nz or ns)
+    sampling = tuple(float(c) / g if g else 1.0 for c, g in zip(cell, grid))
+    if not any(origin) or any(np.isnan(origin)):
+        # Origin given as the start pixel
+        origin = tuple(s * st for s, st in zip(sampling, (ncstart, nrstart, nsstart)))
+
+    return {'dims': (nc, nr, ns), 'mode': mode, 'endian': endian,
+            'dtype': np.dtype(MRC_DTYPES[mode]).newbyteorder(endian),
+            'axes': axes, 'sampling': sampling, 'origin': tuple(float(o) for o in origin),
+            'offset': MRC_HEADER_SIZE + nsymbt}
+
+
+def readSpiderHeader(spiderFile):
+    """ Reads the dimensions, endianness and data offset of a SPIDER volume, as a dict with the fields of
+    readMapHeader used by openMapData """
+    with open(spiderFile, 'rb') as f:
+        raw = f.read(256)
+    # The endianness is the one giving a valid IFORM
+    endian = '<' if struct.unpack_from('<f', raw, 16)[0] == SPIDER_VOLUME else '>'
+    fields = struct.unpack_from(endian + '24f', raw, 0)
+    if fields[4] != SPIDER_VOLUME or fields[23] > 0:
+        raise ValueError('{} is not a SPIDER volume'.format(spiderFile))
+    nz, ny, nx, offset = int(fields[0]), int(fields[1]), int(fields[11]), int(fields[21])
+    return {'dims': (nx, ny, nz), 'mode': 2, 'endian': endian, 'dtype': np.dtype(np.float32).newbyteorder(endian),
+            'axes': (1, 2, 3), 'offset': offset}
+
+
+def openMapData(mapFile, header=None, mode='r'):
+    """ Returns the map data as a memory map with shape (ns, nr, nc) """
+    header = header or readMapHeader(mapFile)
+    nc, nr, ns = header['dims']
+    return np.memmap(mapFile, dtype=header['dtype'], mode=mode,
+                     offset=header['offset'], shape=(ns, nr, nc))
+
+
+def getBoxAroundCoords(coords, header, margin):
+    """ Returns the (start, end) voxel indexes in x, y, z of the box containing the
+    coordinates plus a margin (Angstroms), clipped to the map dimensions """
+    sampling = np.array(header['sampling'])
+    origin = np.array(header['origin'])
+    dims = np.array(header['dims'])
+    start = np.floor((coords.min(axis=0) - margin - origin) / sampling).astype(int)
+    end = np.ceil((coords.max(axis=0) + margin - origin) / sampling).astype(int) + 1
+    return np.clip(start, 0, dims), np.clip(end, 0, dims)
+
+
+def cropMap(inMap, outMap, start, end):
+    """ Writes the box [start, end) (voxels in x, y, z) of inMap into outMap, updating the dimensions
+    and origin of the header so the cropped map keeps the coordinates of the original one.
+    Only the needed sections are read from inMap """
+    header = readMapHeader(inMap)
+    _checkAxesOrder(header)
+    if any(e <= s for s, e in zip(start, end)):
+        raise ValueError('The box to crop from {} is empty: the structure is outside the map'.format(inMap))
+    (x0, y0, z0), (x1, y1, z1) = start, end
+    newDims = (x1 - x0, y1 - y0, z1 - z0)
+    sampling = header['sampling']
+    origin = [o + s * i for o, s, i in zip(header['origin'], sampling, start)]
+
+    inData = openMapData(inMap, header)
+    outData = _createMapFile(outMap, inMap, header, newDims, sampling, origin, header['dtype'])
+    stats = _SectionStats()
+    for k in range(z0, z1):
+        section = inData[k, y0:y1, x0:x1]
+        outData[k - z0] = section
+        stats.add(section)
+    outData.flush()
+    del outData
+    stats.writeHeader(outMap, header['endian'])
+
+
+def binMap(inMap, outMap, factor):
+    """ Writes into outMap the inMap downsampled by averaging blocks of factor^3 voxels, which also
+    low-pass filters it. The origin is shifted to the center of the first block, so coordinates are kept.
+    The input is read in slabs of factor sections """
+    header = readMapHeader(inMap)
+    _checkAxesOrder(header)
+    nc, nr, ns = header['dims']
+    newDims = (nc // factor, nr // factor, ns // factor)
+    sampling = [s * factor for s in header['sampling']]
+    origin = [o + s * (factor - 1) / 2.0 for o, s in zip(header['origin'], header['sampling'])]
+
+    inData = openMapData(inMap, header)
+    outData = _createMapFile(outMap, inMap, header, newDims, sampling, origin, np.dtype(np.float32))
+    nx, ny, nz = newDims
+    stats = _SectionStats()
+    for k in range(nz):
+        slab = np.asarray(inData[k * factor:(k + 1) * factor, :ny * factor, :nx * factor], dtype=np.float32)
+        section = slab.reshape(factor, ny, factor, nx, factor).mean(axis=(0, 2, 4))
+        outData[k] = section
+        stats.add(section)
+    outData.flush()
+    del outData
+    stats.writeHeader(outMap, header['endian'])
+
+
+def mapHistogram(mapFile, bins=1000):
+    """ Returns the histogram of the map values as (counts, edges) and their mean and standard deviation.
+    The map is read section by section, first for its range and then for the histogram """
+    header = readMapHeader(mapFile)
+    data = openMapData(mapFile, header)
+    stats = _SectionStats()
+    for section in data:
+        stats.add(section)
+    mean = stats.sum / stats.n
+    std = np.sqrt(max(stats.sum2 / stats.n - mean ** 2, 0.0))
+
+    edges = np.linspace(stats.min, stats.max if stats.max > stats.min else stats.min + 1, bins + 1)
+    counts = np.zeros(bins, dtype=np.int64)
+    for section in data:
+        counts += np.histogram(section, edges)[0]
+    return counts, edges, float(mean), float(std)
+
+
+def createMapFile(outMap, dims, sampling, origin):
+    """ Creates a float32 MRC map of dims (nx, ny, nz) with the given sampling and origin (Angstroms) per axis.
+    Returns its data as a writable memory map, filled with zeros """
+    rawHeader = bytearray(MRC_HEADER_SIZE)
+    struct.pack_into('<10i', rawHeader, 0, dims[0], dims[1], dims[2], 2, 0, 0, 0, dims[0], dims[1], dims[2])
+    struct.pack_into('<6f', rawHeader, 40, *([n * s for n, s in zip(dims, sampling)] + [90.0] * 3))
+    struct.pack_into('<3i', rawHeader, 64, 1, 2, 3)
+    # Space group 1, a single volume rather than a stack of images
+    struct.pack_into('<i', rawHeader, 88, 1)
+    struct.pack_into('<3f', rawHeader, 196, *origin)
+    rawHeader[208:216] = b'MAP DD\x00\x00'
+    with open(outMap, 'wb') as f:
+        f.write(rawHeader)
+        f.truncate(MRC_HEADER_SIZE + int(np.prod(dims)) * 4)
+    return openMapData(outMap, mode='r+')
+
+
+def isCompatibleMap(mapFile, sampling, origin, tolerance=1e-3):
+    """ Whether mapFile is a MRC/CCP4 map with the standard axes order, a supported mode and the given sampling and
+    origin (Angstroms) in its header, so it can be passed to iMODfit as it is """
+    if os.path.splitext(mapFile)[1] in SPIDER_EXTENSIONS:
+        return False
+    try:
+        header = readMapHeader(mapFile)
+    except (KeyError, struct.error):
+        return False
+    return tuple(header['axes']) == (1, 2, 3) and \
+        np.allclose(header['sampling'], sampling, atol=tolerance) and \
+        np.allclose(header['origin'], origin, atol=tolerance)
+
+
+def convertSpiderToCcp4(spiderFile, ccp4File, sampling, origin):
+    """ Writes a SPIDER volume as a float32 CCP4 map with the given sampling and origin (Angstroms),
+    copying one section at a time into the memory mapped output """
+    header = readSpiderHeader(spiderFile)
+    inData = openMapData(spiderFile, header)
+    outData = createMapFile(ccp4File, header['dims'], [sampling] * 3, origin)
+    stats = _SectionStats()
+    for k, section in enumerate(inData):
+        outData[k] = section
+        stats.add(section)
+    outData.flush()
+    del outData
+    stats.writeHeader(ccp4File)
+
+
+def _checkAxesOrder(header):
+    if tuple(header['axes']) != (1, 2, 3):
+        raise ValueError('Only maps with the standard X, Y, Z axes order are supported')
+
+
+def _createMapFile(outMap, templateMap, templateHeader, dims, sampling, origin, dtype):
+    """ Creates outMap with the header of templateMap, updating its dimensions, sampling, origin and mode.
+    Returns its data as a writable memory map """
+    with open(templateMap, 'rb') as f:
+        rawHeader = bytearray(f.read(templateHeader['offset']))
+    endian = templateHeader['endian']
+    mode = [m for m, t in MRC_DTYPES.items() if np.dtype(t) == dtype.newbyteorder('=')][0]
+    struct.pack_into(endian + '4i', rawHeader, 0, dims[0], dims[1], dims[2], mode)
+    struct.pack_into(endian + '3i', rawHeader, 16, 0, 0, 0)
+    struct.pack_into(endian + '3i', rawHeader, 28, *dims)
+    struct.pack_into(endian + '3f', rawHeader, 40, *[n * s for n, s in zip(dims, sampling)])
+    struct.pack_into(endian + '3f', rawHeader, 196, *origin)
+
+    with open(outMap, 'wb') as f:
+        f.write(rawHeader)
+        f.truncate(len(rawHeader) + int(np.prod(dims)) * dtype.itemsize)
+    outHeader = dict(templateHeader, dims=tuple(dims), mode=mode, dtype=dtype.newbyteorder(endian))
+    return openMapData(outMap, outHeader, mode='r+')
+
+
+class _SectionStats:
+    """ Accumulates the min, max, mean and rms of a map section by section """
+    def __init__(self):
+        self.min, self.max = np.inf, -np.inf
+        self.sum, self.sum2, self.n = 0.0, 0.0, 0
+
+    def add(self, section):
+        section = np.asarray(section, dtype=np.float64)
+        if section.size:
+            self.min = min(self.min, section.min())
+            self.max = max(self.max, section.max())
+            self.sum += section.sum()
+            self.sum2 += np.square(section).sum()
+            self.n += section.size
+
+    def writeHeader(self, mapFile, endian='<'):
+        """ Writes the statistics in the DMIN, DMAX, DMEAN and RMS fields of the map header """
+        if not self.n:
+            return
+        mean = self.sum / self.n
+        rms = np.sqrt(max(self.sum2 / self.n - mean ** 2, 0.0))
+        with open(mapFile, 'rb+') as f:
+            f.seek(76)
+            f.write(struct.pack(endian + '3f', self.min, self.max, mean))
+            f.seek(216)
+            f.write(struct.pack(endian + 'f', rms))
+
+
+# --------------------------- STRUCTURES ------------------------------
+def readPdbAtoms(pdbFile):
+    """ Returns the ATOM and HETATM lines of the first model of a pdb file """
+    atomLines = []
+    with open(pdbFile) as f:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                atomLines.append(line)
+            elif line.startswith('ENDMDL'):
+                break
+    return atomLines
+
+
+def readPdbCoordinates(pdbFile):
+    """ Returns the coordinates of the ATOM and HETATM records of the first model of a pdb file,
+    as a (nAtoms, 3) float32 array """
+    coords = [(line[30:38], line[38:46], line[46:54]) for line in readPdbAtoms(pdbFile)]
+    return np.array(coords, dtype=np.float32).reshape(-1, 3)
+
+
+def getChains(atomLines):
+    """ Returns the chain identifiers of a list of pdb atom lines, in order of appearance """
+    return list(dict.fromkeys(line[21] for line in atomLines))
+
+
+def selectChains(atomLines, chains):
+    """ Returns the atom lines of the given chains """
+    chains = set(chains)
+    return [line for line in atomLines if line[21] in chains]
+
+
+def updateCoordinates(atomLines, movedLines):
+    """ Returns atomLines with the coordinates of the atoms of movedLines, matched by their name, residue, chain
+    and residue number. Atoms not in movedLines keep their coordinates """
+    moved = {line[12:27]: line[30:54] for line in movedLines}
+    return [line[:30] + moved.get(line[12:27], line[30:54]) + line[54:] for line in atomLines]
@@ -0,0 +1,90 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Ordering of a set of related maps for warm-started fittings.
+
+The maps are compared by the correlation of their downsampled copies, and arranged in the maximum
+spanning tree of their similarities, rooted at the map most similar to all the others. Each map is
+then fitted starting from the fitted model of its parent in the tree, its most similar map among
+the ones fitted before, and the fittings of different branches are independent.
+"""
+import numpy as np
+
+from .convert import readMapHeader, openMapData, _checkAxesOrder
+
+DOWNSAMPLED_SIZE = 32
+
+
+def downsampleMap(mapFile, size=DOWNSAMPLED_SIZE):
+    """ Returns the map downsampled by averaging blocks of voxels to about size voxels in its smallest axis,
+    as a (nz, ny, nx) float32 array. The map is read in slabs of one block """
+    header = readMapHeader(mapFile)
+    _checkAxesOrder(header)
+    factor = max(1, min(header['dims']) // size)
+    nx, ny, nz = (n // factor for n in header['dims'])
+    data = openMapData(mapFile, header)
+    small = np.empty((nz, ny, nx), dtype=np.float32)
+    for k in range(nz):
+        slab = np.asarray(data[k * factor:(k + 1) * factor, :ny * factor, :nx * factor], dtype=np.float32)
+        small[k] = slab.reshape(factor, ny, factor, nx, factor).mean(axis=(0, 2, 4))
+    return small
+
+
+def mapSimilarities(mapFiles, size=DOWNSAMPLED_SIZE):
+    """ Returns the matrix of correlations between the downsampled maps, which must have the same box """
+    maps = []
+    for mapFile in mapFiles:
+        small = downsampleMap(mapFile, size).ravel()
+        small -= small.mean()
+        maps.append(small / (np.linalg.norm(small) or 1.0))
+    if len({m.size for m in maps}) > 1:
+        raise ValueError('The maps must have the same box size to be compared')
+    maps = np.array(maps)
+    return maps @ maps.T
+
+
+def getWarmStartTree(similarities):
+    """ Returns the maximum spanning tree of the similarities as (order, parents): the map indexes in the order
+    they are added to the tree, starting from the map with the highest similarity to all the others, and the
+    parent index of each map (None for the root) """
+    nMaps = len(similarities)
+    offDiagonal = similarities - np.diag(np.diag(similarities))
+    root = int(np.argmax(offDiagonal.sum(axis=1)))
+    order, parents = [root], [None] * nMaps
+    best = similarities[root].copy()
+    bestParent = np.full(nMaps, root)
+    inTree = np.zeros(nMaps, dtype=bool)
+    inTree[root] = True
+    while len(order) < nMaps:
+        candidates = np.where(inTree, -np.inf, best)
+        nextMap = int(np.argmax(candidates))
+        order.append(nextMap)
+        parents[nextMap] = int(bestParent[nextMap])
+        inTree[nextMap] = True
+        closer = similarities[nextMap] > best
+        best[closer] = similarities[nextMap][closer]
+        bestParent[closer] = nextMap
+    return order, parents
@@ -0,0 +1,141 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Fetching of the iMODfit and MKL installation archives.
+
+Archives are taken from a local mirror folder when it contains them and their checksum matches the one
+listed in its SHA256SUMS file, so nodes without internet access can install the plugin. Otherwise they are
+downloaded, and checked against the mirror checksums if listed. A mirror is created with:
+
+    python -m imodfit.install mirror <mirrorDir>
+"""
+import os
+import sys
+import html
+import shutil
+import hashlib
+import argparse
+import urllib.request
+
+from .constants import IMODFIT_MIRROR, IMODFIT_ARCHIVE, IMODFIT_DOWNLOAD_PAGE, MKL_ARCHIVE, MKL_URL
+
+CHECKSUMS_FILE = 'SHA256SUMS'
+HASH_BLOCK = 16 * 1024 * 1024
+
+
+def getImodfitUrl():
+    """ Returns the download url of the iMODfit archive, which is found in the chaconlab web """
+    htmlStr = urllib.request.urlopen(IMODFIT_DOWNLOAD_PAGE).read().decode('utf-8')
+    for line in htmlStr.split('\n'):
+        if 'href="/hybrid4em/imodfit/imodfit-donwload?task=callelement&amp;format=raw&amp;item_id=23' in line:
+            for element in line.split(' '):
+                if element.startswith('href='):
+                    return 'https://chaconlab.org' + html.unescape(element.split('"')[1])
+    raise Exception('Could not find the package url in the https://chaconlab.org web')
+
+
+ARCHIVE_URLS = {IMODFIT_ARCHIVE: getImodfitUrl, MKL_ARCHIVE: lambda: MKL_URL}
+
+
+def fileChecksum(fileName):
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def readChecksums(mirrorDir):
+    """ Reads the {archive: sha256} of a mirror from its SHA256SUMS file (sha256sum format) """
+    checksums = {}
+    checksumsFile = os.path.join(mirrorDir, CHECKSUMS_FILE)
+    if os.path.exists(checksumsFile):
+        with open(checksumsFile) as f:
+            for line in f:
+                if line.strip():
+                    checksum, name = line.split(None, 1)
+                    checksums[name.strip().lstrip('*')] = checksum
+    return checksums
+
+
+def download(archive, destFile):
+    print('Downloading {}'.format(archive))
+    with urllib.request.urlopen(ARCHIVE_URLS[archive]()) as response, open(destFile, 'wb') as f:
+        shutil.copyfileobj(response, f)
+
+
+def fetchArchive(archive, destFile, mirrorDir=None):
+    """ Copies the archive from the mirror into destFile, or downloads it if it is not in the mirror
+    or its checksum does not match """
+    checksum = readChecksums(mirrorDir).get(archive) if mirrorDir else None
+    mirrorFile = os.path.join(mirrorDir, archive) if mirrorDir else None
+    if checksum is not None and os.path.exists(mirrorFile):
+        if fileChecksum(mirrorFile) == checksum:
+            print('Using {} from the mirror {}'.format(archive, mirrorDir))
+            shutil.copy(mirrorFile, destFile)
+            return
+        print('Wrong checksum of {} in the mirror {}'.format(archive, mirrorDir))
+
+    download(archive, destFile)
+    if checksum is not None and fileChecksum(destFile) != checksum:
+        os.remove(destFile)
+        raise Exception('Wrong checksum of the downloaded {}'.format(archive))
+
+
+def createMirror(mirrorDir):
+    """ Downloads the archives into mirrorDir, writing their SHA256SUMS """
+    os.makedirs(mirrorDir, exist_ok=True)
+    checksums = readChecksums(mirrorDir)
+    for archive in ARCHIVE_URLS:
+        mirrorFile = os.path.join(mirrorDir, archive)
+        if archive not in checksums or not os.path.exists(mirrorFile) or fileChecksum(mirrorFile) != checksums[archive]:
+            download(archive, mirrorFile)
+            checksums[archive] = fileChecksum(mirrorFile)
+    with open(os.path.join(mirrorDir, CHECKSUMS_FILE), 'w') as f:
+        f.writelines('{}  {}\n'.format(checksum, name) for name, checksum in sorted(checksums.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m imodfit.install', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    fetchParser = subparsers.add_parser('fetch', help='Fetch an archive from the mirror or its url')
+    fetchParser.add_argument('archive', choices=sorted(ARCHIVE_URLS))
+    fetchParser.add_argument('destFile')
+    fetchParser.add_argument('--mirror', default=os.environ.get(IMODFIT_MIRROR),
+                             help='Mirror folder (default: ${})'.format(IMODFIT_MIRROR))
+    mirrorParser = subparsers.add_parser('mirror', help='Download the archives into a mirror folder')
+    mirrorParser.add_argument('mirrorDir')
+    args = parser.parse_args(argv)
+
+    if args.command == 'fetch':
+        fetchArchive(args.archive, args.destFile, args.mirror or None)
+    else:
+        createMirror(args.mirrorDir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
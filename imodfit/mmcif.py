@@ -0,0 +1,209 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Streaming mmCIF to PDB conversion.
+
+The atom_site loop of the first model is read row by row and written as ATOM/HETATM records with only
+the columns used by iMODfit. Structures beyond the PDB format limits are remapped: chains whose identifier
+is longer than one character, or already taken, get a free one, chains share identifiers with consecutive
+residue numbers once the 62 available ones are taken, and atom serials wrap around 99999. A tab separated
+mapping table keeps, for each atom, its PDB name, residue and chain columns and its original atom_site values,
+so fitted models can be written back to mmCIF with the original identifiers.
+"""
+import re
+import string
+
+CHAIN_IDS = string.ascii_uppercase + string.ascii_lowercase + string.digits
+MAX_SERIAL = 99999
+MIN_RESSEQ, MAX_RESSEQ = -999, 9999
+TOKEN_RE = re.compile(r"""'(?:[^']|'(?=\S))*'(?=\s|$)|"(?:[^"]|"(?=\S))*"(?=\s|$)|\S+""")
+MISSING = ('.', '?')
+
+
+def _unquote(token):
+    if len(token) > 1 and token[0] == token[-1] and token[0] in '\'"':
+        return token[1:-1]
+    return token
+
+
+def iterAtomSite(cifFile):
+    """ Iterates over the rows of the atom_site loop of a mmCIF file, yielding them as dicts of the values as
+    they are written in the file, quotes included. The file is read line by line and only the current row is
+    kept in memory """
+    columns, tokens, inLoop = [], [], False
+    with open(cifFile) as f:
+        for line in f:
+            if line.startswith('_atom_site.'):
+                columns.append(line.split()[0][len('_atom_site.'):])
+                inLoop = True
+            elif inLoop and columns:
+                if line.startswith(('loop_', '_', '#', 'data_')):
+                    break
+                if line.startswith(';'):
+                    raise ValueError('Multi-line values are not supported in the atom_site loop')
+                tokens += TOKEN_RE.findall(line) if '"' in line or "'" in line else line.split()
+                while len(tokens) >= len(columns):
+                    yield dict(zip(columns, tokens))
+                    tokens = tokens[len(columns):]
+
+
+def _value(row, *columns):
+    """ Returns the unquoted value of the first of the columns given in the row, or '' """
+    for column in columns:
+        if row.get(column, '.') not in MISSING:
+            return _unquote(row[column])
+    return ''
+
+
+def _formatAtomName(name, element):
+    if len(name) < 4 and len(element) == 1:
+        return ' ' + name.ljust(3)
+    return name.ljust(4)[:4]
+
+
+class _IdMapper:
+    """ Assigns the PDB chain identifier and residue number of each residue. Chains keep their identifier and
+    residue numbers if they fit and the identifier is free. Otherwise, their residues are numbered consecutively
+    in a free identifier or, when none is free, after the residues of the least used one """
+    def __init__(self):
+        self.nextResSeq = {}
+        self.chainIds = {}
+        self.lastResidue, self.lastPdbResidue = None, None
+        self.remapped = False
+
+    def _newChainId(self, chain=''):
+        """ Returns a chain identifier and whether the residues must be renumbered in it """
+        free = [c for c in CHAIN_IDS if c not in self.nextResSeq]
+        if len(chain) == 1 and chain in free:
+            return chain, False
+        self.remapped = True
+        chainId = free[0] if free else min(self.nextResSeq, key=self.nextResSeq.get)
+        if self.nextResSeq.get(chainId, 1) > MAX_RESSEQ:
+            raise ValueError('The structure has too many residues to be written as PDB')
+        return chainId, True
+
+    def getResidue(self, chain, resSeq, insCode):
+        """ Returns the (chainId, resSeq, insCode) of a residue in the PDB file """
+        if (chain, resSeq, insCode) == self.lastResidue:
+            return self.lastPdbResidue
+        if chain not in self.chainIds:
+            self.chainIds[chain] = self._newChainId(chain)
+        chainId, renumbered = self.chainIds[chain]
+        if not renumbered and re.match(r'^-?\d+$', resSeq) and MIN_RESSEQ <= int(resSeq) <= MAX_RESSEQ:
+            pdbResidue = (chainId, int(resSeq), insCode)
+        else:
+            self.remapped = True
+            if self.nextResSeq.get(chainId, 1) > MAX_RESSEQ:
+                # The identifier is full, the chain continues in another one
+                chainId = self._newChainId()[0]
+            self.chainIds[chain] = (chainId, True)
+            pdbResidue = (chainId, self.nextResSeq.get(chainId, 1), ' ')
+        self.nextResSeq[chainId] = max(self.nextResSeq.get(chainId, 1), pdbResidue[1] + 1)
+        self.lastResidue, self.lastPdbResidue = (chain, resSeq, insCode), pdbResidue
+        return pdbResidue
+
+
+def convertCifToPdb(cifFile, pdbFile, mappingFile):
+    """ Writes the first model of a mmCIF file as a PDB file and the mapping table of its atoms into mappingFile.
+    Returns whether chain identifiers or residue numbers were remapped """
+    mapper, model, serial = _IdMapper(), None, 0
+    with open(pdbFile, 'w') as fPdb, open(mappingFile, 'w') as fMap:
+        for row in iterAtomSite(cifFile):
+            if serial == 0:
+                fMap.write('\t'.join(['pdbKey'] + list(row)) + '\n')
+            model = model or row.get('pdbx_PDB_model_num')
+            if row.get('pdbx_PDB_model_num') != model:
+                break
+            serial += 1
+            element = _value(row, 'type_symbol')
+            name = _formatAtomName(_value(row, 'auth_atom_id', 'label_atom_id'), element)
+            altLoc = _value(row, 'label_alt_id')[:1] or ' '
+            resName = _value(row, 'auth_comp_id', 'label_comp_id')[:3].rjust(3)
+            chainId, resSeq, insCode = mapper.getResidue(_value(row, 'auth_asym_id', 'label_asym_id'),
+                                                         _value(row, 'auth_seq_id', 'label_seq_id'),
+                                                         _value(row, 'pdbx_PDB_ins_code')[:1] or ' ')
+            pdbKey = '{}{}{} {}{:4d}{}'.format(name, altLoc, resName, chainId, resSeq, insCode)
+            fPdb.write('{:6s}{:5d} {}   {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}          {:>2s}\n'.format(
+                'HETATM' if row.get('group_PDB') == 'HETATM' else 'ATOM', serial % (MAX_SERIAL + 1), pdbKey,
+                float(row['Cartn_x']), float(row['Cartn_y']), float(row['Cartn_z']),
+                float(_value(row, 'occupancy') or 1.0), float(_value(row, 'B_iso_or_equiv') or 0.0), element[:2]))
+            fMap.write('\t'.join([pdbKey] + list(row.values())) + '\n')
+        fPdb.write('END\n')
+    return mapper.remapped
+
+
+def readMapping(mappingFile):
+    """ Returns the atom_site columns of the mapping table and a dict {pdbKey: original values, as written in mmCIF} """
+    with open(mappingFile) as f:
+        columns = f.readline().rstrip('\n').split('\t')[1:]
+        return columns, {values[0]: values[1:] for values in (line.rstrip('\n').split('\t') for line in f)}
+
+
+def getChainMapping(mappingFile):
+    """ Returns {original chain: PDB chain identifiers} of the mapping table """
+    chains = {}
+    with open(mappingFile) as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        chainColumn = columns.index('auth_asym_id' if 'auth_asym_id' in columns else 'label_asym_id')
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            chains.setdefault(_unquote(values[chainColumn]), set()).add(values[0][9])
+    return chains
+
+
+def getCifChains(cifFile):
+    """ Returns the chain identifiers of the atoms of a mmCIF file, in order of appearance """
+    return list(dict.fromkeys(_value(row, 'auth_asym_id', 'label_asym_id') for row in iterAtomSite(cifFile)))
+
+
+def writePdbAsCif(pdbFile, mappingFile, cifFile, dataName='imodfit'):
+    """ Writes the atoms of a PDB file converted by convertCifToPdb (e.g. a fitted model) as mmCIF, with the
+    original identifiers of the mapping table and the coordinates, occupancy and B-factor of the PDB file.
+    Every model of a multi-model file is written, numbered in pdbx_PDB_model_num and with consecutive atom ids """
+    from .trajectory import iterPdbModels
+    columns, mapping = readMapping(mappingFile)
+    pdbColumns = {'Cartn_x': (30, 38), 'Cartn_y': (38, 46), 'Cartn_z': (46, 54),
+                  'occupancy': (54, 60), 'B_iso_or_equiv': (60, 66)}
+    updated = [(columns.index(c), start, end) for c, (start, end) in pdbColumns.items() if c in columns]
+    idColumn = columns.index('id') if 'id' in columns else None
+    modelColumn = columns.index('pdbx_PDB_model_num') if 'pdbx_PDB_model_num' in columns else None
+    with open(cifFile, 'w') as f:
+        f.write('data_{}\n#\nloop_\n'.format(dataName))
+        f.writelines('_atom_site.{}\n'.format(column) for column in columns)
+        serial = 0
+        for modelNum, atomLines in enumerate(iterPdbModels(pdbFile), 1):
+            for line in atomLines:
+                serial += 1
+                values = list(mapping[line[12:27]])
+                for i, start, end in updated:
+                    values[i] = line[start:end].strip() or values[i]
+                if modelNum > 1:
+                    if idColumn is not None:
+                        values[idColumn] = str(serial)
+                    if modelColumn is not None:
+                        values[modelColumn] = str(modelNum)
+                f.write(' '.join(values) + '\n')
+        f.write('#\n')
@@ -0,0 +1,199 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Parsing and live monitoring of the iMODfit output.
+"""
+import os
+import re
+import time
+import threading
+
+from .constants import IMODFIT_ITER_REGEX
+from .trajectory import getIterationModel
+
+_iterRegex = re.compile(IMODFIT_ITER_REGEX)
+PROGRESS_HEADER = 'iteration,score,elapsed\n'
+
+
+def parseIterationLine(line):
+    """ Returns the (iteration, score) of an iMODfit iteration line, or None for any other line """
+    match = _iterRegex.match(line)
+    if match:
+        return int(match.group(1)), float(match.group(2))
+    return None
+
+
+def parseImodfitLog(logFile):
+    """ Returns the list of (iteration, score) reported in an iMODfit output file """
+    scores = []
+    if os.path.exists(logFile):
+        with open(logFile) as f:
+            for line in f:
+                parsed = parseIterationLine(line)
+                if parsed:
+                    scores.append(parsed)
+    return scores
+
+
+def getFinalScore(logFile):
+    """ Returns the last score reported in an iMODfit output file, or None """
+    scores = parseImodfitLog(logFile)
+    return scores[-1][1] if scores else None
+
+
+class ImodfitMonitor:
+    """ Follows the output file of a running iMODfit job from a background thread.
+    Each iteration line is parsed and appended to a csv progressFile (iteration, score, elapsed seconds),
+    which can be plotted while the job is still running. Optional callbacks are called with the
+    (iteration, score, elapsed) of each new line. After stopping, elapsed holds the running time (seconds).
+    A job resuming a fitting reports its iterations and elapsed times after startIteration and startElapsed,
+    continuing the rows of the progress file up to startIteration """
+    def __init__(self, logFile, progressFile, interval=2.0, callbacks=None, startIteration=0, startElapsed=0.0):
+        self.logFile = logFile
+        self.progressFile = progressFile
+        self.interval = interval
+        self.callbacks = callbacks or []
+        self.startIteration, self.startElapsed = startIteration, startElapsed
+        self.elapsed = None
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._startTime = None
+        self._pos = 0
+        self._partial = ''
+
+    def start(self):
+        self._startTime = time.time()
+        previousRows = [row for row in readProgress(self.progressFile) if row[0] <= self.startIteration] \
+            if self.startIteration else []
+        with open(self.progressFile, 'w') as f:
+            f.write(PROGRESS_HEADER)
+            f.writelines('{},{},{:.2f}\n'.format(*row) for row in previousRows)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops following the file, after processing its last lines """
+        self.elapsed = time.time() - self._startTime
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._readNewLines()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _run(self):
+        while not self._stopEvent.wait(self.interval):
+            self._readNewLines()
+
+    def _readNewLines(self):
+        if not os.path.exists(self.logFile):
+            return
+        with open(self.logFile) as f:
+            f.seek(self._pos)
+            data = f.read()
+            self._pos = f.tell()
+        if not data:
+            return
+
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        elapsed = self.startElapsed + time.time() - self._startTime
+        rows = []
+        for line in lines:
+            parsed = parseIterationLine(line)
+            if parsed:
+                rows.append((self.startIteration + parsed[0], parsed[1], elapsed))
+        if rows:
+            with open(self.progressFile, 'a') as f:
+                f.writelines('{},{},{:.2f}\n'.format(*row) for row in rows)
+            for row in rows:
+                for callback in self.callbacks:
+                    callback(*row)
+
+
+def readProgress(progressFile):
+    """ Returns the (iteration, score, elapsed) rows of a progress file """
+    rows = []
+    if os.path.exists(progressFile):
+        with open(progressFile) as f:
+            next(f, None)
+            for line in f:
+                fields = line.strip().split(',')
+                if len(fields) == 3:
+                    rows.append((int(fields[0]), float(fields[1]), float(fields[2])))
+    return rows
+
+
+class ConvergenceCheck:
+    """ Monitor callback that detects when the score has not improved more than threshold during the
+    last window iterations, calling onConverged once when it happens. Given the movieInterval of the run
+    (trajectory.getMovieInterval) and its startIteration, bestFrame is the number (1 based) of the model of
+    its movie written at the best iteration or the last one before it """
+    def __init__(self, threshold, window, onConverged=None, movieInterval=1, startIteration=0):
+        self.threshold = threshold
+        self.window = window
+        self.onConverged = onConverged
+        self.movieInterval = movieInterval
+        self.startIteration = startIteration
+        self.converged = False
+        self.bestScore, self.bestIteration = None, None
+        self.iteration, self.score = None, None
+
+    @property
+    def bestFrame(self):
+        if self.bestIteration is None:
+            return 0
+        return getIterationModel(self.bestIteration, self.movieInterval, self.startIteration)
+
+    def __call__(self, iteration, score, elapsed):
+        if self.converged:
+            return
+        self.iteration, self.score = iteration, score
+        if self.bestScore is None or score - self.bestScore > self.threshold:
+            self.bestScore, self.bestIteration = score, iteration
+        elif iteration - self.bestIteration >= self.window:
+            self.converged = True
+            if self.onConverged is not None:
+                self.onConverged()
+
+
+def terminateProgram(program, cwd):
+    """ Sends SIGTERM to the child processes of the current one running program in the cwd folder """
+    import psutil
+    cwd = os.path.realpath(cwd)
+    for child in psutil.Process().children(recursive=True):
+        try:
+            if any(os.path.basename(arg) == program for arg in child.cmdline()[:2]) \
+                    and os.path.realpath(child.cwd()) == cwd:
+                child.terminate()
+        except psutil.Error:
+            # Already finished
+            pass
@@ -0,0 +1,171 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Prediction of the running time and peak memory of iMODfit.
+
+Every iMODfit execution appends its input sizes, arguments, threads and measured usage to a calibration
+file shared by the runs of the user. The CPU time is modelled as linear in the work of each iteration
+(normal modes, contacts of the coarse-grained units and map correlation) and the peak memory as linear in
+the size of the Hessian, the number of units and the map voxels. The coefficients are fitted to the
+calibration records by non negative least squares or, with few records, the default ones are scaled to them.
+The wall time for a number of threads follows Amdahl's law with the serial fraction measured in the records.
+"""
+import os
+import re
+
+import numpy as np
+
+from .profiling import appendRecord, readRecords, MB
+
+# Coarse-grained units per residue of the models CA, 3BB2R and NCAC. The full atom model uses the atoms
+UNITS_PER_RESIDUE = {0: 1, 1: 5, 3: 3}
+FULL_ATOM = 2
+
+# Default coefficients, overridden by the calibration records: CPU seconds of the setup and per unit of
+# iteration work, and MB of the base process and per unit of size
+DEFAULT_TIME = np.array([1.0, 2e-8, 2e-7, 1e-8])
+DEFAULT_MEMORY = np.array([50.0, 2.4e-5, 1e-3, 1.2e-5])
+DEFAULT_SERIAL = 0.3
+
+
+def parseImodfitArgs(args):
+    """ Returns the maxIter, cgModel, modesRange and chiAngle of a list of iMODfit arguments """
+    options = dict(arg.split(' ', 1) for arg in map(str, args) if re.match(r'^-[imn] ', arg))
+    return {'maxIter': int(options.get('-i', 100)), 'cgModel': int(options.get('-m', FULL_ATOM)),
+            'modesRange': float(options.get('-n', 0.2)), 'chiAngle': '-x' in map(str, args)}
+
+
+def getFittingSize(nAtoms, nResidues, nVoxels, cgModel, modesRange, chiAngle=False):
+    """ Returns the number of coarse-grained units, dihedral degrees of freedom and modes of a fitting """
+    nUnits = nAtoms if cgModel == FULL_ATOM else UNITS_PER_RESIDUE.get(cgModel, 1) * nResidues
+    nDofs = (3 if chiAngle else 2) * nResidues
+    nModes = modesRange * nDofs if modesRange < 1 else min(modesRange, nDofs)
+    return {'nUnits': nUnits, 'nDofs': nDofs, 'nModes': nModes, 'nVoxels': nVoxels}
+
+
+def _timeFeatures(size, iterations):
+    return np.array([1.0, iterations * size['nDofs'] * size['nModes'], iterations * size['nUnits'],
+                     iterations * size['nVoxels']], dtype=float)
+
+
+def _memoryFeatures(size):
+    return np.array([1.0, size['nDofs'] ** 2, size['nUnits'], size['nVoxels']], dtype=float)
+
+
+def _fitCoefficients(features, values, defaults):
+    """ Non negative least squares coefficients, if there are twice as many records as coefficients.
+    Otherwise, the defaults scaled by the median ratio between the values and their predictions """
+    if len(values) >= 2 * len(defaults):
+        from scipy.optimize import nnls
+        scale = np.maximum(features.max(axis=0), 1e-12)
+        coefs, _ = nnls(features / scale, values)
+        if np.any(coefs):
+            return coefs / scale
+    if len(values):
+        return defaults * np.median(values / (features @ defaults))
+    return defaults
+
+
+class ResourceModel:
+    """ Predicts the CPU time, wall time and peak memory of iMODfit from the calibration records """
+    @classmethod
+    def fromFile(cls, calibrationFile):
+        return cls(readRecords(calibrationFile))
+
+    def __init__(self, records=()):
+        records = [r for r in records if r.get('cpuTime', 0) > 0 and r.get('iterations', 0) > 0]
+        self.nRecords = len(records)
+        sizes = [getFittingSize(r['nAtoms'], r['nResidues'], r['nVoxels'], r['cgModel'], r['modesRange'],
+                                r['chiAngle']) for r in records]
+        timeFeatures = np.array([_timeFeatures(s, r['iterations']) for s, r in zip(sizes, records)]).reshape(-1, 4)
+        memoryFeatures = np.array([_memoryFeatures(s) for s in sizes]).reshape(-1, 4)
+        self.timeCoefs = _fitCoefficients(timeFeatures, np.array([r['cpuTime'] for r in records]), DEFAULT_TIME)
+        self.memoryCoefs = _fitCoefficients(memoryFeatures, np.array([r['peakRssMB'] for r in records]),
+                                            DEFAULT_MEMORY)
+
+        # Amdahl: wall / cpu = s + (1 - s) / threads
+        serial = [(r['wallTime'] / r['cpuTime'] - 1 / r['threads']) / (1 - 1 / r['threads'])
+                  for r in records if r['threads'] > 1]
+        self.serialFraction = float(np.clip(np.median(serial), 0.02, 1.0)) if serial else DEFAULT_SERIAL
+
+    def predict(self, size, iterations, threads=1):
+        """ Returns the predicted cpuTime and wallTime (seconds) and peakMemoryMB of a fitting """
+        cpuTime = float(_timeFeatures(size, iterations) @ self.timeCoefs)
+        return {'cpuTime': cpuTime, 'wallTime': cpuTime * self.getWallFraction(threads),
+                'peakMemoryMB': float(_memoryFeatures(size) @ self.memoryCoefs)}
+
+    def getWallFraction(self, threads):
+        return self.serialFraction + (1 - self.serialFraction) / max(threads, 1)
+
+    def recommendThreads(self, maxThreads, minEfficiency=0.5):
+        """ Largest number of threads, up to maxThreads, whose parallel efficiency is at least minEfficiency """
+        threads = 1
+        while threads < maxThreads and 1 / ((threads + 1) * self.getWallFraction(threads + 1)) >= minEfficiency:
+            threads += 1
+        return threads
+
+
+def addCalibrationRecord(calibrationFile, inputSizes, args, iterations, threads, wallTime, usage):
+    """ Appends the measurements of an iMODfit execution to the calibration file """
+    record = {key: inputSizes[key] for key in ('nAtoms', 'nResidues', 'nVoxels')}
+    record.update(parseImodfitArgs(args))
+    record.update(iterations=iterations, threads=threads, wallTime=wallTime, cpuTime=usage['cpuTime'],
+                  peakRssMB=usage['peakRssMB'])
+    os.makedirs(os.path.dirname(os.path.abspath(calibrationFile)), exist_ok=True)
+    appendRecord(calibrationFile, record)
+
+
+def getStructureSizes(structFile):
+    """ Returns the number of atoms and residues of a pdb or mmCIF structure """
+    if structFile.endswith('.cif'):
+        from .mmcif import iterAtomSite
+        nAtoms, residues = 0, set()
+        for row in iterAtomSite(structFile):
+            nAtoms += 1
+            residues.add((row.get('auth_asym_id', row.get('label_asym_id')),
+                          row.get('auth_seq_id', row.get('label_seq_id')), row.get('pdbx_PDB_ins_code')))
+        return nAtoms, len(residues)
+    from .convert import readPdbAtoms
+    from .scoring import getResidues
+    atomLines = readPdbAtoms(structFile)
+    return len(atomLines), len(getResidues(atomLines)[0])
+
+
+def getNodeResources():
+    """ Returns the number of cores available to this process and the available memory of the node (MB) """
+    import psutil
+    return len(os.sched_getaffinity(0)), psutil.virtual_memory().available / MB
+
+
+def formatTime(seconds):
+    if seconds < 60:
+        return '{:.0f} s'.format(seconds)
+    if seconds < 3600:
+        return '{:.1f} min'.format(seconds / 60)
+    if seconds < 48 * 3600:
+        return '{:.1f} h'.format(seconds / 3600)
+    return '{:.1f} days'.format(seconds / 86400)
+
@@ -0,0 +1,183 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Profiling of the protocol steps.
+
+Each profiled step records its wall time and the CPU time of its thread. Programs run through this
+module as a script are measured when they finish: their CPU time and peak resident memory come from
+the resource usage returned by wait4, and their read and written bytes from /proc/self/io, which also
+accounts the I/O of the waited children. These figures are added to the record of the step running them,
+and the records are appended as JSON lines to a profile file.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import signal
+import resource
+import functools
+import threading
+import subprocess
+
+MB = 1024 ** 2
+_local = threading.local()
+
+
+class ResourceSampler:
+    """ Samples in a background thread the resident memory of this process and of its child processes,
+    keeping their peaks (bytes) """
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak, self.peakChildren = 0, 0
+        self._stopEvent = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        import psutil
+        process = psutil.Process()
+        self.peak = max(self.peak, process.memory_info().rss)
+        childrenMemory = 0
+        for child in process.children(recursive=True):
+            try:
+                childrenMemory += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peakChildren = max(self.peakChildren, childrenMemory)
+
+    def _run(self):
+        while not self._stopEvent.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopEvent.set()
+        self._thread.join()
+        self.sample()
+
+
+# --------------------------- STEPS ------------------------------
+def _threadCpuTime():
+    usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+    return usage.ru_utime + usage.ru_stime
+
+
+def addProfileInfo(**info):
+    """ Adds information to the record of the step running in the current thread, if any """
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record.update(info)
+
+
+def addChildUsage(usageFile):
+    """ Adds the usage of a program measured in usageFile to the record of the step running in the current
+    thread. The usages of several programs run by the same step are accumulated """
+    record = getattr(_local, 'record', None)
+    if record is None or not os.path.exists(usageFile):
+        return
+    with open(usageFile) as f:
+        usage = json.load(f)
+    record['childCpuTime'] += usage['cpuTime']
+    record['childPeakRssMB'] = max(record['childPeakRssMB'], usage['peakRssMB'])
+    record['childReadBytes'] += usage['readBytes']
+    record['childWriteBytes'] += usage['writeBytes']
+
+
+def profileStep(func):
+    """ Decorator of protocol step functions that appends their profile record to the file given by the
+    _getProfileFile method of the protocol """
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        record = {'step': func.__name__, 'args': list(args), 'start': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'childCpuTime': 0.0, 'childPeakRssMB': 0.0, 'childReadBytes': 0, 'childWriteBytes': 0}
+        t0, cpu0 = time.time(), _threadCpuTime()
+        _local.record = record
+        try:
+            return func(self, *args)
+        except Exception as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            _local.record = None
+            record.update(wallTime=time.time() - t0, cpuTime=_threadCpuTime() - cpu0)
+            appendRecord(self._getProfileFile(), record)
+    return wrapper
+
+
+def appendRecord(profileFile, record):
+    """ Appends a record as a JSON line, locking the file for the concurrent steps """
+    with open(profileFile, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(record) + '\n')
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def readRecords(profileFile):
+    records = []
+    if os.path.exists(profileFile):
+        with open(profileFile) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+# --------------------------- PROGRAMS ------------------------------
+def getUsageCommand(usageFile, program):
+    """ Returns the command line that runs program measuring its usage into usageFile """
+    return '"%s" "%s" "%s" %s' % (sys.executable, os.path.abspath(__file__), os.path.abspath(usageFile), program)
+
+
+def _readIo():
+    with open('/proc/self/io') as f:
+        return dict((key, int(value)) for key, value in (line.split(': ') for line in f))
+
+
+def main(argv=None):
+    """ Runs a program and writes its usage in a JSON file: profiling.py usageFile program [args...]
+    Exits with the exit code of the program """
+    usageFile, *command = argv if argv is not None else sys.argv[1:]
+    io0 = _readIo()
+    process = subprocess.Popen(command)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: process.send_signal(signum))
+    _, status, usage = os.wait4(process.pid, 0)
+    io1 = _readIo()
+
+    with open(usageFile, 'w') as f:
+        json.dump({'cpuTime': usage.ru_utime + usage.ru_stime, 'peakRssMB': usage.ru_maxrss / 1024,
+                   'readBytes': io1['rchar'] - io0['rchar'], 'writeBytes': io1['wchar'] - io0['wchar']}, f)
+    # Killed by a signal as a shell does, 128 + signal
+    exitCode = os.waitstatus_to_exitcode(status)
+    return exitCode if exitCode >= 0 else 128 - exitCode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,6 @@
 # -*- coding: utf-8 -*-
-from .protocol_flexible_fitting import imodfitFlexFitting
\ No newline at end of file
+from .protocol_flexible_fitting import imodfitFlexFitting
+from .protocol_batch_fitting import imodfitBatchFlexFitting
+from .protocol_sweep_fitting import imodfitSweepFlexFitting
+from .protocol_domain_fitting import imodfitDomainFlexFitting
+from .protocol_ensemble_fitting import imodfitEnsembleFlexFitting
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This protocol performs the iMODfit flexible fitting of several structures over several maps in a single run.
+Each structure-map pair is converted and fitted in its own steps, which are executed in parallel.
+"""
+import os
+import numpy as np
+
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.object import Set
+from pwem.objects.data import SetOfAtomStructs
+from pyworkflow.utils import Message
+import pyworkflow.utils as pwutils
+
+from imodfit.profiling import profileStep
+from .protocol_flexible_fitting import imodfitFlexFitting
+
+ALL_PAIRS, ORDERED_PAIRS = 0, 1
+
+
+class imodfitBatchFlexFitting(imodfitFlexFitting):
+    """
+    Performs the flexible fitting of a set of protein structures to a set of maps.
+    Each structure-map pair is fitted independently and the fittings run in parallel,
+    as many at the same time as Scipion threads minus one.
+    A rigid fitting for ensuring their prior best positions is needed before performing this flexible fitting.
+    """
+    _label = 'Batch flexible fitting'
+    stepsExecutionMode = STEPS_PARALLEL
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputVolumes', params.PointerParam,
+                      pointerClass='SetOfVolumes,Volume', allowsNull=False,
+                      label="Input volumes",
+                      help='Target EM maps')
+
+        form.addParam('inputAtomStructs', params.PointerParam,
+                      pointerClass='SetOfAtomStructs,AtomStruct', allowsNull=False,
+                      label="Input atom structures",
+                      help='Select the atom structures to be fitted in the volumes')
+
+        form.addParam('pairing', params.EnumParam,
+                      choices=['All combinations', 'Paired in order'], default=ALL_PAIRS,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Structure-map pairs',
+                      help='*All combinations*: every structure is fitted into every map.\n'
+                           '*Paired in order*: the i-th structure is fitted into the i-th map. '
+                           'Both sets must have the same size.')
+
+        self._defineFittingParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+        form.addParam('fitThreads', params.IntParam,
+                      default=1, label='Threads per fitting',
+                      help='MKL threads of each iMODfit execution. The number of fittings running at the '
+                           'same time is given by the number of threads minus one.')
+
+    # --------------------------- UTILS functions ------------------------------
+    def _getInputItems(self, pointer):
+        """ Returns the list of items of the pointed object, which can be a set or a single object """
+        inpObj = pointer.get()
+        if isinstance(inpObj, Set):
+            return [item.clone() for item in inpObj]
+        return [inpObj]
+
+    def _getInputPairs(self):
+        """ Returns the list of (volume, atomStruct) pairs to be fitted """
+        volumes = self._getInputItems(self.inputVolumes)
+        structs = self._getInputItems(self.inputAtomStructs)
+        if self.pairing.get() == ORDERED_PAIRS:
+            return list(zip(volumes, structs))
+        return [(vol, struct) for vol in volumes for struct in structs]
+
+    def _getPairPath(self, pairId, *paths):
+        return self._getExtraPath('pair_%03d' % pairId, *paths)
+
+    def _getFitThreads(self):
+        return self.fitThreads.get()
+
+    def _getPredictionInputs(self):
+        return [(inpStruct.getFileName(), int(np.prod(inpVol.getDim()))) for inpVol, inpStruct in self._getInputPairs()]
+
+    def _getProgressFiles(self):
+        return [('Pair %d' % pairId, self._getProgressFile(self._getPairPath(pairId)))
+                for pairId in range(1, len(self._getInputPairs()) + 1)]
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        fitSteps = []
+        for pairId, (inpVol, inpStruct) in enumerate(self._getInputPairs(), 1):
+            origin = list(inpVol.getOrigin(force=True).getShifts())
+            convId = self._insertFunctionStep('convertPairStep', pairId, inpVol.getFileName(),
+                                              inpVol.getSamplingRate(), origin, inpStruct.getFileName(),
+                                              prerequisites=[])
+            fitId = self._insertFunctionStep('imodfitPairStep', pairId, inpVol.getFileName(),
+                                             inpStruct.getFileName(), prerequisites=[convId])
+            fitSteps.append(fitId)
+        self._insertFunctionStep('createOutputStep', prerequisites=fitSteps)
+
+    @profileStep
+    def convertPairStep(self, pairId, volFile, sampling, origin, structFile):
+        workDir = self._getPairPath(pairId)
+        pwutils.makePath(workDir)
+        self._convertInputs(volFile, sampling, origin, structFile, workDir)
+
+    @profileStep
+    def imodfitPairStep(self, pairId, volFile, structFile):
+        workDir = self._getPairPath(pairId)
+        pdbFile, ccp4File = self._getInputPdbFile(structFile, workDir), self._getInputCcp4File(volFile, workDir)
+        self._runResumable(pdbFile, ccp4File, workDir, earlyStop=self.earlyStop.get(), cutoff=self._getCutoff(workDir))
+        self._scoreFitting(workDir, ccp4File, pdbFile)
+        if self._compactsMovie():
+            self._compactMovie(workDir)
+        if self.outputMovie.get() and self.movieAnalysis.get():
+            self._analyseMovie(workDir)
+
+    @profileStep
+    def createOutputStep(self):
+        fittedSet = SetOfAtomStructs.create(self._getPath(), suffix='fitted')
+        movieSet = SetOfAtomStructs.create(self._getPath(), suffix='movie')
+        for pairId, (inpVol, inpStruct) in enumerate(self._getInputPairs(), 1):
+            workDir = self._getPairPath(pairId)
+            fittedPDB = self._getFittedAtomStruct(workDir, self._getMappingFile(inpStruct.getFileName(), workDir))
+            fittedPDB.setVolume(inpVol)
+            fittedSet.append(fittedPDB)
+
+            moviePDB = self._getMovieAtomStruct(workDir)
+            if os.path.exists(moviePDB.getFileName()):
+                moviePDB.setVolume(inpVol)
+                movieSet.append(moviePDB)
+
+        fittedSet.write()
+        movieSet.write()
+        self._defineOutputs(fittedAtomStructs=fittedSet)
+        if movieSet.getSize() > 0:
+            self._defineOutputs(movieAtomStructs=movieSet)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = super()._validate()
+        if self.multiStage.get():
+            errors.append('The multi-stage fitting is not available in the batch fitting')
+        if self.pairing.get() == ORDERED_PAIRS:
+            nVols = len(self._getInputItems(self.inputVolumes))
+            nStructs = len(self._getInputItems(self.inputAtomStructs))
+            if nVols != nStructs:
+                errors.append('The number of volumes ({}) and atom structures ({}) must be the same '
+                              'when they are paired in order'.format(nVols, nStructs))
+        return errors
+
+    def _summary(self):
+        summary = []
+        if self.isFinished():
+            pairs = self._getInputPairs()
+            summary.append('{} structure-map pairs fitted'.format(len(pairs)))
+            for pairId in range(1, len(pairs) + 1):
+                scoresLine = self._getScoresSummary(self._getPairPath(pairId))
+                if scoresLine:
+                    summary.append('Pair {}: {}'.format(pairId, scoresLine))
+            summary += self._getProfileSummary()
+        return summary
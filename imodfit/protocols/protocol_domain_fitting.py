@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This protocol performs the iMODfit flexible fitting of a large assembly split into domains.
+Each domain (a chain or a group of chains) is fitted on its own into the map region around it, in parallel,
+and the fitted domains are merged and refined with a short fitting of the whole structure.
+"""
+import os
+import json
+import time
+
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.utils import Message
+import pyworkflow.utils as pwutils
+
+from imodfit.convert import readMapHeader, readPdbAtoms, getBoxAroundCoords, cropMap, getChains, selectChains, \
+    updateCoordinates
+from imodfit.trajectory import linesToCoords, writeTopology
+from imodfit.checkpoint import readCheckpoint
+from imodfit.mmcif import getChainMapping, getCifChains
+from imodfit.profiling import profileStep
+from .protocol_flexible_fitting import imodfitFlexFitting
+
+DOMAINS_CHAINS, DOMAINS_GROUPS = 0, 1
+
+
+class imodfitDomainFlexFitting(imodfitFlexFitting):
+    """
+    Performs the flexible fitting of a large protein assembly to a map by domains.
+    The structure is split by chain or into groups of chains, and each domain is fitted independently into
+    the map cropped around it. These fittings run in parallel, as many at the same time as Scipion threads
+    minus one, and are much cheaper than fitting the whole assembly, as the size of the normal modes problem
+    grows with the number of atoms. The fitted domains are then merged and refined with a short fitting of
+    the whole structure into the whole map.
+    A rigid fitting for ensuring their prior best positions is needed before performing this flexible fitting.
+    """
+    _label = 'Domain flexible fitting'
+    stepsExecutionMode = STEPS_PARALLEL
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputVolume', params.PointerParam,
+                      pointerClass='Volume', allowsNull=False,
+                      label="Input volume",
+                      help='Target EM map')
+        form.addParam('inputAtomStruct', params.PointerParam,
+                      pointerClass='AtomStruct', allowsNull=False,
+                      label="Input atom structure",
+                      help='Select the atom structure to be fitted in the volume')
+
+        form.addSection(label='Domains')
+        form.addParam('domainMode', params.EnumParam,
+                      choices=['By chain', 'Groups of chains'], default=DOMAINS_CHAINS,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Domains',
+                      help='*By chain*: each chain is fitted on its own.\n'
+                           '*Groups of chains*: each group given below is fitted on its own.')
+        form.addParam('domainGroups', params.TextParam, default='',
+                      condition='domainMode==%d' % DOMAINS_GROUPS,
+                      label='Groups of chains',
+                      help='One line per domain with its chain identifiers separated by spaces, e.g.:\n'
+                           'A B\nC\n'
+                           'Chains not in any group are not fitted locally, but they are included in the '
+                           'global refinement. For mmCIF structures, the chain identifiers of the file '
+                           '(auth_asym_id) are used.')
+        form.addParam('domainMargin', params.FloatParam, default=2.0,
+                      label='Map margin (resolution units)',
+                      help='Each domain is fitted into the map cropped to its bounding box plus this margin, '
+                           'in units of the resolution')
+        form.addParam('refineIter', params.IntParam, default=500,
+                      label='Global refinement iterations',
+                      help='Iterations of the final fitting of the merged structure into the whole map. '
+                           'The maximum iterations of the Parameters tab are used for each domain.')
+
+        self._defineFittingParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+        form.addParam('fitThreads', params.IntParam,
+                      default=1, label='Threads per domain fitting',
+                      help='MKL threads of each domain fitting. The number of domains fitted at the same time '
+                           'is given by the number of threads minus one. The global refinement uses all the '
+                           'threads.')
+
+    # --------------------------- UTILS functions ------------------------------
+    def _getFitThreads(self):
+        return self.fitThreads.get()
+
+    def _parseDomainGroups(self):
+        """ Returns the list of chain groups given in the form """
+        return [line.split() for line in self.domainGroups.get().splitlines()
+                if line.strip() and not line.strip().startswith('#')]
+
+    def _getDomainGroups(self):
+        """ Returns the list of domains, each one as a list of chain identifiers of the input structure. Only the
+        input file is read, so that the domains can be counted before converting it """
+        if self.domainMode.get() == DOMAINS_GROUPS:
+            return self._parseDomainGroups()
+        inputFile = self.inputAtomStruct.get().getFileName()
+        chains = getCifChains(inputFile) if inputFile.endswith('.cif') else getChains(readPdbAtoms(inputFile))
+        return [[chain] for chain in chains]
+
+    def _getDomainsFile(self):
+        """ Json file with the chains of each domain in the converted pdb, written with the inputs """
+        return self._getExtraPath('domains.json')
+
+    def _getDomains(self):
+        """ Returns the list of domains, each one as a list of chain identifiers of the input pdb """
+        with open(self._getDomainsFile()) as f:
+            return json.load(f)
+
+    def _getNumberOfDomains(self):
+        if os.path.exists(self._getDomainsFile()):
+            return len(self._getDomains())
+        return len(self._getDomainGroups())
+
+    def _getDomainPath(self, domainId, *paths):
+        return self._getExtraPath('domain_%03d' % domainId, *paths)
+
+    def _getDomainFile(self, domainId):
+        """ Json file with the chains, size and fitting time of a domain """
+        return self._getDomainPath(domainId, 'domain.json')
+
+    def _readDomains(self):
+        records = []
+        for domainId in range(1, self._getNumberOfDomains() + 1):
+            if os.path.exists(self._getDomainFile(domainId)):
+                with open(self._getDomainFile(domainId)) as f:
+                    records.append(json.load(f))
+        return records
+
+    def _getMergedFile(self):
+        return self._getOutputFile('merged')
+
+    def _getProgressFiles(self):
+        progressFiles = [('Domain %d' % domainId, self._getProgressFile(self._getDomainPath(domainId)))
+                         for domainId in range(1, self._getNumberOfDomains() + 1)]
+        return progressFiles + [('Refinement', self._getProgressFile())]
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        convId = self._insertFunctionStep('convertInputStep', prerequisites=[])
+        domainSteps = [self._insertFunctionStep('fitDomainStep', domainId, prerequisites=[convId])
+                       for domainId in range(1, self._getNumberOfDomains() + 1)]
+        mergeId = self._insertFunctionStep('mergeDomainsStep', prerequisites=domainSteps)
+
+        # As in the flexible fitting, the refinement iterations are an argument of the following steps
+        refineIter = self.refineIter.get()
+        prevId = self._insertFunctionStep('refineStep', refineIter, prerequisites=[mergeId])
+        if self._compactsMovie():
+            prevId = self._insertFunctionStep('convertMovieStep', refineIter, prerequisites=[prevId])
+        prevId = self._insertFunctionStep('scoreStep', refineIter, prerequisites=[prevId])
+        self._insertFunctionStep('createOutputStep', refineIter, prerequisites=[prevId])
+
+    def _convertInputs(self, volFile, sampling, origin, structFile, workDir):
+        """ Converts the inputs and writes the domains file, with the chains of the groups of a mmCIF input
+        translated to their pdb identifiers """
+        inputFiles = super()._convertInputs(volFile, sampling, origin, structFile, workDir)
+        domains = self._getDomainGroups()
+        mappingFile = self._getMappingFile(structFile, workDir)
+        if os.path.exists(mappingFile):
+            chainMapping = getChainMapping(mappingFile)
+            domains = [sorted(set().union(*[chainMapping.get(chain, set()) for chain in group]))
+                       for group in domains]
+        with open(self._getDomainsFile(), 'w') as f:
+            json.dump(domains, f, indent=2)
+        return inputFiles
+
+    @profileStep
+    def fitDomainStep(self, domainId):
+        """ Fits the atoms of a domain into the map cropped around them """
+        chains = self._getDomains()[domainId - 1]
+        workDir = self._getDomainPath(domainId)
+        pwutils.makePath(workDir)
+        domainPdb = os.path.abspath(os.path.join(workDir, 'domain.pdb'))
+        atomLines = selectChains(readPdbAtoms(self._getInputPdbFile()), chains)
+        writeTopology(atomLines, domainPdb)
+
+        ccp4File = self._getInputCcp4File()
+        domainMap = os.path.join(workDir, os.path.basename(ccp4File))
+        header = readMapHeader(ccp4File)
+        start, end = getBoxAroundCoords(linesToCoords(atomLines), header,
+                                        self.domainMargin.get() * self.resolution.get())
+        cropMap(ccp4File, domainMap, start, end)
+
+        # Full-atom models are needed for merging. The domain movies are not used
+        t0 = time.time()
+        self._runResumable(domainPdb, domainMap, workDir, cutoff=self._getCutoff(),
+                           fullAtom=True, outputMovie=False)
+        record = {'domain': domainId, 'chains': chains, 'nAtoms': len(atomLines),
+                  'mapDims': [int(e - s) for s, e in zip(start, end)], 'start': t0, 'end': time.time(),
+                  'time': readCheckpoint(self._getCheckpointFile(workDir))['elapsed']}
+        with open(self._getDomainFile(domainId), 'w') as f:
+            json.dump(record, f, indent=2)
+
+    @profileStep
+    def mergeDomainsStep(self):
+        """ Writes the input structure with the coordinates of the fitted domains """
+        atomLines = readPdbAtoms(self._getInputPdbFile())
+        for domainId in range(1, self._getNumberOfDomains() + 1):
+            fittedLines = readPdbAtoms(self._getOutputFile('fitted', self._getDomainPath(domainId)))
+            atomLines = updateCoordinates(atomLines, fittedLines)
+        writeTopology(atomLines, self._getMergedFile())
+
+    @profileStep
+    def refineStep(self, refineIter):
+        """ Refines the merged structure with a short fitting into the whole map, using all the threads """
+        self._runResumable(os.path.abspath(self._getMergedFile()), self._getInputCcp4File(), self._getExtraPath(),
+                           earlyStop=self.earlyStop.get(), numberOfThreads=self.numberOfThreads.get(),
+                           maxIter=refineIter)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = super()._validate()
+        if self.multiStage.get():
+            errors.append('The multi-stage fitting is not available in the domain fitting')
+        if self.refineIter.get() < 1:
+            errors.append('The global refinement needs at least 1 iteration')
+        if self.domainMode.get() == DOMAINS_GROUPS:
+            chains = [chain for group in self._parseDomainGroups() for chain in group]
+            if not chains:
+                errors.append('No groups of chains given')
+            elif len(chains) != len(set(chains)):
+                errors.append('Each chain can only be in one group')
+            elif not self.inputAtomStruct.get().getFileName().endswith('.cif') and \
+                    any(len(chain) != 1 for chain in chains):
+                errors.append('Chain identifiers must be single characters')
+            else:
+                inputFile = self.inputAtomStruct.get().getFileName()
+                inputChains = getCifChains(inputFile) if inputFile.endswith('.cif') \
+                    else getChains(readPdbAtoms(inputFile))
+                missing = [chain for chain in chains if chain not in inputChains]
+                if missing:
+                    errors.append('Chains not found in the input structure: {}'.format(' '.join(missing)))
+        return errors
+
+    def _summary(self):
+        summary = []
+        records = self._readDomains()
+        for record in records:
+            summary.append('Domain {} (chains {}): {} atoms, map {}, fitted in {:.1f} s'.format(
+                record['domain'], ' '.join(record['chains']), record['nAtoms'],
+                'x'.join(map(str, record['mapDims'])), record['time']))
+        if records:
+            wallTime = max(r['end'] for r in records) - min(r['start'] for r in records)
+            fitTime = sum(r['time'] for r in records)
+            summary.append('Domain fittings: {:.1f} s in total, {:.1f} s of wall time ({:.1f}x parallel speedup)'
+                           .format(fitTime, wallTime, fitTime / wallTime if wallTime > 0 else 1.0))
+        refinement = readCheckpoint(self._getCheckpointFile())
+        if refinement is not None:
+            summary.append('Global refinement: {} iterations in {:.1f} s'.format(
+                refinement['iteration'], refinement['elapsed']))
+        scoresLine = self._getScoresSummary()
+        if scoresLine:
+            summary.append(scoresLine)
+        summary += self._getProfileSummary()
+        return summary
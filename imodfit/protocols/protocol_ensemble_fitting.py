@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This protocol performs the iMODfit flexible fitting of a structure into a set of related maps, such as 3D classes,
+starting each fitting from the fitted structure of the most similar map already fitted.
+"""
+import os
+import json
+import numpy as np
+
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.object import Integer, Float
+from pwem.objects.data import SetOfAtomStructs
+from pyworkflow.utils import Message
+import pyworkflow.utils as pwutils
+
+from imodfit.ensemble import mapSimilarities, getWarmStartTree
+from imodfit.checkpoint import readCheckpoint
+from imodfit.profiling import profileStep
+from .protocol_flexible_fitting import imodfitFlexFitting
+
+
+class imodfitEnsembleFlexFitting(imodfitFlexFitting):
+    """
+    Performs the flexible fitting of a protein structure into each map of a set of related maps, e.g. the 3D
+    classes of a heterogeneity analysis. The maps are ordered by the correlation of their downsampled copies:
+    the map most similar to all the others is fitted first from the input structure, and each of the other maps
+    is fitted starting from the fitted structure of its most similar map among the ones fitted before, with
+    the (usually much lower) warm start iterations. Fittings of independent branches run in parallel, as many
+    at the same time as Scipion threads minus one.
+    A rigid fitting for ensuring their prior best positions is needed before performing this flexible fitting.
+    """
+    _label = 'Ensemble flexible fitting'
+    stepsExecutionMode = STEPS_PARALLEL
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputVolumes', params.PointerParam,
+                      pointerClass='SetOfVolumes', allowsNull=False,
+                      label="Input volumes",
+                      help='Related target EM maps, with the same box size and sampling rate')
+        form.addParam('inputAtomStruct', params.PointerParam,
+                      pointerClass='AtomStruct', allowsNull=False,
+                      label="Input atom structure",
+                      help='Select the atom structure to be fitted in the volumes')
+
+        form.addSection(label='Ensemble')
+        form.addParam('warmIter', params.IntParam, default=2000,
+                      label='Warm start iterations',
+                      help='Maximum iterations of the fittings starting from the fitted structure of another map. '
+                           'The maximum iterations of the Parameters tab are used for the first map, which is '
+                           'fitted from the input structure.')
+        form.addParam('similaritySize', params.IntParam, default=32,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Downsampled size (voxels)',
+                      help='The maps are compared after averaging blocks of voxels down to about this size')
+
+        self._defineFittingParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+        form.addParam('fitThreads', params.IntParam,
+                      default=1, label='Threads per fitting',
+                      help='MKL threads of each iMODfit execution. The number of fittings running at the '
+                           'same time is given by the number of threads minus one.')
+
+    # --------------------------- UTILS functions ------------------------------
+    def _getInputVolumes(self):
+        return [vol.clone() for vol in self.inputVolumes.get()]
+
+    def _getMapPath(self, mapId, *paths):
+        return self._getExtraPath('map_%03d' % mapId, *paths)
+
+    def _getFitThreads(self):
+        return self.fitThreads.get()
+
+    def _getTreeFile(self):
+        return self._getExtraPath('ensemble_tree.json')
+
+    def _getWarmStartTree(self):
+        """ Returns the (order, parents) of the maps, with 1-based map ids. The tree is computed when the protocol
+        is launched, as the steps depend on it, and saved to be kept if the protocol is continued """
+        if not os.path.exists(self._getTreeFile()):
+            similarities = mapSimilarities([vol.getFileName() for vol in self._getInputVolumes()],
+                                           self.similaritySize.get())
+            order, parents = getWarmStartTree(similarities)
+            tree = {'order': [i + 1 for i in order],
+                    'parents': [None if p is None else p + 1 for p in parents],
+                    'similarities': similarities.tolist()}
+            pwutils.makePath(self._getExtraPath())
+            with open(self._getTreeFile(), 'w') as f:
+                json.dump(tree, f, indent=2)
+        with open(self._getTreeFile()) as f:
+            tree = json.load(f)
+        return tree['order'], tree['parents']
+
+    def _getMapRecordFile(self, mapId):
+        return self._getMapPath(mapId, 'ensemble.json')
+
+    def _readMapRecords(self):
+        records = []
+        for mapId in range(1, len(self._getInputVolumes()) + 1):
+            if os.path.exists(self._getMapRecordFile(mapId)):
+                with open(self._getMapRecordFile(mapId)) as f:
+                    records.append(json.load(f))
+        return records
+
+    def _getPredictionInputs(self):
+        nVoxels = max(int(np.prod(vol.getDim())) for vol in self._getInputVolumes())
+        return [(self.inputAtomStruct.get().getFileName(), nVoxels)]
+
+    def _getProgressFiles(self):
+        return [('Map %d' % mapId, self._getProgressFile(self._getMapPath(mapId)))
+                for mapId in range(1, len(self._getInputVolumes()) + 1)]
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        volumes = self._getInputVolumes()
+        order, parents = self._getWarmStartTree()
+        fitSteps = {}
+        for mapId in order:
+            inpVol = volumes[mapId - 1]
+            origin = list(inpVol.getOrigin(force=True).getShifts())
+            convId = self._insertFunctionStep('convertMapStep', mapId, inpVol.getFileName(),
+                                              inpVol.getSamplingRate(), origin, prerequisites=[])
+            parentId = parents[mapId - 1]
+            prerequisites = [convId] if parentId is None else [convId, fitSteps[parentId]]
+            fitSteps[mapId] = self._insertFunctionStep('fitMapStep', mapId, inpVol.getFileName(), parentId,
+                                                       prerequisites=prerequisites)
+        self._insertFunctionStep('createOutputStep', prerequisites=list(fitSteps.values()))
+
+    @profileStep
+    def convertMapStep(self, mapId, volFile, sampling, origin):
+        workDir = self._getMapPath(mapId)
+        pwutils.makePath(workDir)
+        self._convertInputs(volFile, sampling, origin, self.inputAtomStruct.get().getFileName(), workDir)
+
+    @profileStep
+    def fitMapStep(self, mapId, volFile, parentId):
+        """ Fits the map from the input structure or, if it has a parent, from the fitted structure of the parent """
+        workDir = self._getMapPath(mapId)
+        ccp4File = self._getInputCcp4File(volFile, workDir)
+        if parentId is None:
+            pdbFile, maxIter = self._getInputPdbFile(workDir=workDir), self.maxIter.get()
+        else:
+            pdbFile, maxIter = os.path.abspath(self._getOutputFile('fitted', self._getMapPath(parentId))), \
+                               self.warmIter.get()
+        # The fitted structures that start other fittings are written in full-atom
+        fullAtom = self.fullAtom.get() or mapId in self._getWarmStartTree()[1]
+        self._runResumable(pdbFile, ccp4File, workDir, earlyStop=self.earlyStop.get(),
+                           cutoff=self._getCutoff(workDir), maxIter=maxIter, fullAtom=fullAtom)
+        scores = self._scoreFitting(workDir, ccp4File, self._getInputPdbFile(workDir=workDir))
+        if self._compactsMovie():
+            self._compactMovie(workDir)
+
+        checkpoint = readCheckpoint(self._getCheckpointFile(workDir))
+        record = {'map': mapId, 'parent': parentId, 'iterations': checkpoint['iteration'],
+                  'time': checkpoint['elapsed'], 'cc': scores['fitted']['cc']}
+        with open(self._getMapRecordFile(mapId), 'w') as f:
+            json.dump(record, f, indent=2)
+
+    @profileStep
+    def createOutputStep(self):
+        fittedSet = SetOfAtomStructs.create(self._getPath(), suffix='fitted')
+        movieSet = SetOfAtomStructs.create(self._getPath(), suffix='movie')
+        records = {record['map']: record for record in self._readMapRecords()}
+        for mapId, inpVol in enumerate(self._getInputVolumes(), 1):
+            workDir = self._getMapPath(mapId)
+            fittedPDB = self._getFittedAtomStruct(workDir, self._getMappingFile(workDir=workDir))
+            fittedPDB.setVolume(inpVol)
+            fittedPDB._imodfitIterations = Integer(records[mapId]['iterations'])
+            fittedPDB._imodfitTime = Float(records[mapId]['time'])
+            fittedSet.append(fittedPDB)
+
+            moviePDB = self._getMovieAtomStruct(workDir)
+            if os.path.exists(moviePDB.getFileName()):
+                moviePDB.setVolume(inpVol)
+                movieSet.append(moviePDB)
+
+        fittedSet.write()
+        movieSet.write()
+        self._defineOutputs(fittedAtomStructs=fittedSet)
+        if movieSet.getSize() > 0:
+            self._defineOutputs(movieAtomStructs=movieSet)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = super()._validate()
+        if self.multiStage.get():
+            errors.append('The multi-stage fitting is not available in the ensemble fitting')
+        volumes = self._getInputVolumes()
+        if len({vol.getDim() for vol in volumes}) > 1:
+            errors.append('All the volumes must have the same box size to be compared')
+        return errors
+
+    def _summary(self):
+        summary = []
+        records = self._readMapRecords()
+        for record in sorted(records, key=lambda r: r['map']):
+            start = 'input structure' if record['parent'] is None else 'map {}'.format(record['parent'])
+            summary.append('Map {} (from {}): {} iterations in {:.1f} s, correlation {:.4f}'.format(
+                record['map'], start, record['iterations'], record['time'], record['cc']))
+        warmRecords = [r for r in records if r['parent'] is not None]
+        if warmRecords and len(warmRecords) < len(records):
+            coldRecord = [r for r in records if r['parent'] is None][0]
+            summary.append('Warm started fittings: {:.0f} iterations and {:.1f} s on average, vs {} iterations '
+                           'and {:.1f} s from the input structure'.format(
+                               sum(r['iterations'] for r in warmRecords) / len(warmRecords),
+                               sum(r['time'] for r in warmRecords) / len(warmRecords),
+                               coldRecord['iterations'], coldRecord['time']))
+        summary += self._getProfileSummary()
+        return summary
@@ -31,15 +31,32 @@ This protocol is used to perform a flexible fitting of a protein structure over
 A rigid fitting for ensuring their prior best positions is needed before performing this flexible fitting.
 """
 from pyworkflow.protocol import Protocol, params
+from pyworkflow.object import String, Float
 from pwem.objects.data import AtomStruct
-from pwem.emlib.image import ImageHandler
-from pwem.convert.atom_struct import toPdb
 from pyworkflow.utils import Message
 import pyworkflow.utils as pwutils
-import os, shutil
+import os, shutil, json, subprocess
+import numpy as np
 from imodfit import Plugin
+from imodfit.convert import readMapHeader, readPdbAtoms, readPdbCoordinates, getBoxAroundCoords, cropMap, binMap, \
+  mapHistogram, isCompatibleMap, convertSpiderToCcp4, selectChains, SPIDER_EXTENSIONS
+from imodfit.mmcif import convertCifToPdb, writePdbAsCif
+from imodfit.symmetry import getSymmetryMatrices, findAsymUnit, expandAsymUnit
+from imodfit.threshold import noiseThreshold, volumeThreshold, getExpectedVolume
+from imodfit.monitor import getFinalScore, readProgress, ImodfitMonitor, ConvergenceCheck, terminateProgram
+from imodfit.trajectory import convertMovieToDcd, convertDcdToMovie, decimateMovie, truncateMovie, writeTopology, \
+  getMovieInterval, iterPdbModels
+from imodfit.checkpoint import Checkpointer, readCheckpoint, saveCheckpoint, archivePart, stitchMovie
+from imodfit.profiling import profileStep, addProfileInfo, addChildUsage, readRecords, MB
+from imodfit.analysis import analyseMovie, writeAnalysis, readFrameAnalysis, saveFramePlot
+from imodfit.prediction import getFittingSize, getStructureSizes, getNodeResources, addCalibrationRecord, \
+  formatTime, parseImodfitArgs
+from imodfit.scoring import scoreModel, scoreResidues, getResidues, writeResidueAttributes, writeResidueBfactors
 
-from pwem.convert import Ccp4Header
+
+
+CUTOFF_MANUAL, CUTOFF_NOISE, CUTOFF_VOLUME = 0, 1, 2
+FRAMES_ALL, FRAMES_EVERY, FRAMES_KEYFRAMES = 0, 1, 2
 
 
 class imodfitFlexFitting(Protocol):
@@ -53,8 +70,6 @@ class imodfitFlexFitting(Protocol):
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
         """ """
-        cgChoices = self._get_cgChoices()
-
         form.addSection(label=Message.LABEL_INPUT)
         form.addParam('inputVolume', params.PointerParam,
                       pointerClass='Volume', allowsNull=False,
@@ -66,20 +81,85 @@ class imodfitFlexFitting(Protocol):
                        label="Input atom structure",
                        help='Select the atom structure to be fitted in the volume')
 
+        group = form.addGroup('Symmetry')
+        group.addParam('symmetryGroup', params.StringParam,
+                       default='C1',
+                       label='Point group symmetry',
+                       help='Symmetry of the assembly: C1 (no symmetry), Cn, Dn, T, O, I1 or I2 (icosahedral 222 '
+                            'orientations, I is I1), with the Scipion conventions. With a symmetry, only one '
+                            'asymmetric unit of the structure is fitted, into the map cropped around it, and the '
+                            'fitted assembly is rebuilt applying the symmetry operators. The input can be the whole '
+                            'assembly, whose chains are matched to their symmetry copies, or a single asymmetric unit.')
+        group.addParam('symmetryCentre', params.StringParam,
+                       default='', condition='symmetryGroup not in ["C1", "c1"]',
+                       label='Symmetry centre (A)',
+                       help='Coordinates x y z of the symmetry centre, in Angstroms. If empty, the centre of the '
+                            'map box is used.')
+        group.addParam('symmetryMargin', params.FloatParam,
+                       default=2.0, condition='symmetryGroup not in ["C1", "c1"]',
+                       label='Map context (resolution units)',
+                       help='The asymmetric unit is fitted into the map cropped to its bounding box plus this '
+                            'margin, in units of the resolution, which includes the density of its neighbours')
+        group.addParam('symmetryTolerance', params.FloatParam,
+                       default=5.0, condition='symmetryGroup not in ["C1", "c1"]',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       label='Copy matching tolerance (A)',
+                       help='Maximum distance between the centroid of a chain and the symmetry image of the '
+                            'centroid of its copy')
+
+        self._defineFittingParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    def _defineFittingParams(self, form):
+        """ Defines the iMODfit parameters, shared by all the fitting protocols """
+        cgChoices = self._get_cgChoices()
+
         form.addSection(label='Parameters')
         group = form.addGroup('Parameters')
         group.addParam('resolution', params.IntParam,
                       default=10,
                       label='Resolution in Angstroms',
                       help='Resolution in Angstroms. The resolution criterion follows EMAN package procedures')
+        group.addParam('cutoffMode', params.EnumParam,
+                      choices=['Manual', 'Auto: noise level', 'Auto: model volume'], default=CUTOFF_MANUAL,
+                      label='EM density map threshold mode',
+                      help='*Manual*: the threshold is given below.\n'
+                           '*Auto: noise level*: the threshold is set the given number of noise standard '
+                           'deviations over the background level, estimated from the median and median absolute '
+                           'deviation of the map values.\n'
+                           '*Auto: model volume*: the threshold encloses the expected volume of the structure, '
+                           'estimated from its number of residues.\n'
+                           'The automatic threshold is estimated from the histogram of the map, which is saved '
+                           'with the chosen value in <basename>_cutoff.json.')
         group.addParam('cutoff', params.FloatParam,
-                      default=0,
+                      default=0, condition='cutoffMode==%d' % CUTOFF_MANUAL,
                       label='EM density map threshold',
                       help='EM density map threshold. All density levels below this value will not be considered.')
+        group.addParam('cutoffSigma', params.FloatParam,
+                      default=3.0, condition='cutoffMode==%d' % CUTOFF_NOISE,
+                      label='Noise standard deviations',
+                      help='Number of noise standard deviations over the background level of the threshold')
         group.addParam('maxIter', params.IntParam,
                       default=10000,
                       label='Maximum iterations',
                       help='Maximum number of iterations')
+        group.addParam('earlyStop', params.BooleanParam,
+                      default=False,
+                      label='Stop when the score converges',
+                      help='Follows the score while iMODfit runs and stops it once it improves less than the '
+                           'threshold during the convergence window. The model of the movie with the best '
+                           'score is then used as the fitted structure and the movie ends with it, so the '
+                           'movie output is required.')
+        group.addParam('stopThreshold', params.FloatParam,
+                      default=0.001, condition='earlyStop',
+                      label='Minimum score improvement',
+                      help='Minimum improvement of the score to consider that the fitting has not converged')
+        group.addParam('stopWindow', params.IntParam,
+                      default=500, condition='earlyStop',
+                      label='Convergence window (iterations)',
+                      help='The fitting is stopped when the score has not improved more than the threshold '
+                           'during this number of iterations')
         group.addParam('cgModel', params.EnumParam,
                       choices=cgChoices, default=2,
                       label='Coarse-Grained model',
@@ -97,6 +177,24 @@ class imodfitFlexFitting(Protocol):
                       label='Excited modes range',
                       help='Excited modes range, either number [1,nevs] <integer>, or ratio [0,1) <float> (default=0.02)')
 
+        group = form.addGroup('Multi-stage')
+        group.addParam('multiStage', params.BooleanParam,
+                       default=False,
+                       label='Coarse-to-fine multi-stage fitting',
+                       help='Runs first a series of coarse fittings, each one starting from the fitted '
+                            'structure of the previous one, and then the fitting with the above parameters. '
+                            'Coarse stages are much faster for large systems, leaving a shorter full-atom '
+                            'fitting at full resolution.')
+        group.addParam('stageSchedule', params.TextParam,
+                       default='# model  resolution(A)  binning  iterations\n'
+                               'CA       20             4        2000\n'
+                               '3BB2R    15             2        2000',
+                       condition='multiStage',
+                       label='Coarse stages',
+                       help='One line per coarse stage with: Coarse-Grained model (CA, 3BB2R, Full-Atom, NCAC), '
+                            'resolution in Angstroms, map binning factor and maximum iterations. '
+                            'The map is downsampled (and low-pass filtered) averaging blocks of binning^3 voxels.')
+
         group = form.addGroup('Output')
         group.addParam('outputBasename', params.StringParam,
                       default='imodfit', expertLevel=params.LEVEL_ADVANCED,
@@ -110,6 +208,40 @@ class imodfitFlexFitting(Protocol):
                       default=True,
                       label='Outputs a Multi-PDB',
                       help='Outputs a Multi-PDB trajectory movie (<basename_movie>.pdb)')
+        group.addParam('compactMovie', params.BooleanParam,
+                      default=True, condition='outputMovie',
+                      label='Convert the movie to DCD',
+                      help='Converts the Multi-PDB movie into a binary DCD trajectory (<basename>_movie.dcd) '
+                           'plus a topology pdb with its first model (<basename>_movie_topology.pdb), '
+                           'and removes the Multi-PDB. The DCD takes several times less disk space, opens '
+                           'much faster in VMD and ChimeraX and its frames can be read directly with '
+                           'imodfit.trajectory.DcdTrajectory.')
+        group.addParam('movieFrames', params.EnumParam,
+                      choices=['All', 'Every Nth frame', 'Keyframes'], default=FRAMES_ALL,
+                      condition='outputMovie', display=params.EnumParam.DISPLAY_HLIST,
+                      label='Movie frames to keep',
+                      help='Reduces the movie once the fitting finishes, reading it frame by frame:\n'
+                           '*All*: every frame written by iMODfit is kept.\n'
+                           '*Every Nth frame*: one of every N frames is kept.\n'
+                           '*Keyframes*: a frame is kept when its RMSD from the last kept frame exceeds '
+                           'the threshold.\n'
+                           'The first and final frames are always kept, and the movie output points to the '
+                           'reduced trajectory.')
+        group.addParam('movieStep', params.IntParam,
+                      default=10, condition='outputMovie and movieFrames==%d' % FRAMES_EVERY,
+                      label='Keep one of every N frames')
+        group.addParam('keyframeRmsd', params.FloatParam,
+                      default=0.5, condition='outputMovie and movieFrames==%d' % FRAMES_KEYFRAMES,
+                      label='Keyframe RMSD (A)',
+                      help='Minimum RMSD, without superposition, from the last kept frame to keep a frame')
+        group.addParam('movieAnalysis', params.BooleanParam,
+                      default=True, condition='outputMovie',
+                      label='Analyse the movie',
+                      help='Computes for every frame of the movie its RMSD to the start and final models, its '
+                           'radius of gyration and the largest displacement of a residue from the start, and '
+                           'the principal components of the motion of the residues. The tables '
+                           '(<basename>_movie_frames.csv, <basename>_movie_residues.csv) and plots '
+                           '(<basename>_movie_analysis.png) are linked to the movie output.')
 
         group = form.addGroup('Extra')
         group.addParam('extraParams', params.StringParam,
@@ -118,25 +250,81 @@ class imodfitFlexFitting(Protocol):
                        help='Extra parameters as expected from the command line.'
                             'https://chaconlab.org/hybrid4em/imodfit/imodfit-intro')
 
+        group = form.addGroup('Input conversion')
+        group.addParam('useCache', params.BooleanParam,
+                       default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label='Use the converted inputs cache',
+                       help='Stores the converted input map and structure in a cache shared between runs '
+                            '(IMODFIT_CACHE variable) and links them into the run, so the same inputs are '
+                            'copied and converted only once. The least recently used entries are removed '
+                            'when the cache exceeds IMODFIT_CACHE_SIZE GB.')
+        group.addParam('cropVolume', params.BooleanParam,
+                       default=False,
+                       label='Crop the map around the structure',
+                       help='Crops the input map to the bounding box of the atomic structure plus a margin '
+                            'before fitting. The iMODfit cost of each iteration grows with the number of '
+                            'voxels, so this speeds up the fitting of a small structure in a large map. '
+                            'The origin of the cropped map is updated, so the fitted structure keeps the '
+                            'coordinates of the input map.')
+        group.addParam('cropMargin', params.FloatParam,
+                       default=2.0, condition='cropVolume',
+                       label='Crop margin (resolution units)',
+                       help='Margin added around the structure bounding box, in units of the resolution. '
+                            'E.g: 2 with a resolution of 10 A leaves a 20 A margin')
+
+        group = form.addGroup('Execution')
+        group.addParam('pinCores', params.BooleanParam,
+                       default=True, expertLevel=params.LEVEL_ADVANCED,
+                       label='Pin iMODfit to free cores',
+                       help='Each iMODfit execution waits until there are as many free cores in the node as '
+                            'MKL threads, takes them (preferably from the same NUMA node) and is pinned to '
+                            'them, so concurrent iMODfit jobs of this and other protocols do not compete '
+                            'for the same cores. The cores in use are shared through the IMODFIT_CORES_FILE '
+                            'file. Requires taskset.')
+        group.addParam('reuseResults', params.BooleanParam,
+                       default=False,
+                       label='Reuse identical fittings',
+                       help='Fitting results are stored in a cache shared between runs (IMODFIT_RESULTS variable), '
+                            'keyed by the contents of the input map and structure and the iMODfit arguments, '
+                            'except the output basename and movie options. A fitting identical to a stored one '
+                            'reuses its fitted structure, movie and log instead of running iMODfit. Otherwise the '
+                            'fitting is always run, and its result replaces the stored one. The least recently '
+                            'used results are removed when the cache exceeds IMODFIT_RESULTS_SIZE GB.')
+        group.addParam('checkpointInterval', params.IntParam,
+                       default=1000, condition='outputMovie',
+                       label='Checkpoint interval (iterations)',
+                       help='Every this number of iterations, the last model of the movie is saved with the '
+                            'iteration count (<basename>_checkpoint.json). If the fitting is interrupted, '
+                            'continuing the protocol starts iMODfit again from the last checkpoint with the '
+                            'remaining iterations, and the movie parts are joined at the end. A finished '
+                            'fitting can also be extended by increasing the maximum iterations and '
+                            'continuing the protocol. 0 disables the intermediate checkpoints.')
+
     def _get_cgChoices(self):
       return ['CA', '3BB2R', 'Full-Atom', 'NCAC']
 
-    def _getImodfitArgs(self):
-      ccp4AbsPath = os.path.abspath(self.ccp4File)
-      #ccp4AbsPath = '/home/danieldh/i2pc/software/em/iMODfit-1.51/imodfit_test/1oel.ccp4'
+    def _getImodfitArgs(self, pdbFile=None, ccp4File=None, **kwargs):
+      """ Returns the iMODfit arguments. The form values of resolution, cutoff, maxIter, cgModel, modesRange,
+      excitedModesRange, fullAtom and outputMovie can be overridden by the keyword arguments """
+      pdbFile = pdbFile if pdbFile is not None else self._getInputPdbFile()
+      ccp4File = ccp4File if ccp4File is not None else self._getInputCcp4File()
+      ccp4AbsPath = os.path.abspath(ccp4File)
       #Standard arguments
-      args = [self.pdbFile, ccp4AbsPath, self.resolution.get(), self.cutoff.get()]
-      args += ['-i {}'.format(self.maxIter.get()), '-m {}'.format(self.cgModel.get())]
+      args = [pdbFile, ccp4AbsPath, kwargs.get('resolution', self.resolution.get()),
+              kwargs.get('cutoff', self._getCutoff())]
+      args += ['-i {}'.format(kwargs.get('maxIter', self.maxIter.get())),
+               '-m {}'.format(kwargs.get('cgModel', self.cgModel.get()))]
       if self.chiAngle.get():
         args += ['-x']
-      args += ['-n {}'.format(self.modesRange.get()), '-e {}'.format(self.excitedModesRange.get())]
+      args += ['-n {}'.format(kwargs.get('modesRange', self.modesRange.get())),
+               '-e {}'.format(kwargs.get('excitedModesRange', self.excitedModesRange.get()))]
 
       #Output arguments
       if self.outputBasename.get() != 'imodfit':
         args += ['-o {}'.format(self.outputBasename.get())]
-      if self.fullAtom.get():
+      if kwargs.get('fullAtom', self.fullAtom.get()):
         args += ['-F']
-      if self.outputMovie.get():
+      if kwargs.get('outputMovie', self.outputMovie.get()):
         args += ['-t']
 
       #Extra parameters
@@ -144,57 +332,741 @@ class imodfitFlexFitting(Protocol):
         args += ['{}'.format(self.extraParams.get())]
       return args
 
-    def _getMrcInputVol(self):
-      inpVol = self.inputVolume.get()
-      # Input volume as a ccp4 file
-      name, ext = os.path.splitext(inpVol.getFileName())
-      if ext != '.mrc':
-        mrcFile = self._getExtraPath(pwutils.replaceBaseExt(inpVol.getFileName(), 'mrc'))
-        _ih = ImageHandler()
-        _ih.convert(inpVol, mrcFile)
+    def _getPdbInputStruct(self):
+      return self._convertInputStruct(self.inputAtomStruct.get().getFileName(), self._getExtraPath())
+
+    def _getInputCcp4File(self, volFile=None, workDir=None):
+      """ Path of the header corrected ccp4 map that is passed to iMODfit """
+      volFile = volFile or self.inputVolume.get().getFileName()
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, pwutils.replaceBaseExt(volFile, 'ccp4'))
+
+    def _getInputPdbFile(self, structFile=None, workDir=None):
+      """ Path of the pdb structure that is passed to iMODfit """
+      structFile = structFile or self.inputAtomStruct.get().getFileName()
+      workDir = workDir or self._getExtraPath()
+      if os.path.splitext(structFile)[1] == '.cif':
+        return os.path.abspath(os.path.join(workDir, pwutils.replaceBaseExt(structFile, 'pdb')))
+      return os.path.abspath(structFile)
+
+    def _getTrajectoryFiles(self, workDir=None):
+      """ Paths of the DCD trajectory and topology pdb of the compacted movie """
+      workDir = workDir or self._getExtraPath()
+      basename = os.path.join(workDir, '{}_movie'.format(self.outputBasename.get()))
+      return basename + '.dcd', basename + '_topology.pdb'
+
+    def _compactsMovie(self):
+      """ Whether the movie is reduced or converted to DCD after the fitting """
+      return self.outputMovie.get() and (self.compactMovie.get() or self.movieFrames.get() != FRAMES_ALL)
+
+    def _getFrameSelection(self):
+      """ Returns the (step, rmsd) arguments of the frame selection of the movie """
+      if self.movieFrames.get() == FRAMES_EVERY:
+        return max(self.movieStep.get(), 1), None
+      if self.movieFrames.get() == FRAMES_KEYFRAMES:
+        return 1, self.keyframeRmsd.get()
+      return 1, None
+
+    def _getSelectedFramesFile(self, workDir=None):
+      """ File with the number of frames of the movie already selected by _compactMovie. An extended fitting
+      keeps these frames as they are and only selects among the new ones """
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_movie_selected.json'.format(self.outputBasename.get()))
+
+    def _readSelectedFrames(self, workDir=None):
+      selectedFile = self._getSelectedFramesFile(workDir)
+      if not os.path.exists(selectedFile):
+        return 0
+      with open(selectedFile) as f:
+        return json.load(f)['frames']
+
+    def _compactMovie(self, workDir=None):
+      """ Reduces the Multi-PDB movie to the selected frames and, if chosen, converts it into a DCD trajectory
+      and removes it. The movie is read one frame at a time """
+      movieFile = self._getOutputFile('movie', workDir)
+      if os.path.exists(movieFile):
+        step, rmsd = self._getFrameSelection()
+        nSelected = self._readSelectedFrames(workDir)
+        if self.compactMovie.get():
+          dcdFile, topologyFile = self._getTrajectoryFiles(workDir)
+          nFrames = convertMovieToDcd(movieFile, dcdFile, topologyFile, step, rmsd, nSelected)
+          if nFrames > 0 and os.path.exists(dcdFile):
+            os.remove(movieFile)
+          else:
+            # A movie without complete models is kept as it is, without DCD output
+            pwutils.cleanPath(dcdFile, topologyFile)
+        else:
+          nFrames = decimateMovie(movieFile, step, rmsd, nSelected)
+        with open(self._getSelectedFramesFile(workDir), 'w') as f:
+          json.dump({'frames': nFrames}, f)
+        print('{} movie frames kept'.format(nFrames))
+
+    def _getMovieAtomStruct(self, workDir=None):
+      """ Returns the movie output, which points to the topology pdb if the movie was compacted """
+      dcdFile, topologyFile = self._getTrajectoryFiles(workDir)
+      if os.path.exists(dcdFile):
+        moviePDB = AtomStruct(topologyFile)
+        moviePDB._trajectoryFile = String(dcdFile)
       else:
-        mrcFile = inpVol.getFileName()
-      return mrcFile
+        moviePDB = AtomStruct(self._getOutputFile('movie', workDir))
+      framesFile, residuesFile, _, plotFile = self._getAnalysisFiles(workDir)
+      if os.path.exists(framesFile):
+        moviePDB._analysisFile = String(framesFile)
+        moviePDB._residueAnalysisFile = String(residuesFile)
+        moviePDB._analysisPlot = String(plotFile)
+      return moviePDB
 
-    def _getPdbInputStruct(self):
-      inpStruct = self.inputAtomStruct.get()
-      name, ext = os.path.splitext(inpStruct.getFileName())
-      if ext == '.cif':
-          cifFile = inpStruct.getFileName()
-          pdbFile = self._getExtraPath(pwutils.replaceBaseExt(cifFile, 'pdb'))
-          toPdb(cifFile, pdbFile)
+    def _getAnalysisFiles(self, workDir=None):
+      """ Paths of the per frame and per residue tables, the summary and the plots of the movie analysis """
+      workDir = workDir or self._getExtraPath()
+      basename = os.path.join(workDir, '{}_movie'.format(self.outputBasename.get()))
+      return basename + '_frames.csv', basename + '_residues.csv', basename + '_analysis.json', \
+             basename + '_analysis.png'
 
+    def _analyseMovie(self, workDir=None):
+      """ Analyses the compacted or Multi-PDB movie, reading it in chunks of frames """
+      dcdFile, topologyFile = self._getTrajectoryFiles(workDir)
+      if os.path.exists(dcdFile):
+        analysis = analyseMovie(dcdFile, topologyFile)
+      elif os.path.exists(self._getOutputFile('movie', workDir)) and \
+              next(iterPdbModels(self._getOutputFile('movie', workDir)), None) is not None:
+        analysis = analyseMovie(self._getOutputFile('movie', workDir))
       else:
-        pdbFile = inpStruct.getFileName()
-      return os.path.abspath(pdbFile)
+        print('The movie has no complete models to analyse')
+        return
+      framesFile, residuesFile, summaryFile, plotFile = self._getAnalysisFiles(workDir)
+      writeAnalysis(analysis, framesFile, residuesFile, summaryFile)
+      saveFramePlot(readFrameAnalysis(framesFile), plotFile)
+
+    def _getLogFile(self, workDir=None):
+      """ Path of the file where the iMODfit output is saved """
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_output.log'.format(self.outputBasename.get()))
+
+    def _getProgressFile(self, workDir=None):
+      """ Path of the csv file with the iteration, score and elapsed time of a running iMODfit """
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_progress.csv'.format(self.outputBasename.get()))
+
+    def _getProgressFiles(self):
+      """ Returns the (label, progressFile) of each iMODfit execution of the protocol """
+      progressFiles = []
+      if self.multiStage.get():
+        for stageNum in range(1, len(self._getStages()) + 1):
+          progressFiles.append(('Stage %d' % stageNum, self._getProgressFile(self._getStagePath(stageNum))))
+      progressFiles.append(('Fitting', self._getProgressFile()))
+      return progressFiles
+
+    def _runImodfit(self, args, workDir, earlyStop=False, checkpointer=None, numberOfThreads=None):
+      """ Runs iMODfit in workDir, saving its output in the log file and its progress in the progress file.
+      If earlyStop, iMODfit is stopped once the score converges, its movie is truncated to the model of the best
+      score and this model is saved as the fitted structure. A checkpointer (imodfit.checkpoint.Checkpointer)
+      saves checkpoints while it runs and the final one. numberOfThreads defaults to _getFitThreads.
+      Returns the running time of iMODfit (seconds), which does not include the time waiting for free cores """
+      start = (0, 0.0)
+      if checkpointer is not None:
+        start = (checkpointer.startIteration, checkpointer.startElapsed)
+      convergence = ConvergenceCheck(self.stopThreshold.get(), self.stopWindow.get(),
+                                     lambda: terminateProgram('imodfit_mkl', workDir),
+                                     movieInterval=getMovieInterval(parseImodfitArgs(args)['maxIter']),
+                                     startIteration=start[0])
+      callbacks = [convergence] if earlyStop else []
+      if checkpointer is not None:
+        callbacks.append(checkpointer)
+      monitor = ImodfitMonitor(self._getLogFile(workDir), self._getProgressFile(workDir), callbacks=callbacks,
+                               startIteration=start[0], startElapsed=start[1])
+      usageFile = os.path.join(workDir, '{}_usage.json'.format(self.outputBasename.get()))
+      pwutils.cleanPath(usageFile)
+      inputSizes = self._getInputSizes(args[0], args[1])
+      addProfileInfo(imodfitArgs=' '.join(str(arg) for arg in args), **inputSizes)
+      stoppedEarly = False
+      try:
+        Plugin.runIMODfit(self, 'imodfit_mkl', args=args, cwd=workDir,
+                          logFile=self._getLogFile(workDir), monitor=monitor,
+                          numberOfThreads=numberOfThreads or self._getFitThreads(), pinCores=self.pinCores.get(),
+                          usageFile=usageFile)
+        reason = 'Finished by iMODfit'
+      except subprocess.CalledProcessError:
+        if not convergence.converged:
+          raise
+        stoppedEarly = True
+        bestModel = truncateMovie(self._getOutputFile('movie', workDir), convergence.bestFrame)
+        if bestModel is None:
+          raise Exception('iMODfit was stopped before writing any model of the movie')
+        writeTopology(bestModel, self._getOutputFile('fitted', workDir))
+        reason = 'Stopped at iteration {}: improvement below {} during {} iterations. Best model at ' \
+                 'iteration {} (score {})'.format(convergence.iteration, self.stopThreshold.get(),
+                                                  self.stopWindow.get(), convergence.bestIteration,
+                                                  convergence.bestScore)
+      finally:
+        addChildUsage(usageFile)
+
+      with open(self._getStopFile(workDir), 'w') as f:
+        f.write(reason)
+      self._addCalibration(inputSizes, args, workDir, start[0], numberOfThreads or self._getFitThreads(),
+                           monitor.elapsed, usageFile)
+      if checkpointer is not None:
+        # The convergence may be detected when iMODfit is already finishing on its own
+        iteration = convergence.bestIteration if stoppedEarly else checkpointer.endIteration
+        checkpointer.saveFinal(self._getOutputFile('fitted', workDir), iteration, start[1] + monitor.elapsed)
+      return monitor.elapsed
+
+    def _getCheckpointFile(self, workDir=None):
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_checkpoint.json'.format(self.outputBasename.get()))
+
+    def _runResumable(self, pdbFile, ccp4File, workDir, earlyStop=False, numberOfThreads=None, **kwargs):
+      """ Runs the iMODfit fitting of pdbFile for maxIter iterations (form value or keyword argument),
+      saving checkpoints. If workDir has the checkpoint of an interrupted or finished fitting, iMODfit starts
+      from its model for the remaining iterations, and the movie parts are joined. Other keyword arguments
+      are passed to _getImodfitArgs. Returns the running time of iMODfit (seconds) """
+      maxIter = kwargs.pop('maxIter', self.maxIter.get())
+      moviePdb = self._getOutputFile('movie', workDir)
+      checkpoint = readCheckpoint(self._getCheckpointFile(workDir))
+      startIteration, startElapsed = 0, 0.0
+      # Only the results of fittings run from the start are reused and stored
+      resultKey = None
+      if checkpoint is None:
+        pwutils.cleanPath(self._getSelectedFramesFile(workDir))
+        resultKey = self._getResultKey(self._getImodfitArgs(pdbFile, ccp4File, maxIter=maxIter, **kwargs), earlyStop)
+        if self.reuseResults.get() and \
+                self._fetchResult(resultKey, workDir, kwargs.get('outputMovie', self.outputMovie.get())):
+          addProfileInfo(reusedResult=resultKey, **self._getInputSizes(pdbFile, ccp4File))
+          return 0.0
+      if checkpoint is not None:
+        if checkpoint['iteration'] >= maxIter:
+          print('The fitting already reached {} iterations'.format(checkpoint['iteration']))
+          return 0.0
+        startIteration, startElapsed, pdbFile = checkpoint['iteration'], checkpoint['elapsed'], checkpoint['pdbFile']
+        print('Resuming the fitting from the checkpoint at iteration {}'.format(startIteration))
+        # A compacted movie keeps its selected frames (_compactMovie) and is joined to the new part
+        dcdFile, topologyFile = self._getTrajectoryFiles(workDir)
+        if not os.path.exists(moviePdb) and os.path.exists(dcdFile):
+          convertDcdToMovie(dcdFile, topologyFile, moviePdb)
+          pwutils.cleanPath(dcdFile, topologyFile)
+        archivePart(moviePdb, checkpoint['movieOffset'])
+        archivePart(self._getLogFile(workDir))
+
+      interval = self.checkpointInterval.get() if kwargs.get('outputMovie', self.outputMovie.get()) else 0
+      checkpointer = Checkpointer(self._getCheckpointFile(workDir), moviePdb, interval,
+                                  startIteration, maxIter, startElapsed, getMovieInterval(maxIter - startIteration))
+      args = self._getImodfitArgs(pdbFile, ccp4File, maxIter=maxIter - startIteration, **kwargs)
+      runTime = self._runImodfit(args, workDir, earlyStop, checkpointer, numberOfThreads)
+      stitchMovie(moviePdb)
+      if resultKey is not None:
+        self._storeResult(resultKey, workDir)
+      return runTime
+
+    def _getResultFiles(self, workDir):
+      """ Returns the {entry extension: file} of the files of a fitting result """
+      return {'fitted.pdb': self._getOutputFile('fitted', workDir), 'movie.pdb': self._getOutputFile('movie', workDir),
+              'log': self._getLogFile(workDir), 'progress.csv': self._getProgressFile(workDir),
+              'stop.txt': self._getStopFile(workDir)}
+
+    def _getResultFile(self, workDir=None):
+      """ File describing the stored result reused by the fitting in workDir """
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_result.json'.format(self.outputBasename.get()))
+
+    def _getResultKey(self, args, earlyStop=False):
+      """ Returns the key of the result of running iMODfit with args. The structure and map are identified by
+      their contents, and the output basename and movie options, which do not change the fitting, are left out """
+      cache = Plugin.getResultsCache()
+      normArgs = [str(arg) for arg in args[2:] if str(arg) != '-t' and not str(arg).startswith('-o ')]
+      if earlyStop:
+        normArgs += ['earlyStop', self.stopThreshold.get(), self.stopWindow.get()]
+      return cache.getKey(args[0], cache.fileHash(args[1]), normArgs)
+
+    def _storeResult(self, key, workDir):
+      """ Stores the fitting result of workDir in the results cache. The description of the result, with its
+      files, iterations and running time, is stored last, so only complete results are found """
+      cache = Plugin.getResultsCache()
+      checkpoint = readCheckpoint(self._getCheckpointFile(workDir))
+      files = []
+      for ext, fileName in self._getResultFiles(workDir).items():
+        if os.path.exists(fileName):
+          cache.put(key, ext, fileName)
+          files.append(ext)
+      tmpFile = self._getResultFile(workDir) + '.tmp'
+      with open(tmpFile, 'w') as f:
+        json.dump({'key': key, 'files': files, 'iteration': checkpoint['iteration'],
+                   'elapsed': checkpoint['elapsed']}, f, indent=2)
+      cache.put(key, 'json', tmpFile)
+      os.remove(tmpFile)
+      cache.evict()
+
+    def _fetchResult(self, key, workDir, outputMovie):
+      """ Copies the stored result key into workDir, saving its final checkpoint. Returns False if there is no
+      complete result, or it has no movie and outputMovie is requested """
+      cache = Plugin.getResultsCache()
+      resultFile = self._getResultFile(workDir)
+      if not cache.get(key, 'json', resultFile):
+        return False
+      with open(resultFile) as f:
+        result = json.load(f)
+      files = [ext for ext in result['files'] if ext != 'movie.pdb' or outputMovie]
+      if (outputMovie and 'movie.pdb' not in files) or \
+              not all(cache.get(key, ext, self._getResultFiles(workDir)[ext]) for ext in files):
+        os.remove(resultFile)
+        return False
+
+      print('Reusing the result of an identical fitting ({})'.format(key))
+      saveCheckpoint(self._getCheckpointFile(workDir), readPdbAtoms(self._getOutputFile('fitted', workDir)),
+                     result['iteration'], result['elapsed'], None)
+      return True
+
+    def _getInputSizes(self, pdbFile, ccp4File):
+      """ Returns the number of atoms and residues of the structure and the dimensions and number of voxels
+      of the map """
+      dims = readMapHeader(ccp4File)['dims']
+      atomLines = readPdbAtoms(pdbFile)
+      return {'nAtoms': len(atomLines), 'nResidues': len(getResidues(atomLines)[0]), 'mapDims': list(dims),
+              'nVoxels': int(np.prod(dims))}
+
+    def _addCalibration(self, inputSizes, args, workDir, startIteration, threads, elapsed, usageFile):
+      """ Adds the measurements of an iMODfit execution to the calibration of the time and memory prediction """
+      progress = readProgress(self._getProgressFile(workDir))
+      if not progress or progress[-1][0] <= startIteration or not os.path.exists(usageFile):
+        return
+      with open(usageFile) as f:
+        usage = json.load(f)
+      addCalibrationRecord(Plugin.getCalibrationFile(), inputSizes, args, progress[-1][0] - startIteration,
+                           threads, elapsed, usage)
+
+    def _predictResources(self, nAtoms, nResidues, nVoxels):
+      """ Returns the predicted wall time (s) and peak memory (MB) of the fitting of a structure and a map of
+      these sizes with the fitting threads, the recommended threads and the cores and memory of the node.
+      With the multi-stage fitting, the times of the stages are added """
+      model = Plugin.getResourceModel()
+      stages = [(self.cgModel.get(), 1, self.maxIter.get())]
+      if self.multiStage.get():
+        stages = [(stage['cgModel'], stage['binning'], stage['maxIter']) for stage in self._getStages()] + stages
+      wallTime, peakMemory = 0.0, 0.0
+      for cgModel, binning, maxIter in stages:
+        size = getFittingSize(nAtoms, nResidues, nVoxels / binning ** 3, cgModel, self.modesRange.get(),
+                              self.chiAngle.get())
+        prediction = model.predict(size, maxIter, self._getFitThreads())
+        wallTime += prediction['wallTime']
+        peakMemory = max(peakMemory, prediction['peakMemoryMB'])
+      nCores, availableMemory = getNodeResources()
+      return {'wallTime': wallTime, 'peakMemoryMB': peakMemory, 'threads': self._getFitThreads(),
+              'recommendedThreads': model.recommendThreads(nCores), 'calibrationRecords': model.nRecords,
+              'nodeCores': nCores, 'nodeMemoryMB': availableMemory}
+
+    def _getPredictionInputs(self):
+      """ Returns the (structure file, number of map voxels) of the fittings, to predict their resources """
+      return [(self.inputAtomStruct.get().getFileName(), int(np.prod(self.inputVolume.get().getDim())))]
+
+    def _getPredictionFile(self):
+      return self._getExtraPath('{}_prediction.json'.format(self.outputBasename.get()))
+
+    def _getResourceWarnings(self, prediction):
+      warnings = []
+      if prediction['peakMemoryMB'] > prediction['nodeMemoryMB']:
+        warnings.append('iMODfit is predicted to need {:.0f} MB of memory, but only {:.0f} MB are available '
+                        'in this node'.format(prediction['peakMemoryMB'], prediction['nodeMemoryMB']))
+      if prediction['threads'] > prediction['nodeCores']:
+        warnings.append('{} threads per fitting were requested, but this node has {} cores'.format(
+          prediction['threads'], prediction['nodeCores']))
+      return warnings
+
+    def _getProfileFile(self):
+      """ JSON lines file with the profile record of each executed step """
+      return self._getExtraPath('{}_profile.jsonl'.format(self.outputBasename.get()))
+
+    def _getProfileSummary(self):
+      """ Summary lines with the time and resources used by each kind of step """
+      steps = {}
+      for record in readRecords(self._getProfileFile()):
+        steps.setdefault(record['step'], []).append(record)
+      lines = []
+      for step, records in steps.items():
+        line = '{} (x{}): {:.1f} s wall, {:.1f} s CPU'.format(
+          step, len(records), sum(r['wallTime'] for r in records), sum(r['cpuTime'] for r in records))
+        if any(r['childCpuTime'] for r in records):
+          line += '; iMODfit {:.1f} s CPU, {:.0f} MB peak memory, {:.1f} / {:.1f} MB read / written'.format(
+            sum(r['childCpuTime'] for r in records), max(r['childPeakRssMB'] for r in records),
+            sum(r['childReadBytes'] for r in records) / MB, sum(r['childWriteBytes'] for r in records) / MB)
+        lines.append(line)
+      return lines
+
+    def _getFitThreads(self):
+      """ Number of MKL threads of each iMODfit execution """
+      return self.numberOfThreads.get()
+
+    def _getStopFile(self, workDir=None):
+      """ Path of the file with the reason why iMODfit stopped """
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_stop.txt'.format(self.outputBasename.get()))
+
+    def _getFittedAtomStruct(self, workDir=None, mappingFile=None, suffix='fitted'):
+      """ Returns the fitted structure output, with the reason why iMODfit stopped and its correlation scores.
+      If the input was a mmCIF file, converted with the mapping table mappingFile (by default, the one of the input
+      structure), the output is the fitted structure written back to mmCIF with the original identifiers """
+      mappingFile = mappingFile or self._getMappingFile()
+      fittedFile = self._getOutputFile(suffix, workDir)
+      if os.path.exists(mappingFile):
+        fittedFile = os.path.splitext(fittedFile)[0] + '.cif'
+        writePdbAsCif(self._getOutputFile(suffix, workDir), mappingFile, fittedFile)
+      fittedPDB = AtomStruct(fittedFile)
+      if os.path.exists(self._getStopFile(workDir)):
+        with open(self._getStopFile(workDir)) as f:
+          fittedPDB._stopReason = String(f.read())
+      scores = self._readScores(workDir).get('fitted')
+      if scores:
+        fittedPDB._imodfitCC = Float(scores['cc'])
+        fittedPDB._imodfitCCMask = Float(scores['ccMask'])
+      if os.path.exists(self._getResidueScoresFile(workDir)):
+        fittedPDB._residueScoresFile = String(self._getResidueScoresFile(workDir))
+        fittedPDB._residueScoresPdb = String(self._getOutputFile('fitted_residue_cc', workDir))
+      return fittedPDB
+
+    def _getScoresFile(self, workDir=None):
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_scores.json'.format(self.outputBasename.get()))
+
+    def _getResidueScoresFile(self, workDir=None):
+      """ ChimeraX attribute file with the local correlation of each residue of the fitted structure """
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_residue_cc.defattr'.format(self.outputBasename.get()))
+
+    def _scoreResidues(self, workDir, ccp4File):
+      """ Writes the local correlation of each residue of the fitted structure as an attribute file and
+      as the B-factors of a copy of the structure (<basename>_fitted_residue_cc.pdb) """
+      atomLines = readPdbAtoms(self._getOutputFile('fitted', workDir))
+      residues, residueScores = scoreResidues(ccp4File, atomLines, self.resolution.get())
+      writeResidueAttributes(residues, residueScores, self._getResidueScoresFile(workDir))
+      writeResidueBfactors(atomLines, residueScores[getResidues(atomLines)[1]],
+                           self._getOutputFile('fitted_residue_cc', workDir))
+
+    def _scoreFitting(self, workDir, ccp4File, inputPdb=None):
+      """ Scores the fitted structure in workDir and, if given, the input structure against the map.
+      Returns the scores dict, which is also saved in the scores file. The residue scores of the fitted
+      structure are also written """
+      scores = {'fitted': scoreModel(ccp4File, self._getOutputFile('fitted', workDir), self.resolution.get())}
+      self._scoreResidues(workDir, ccp4File)
+      if inputPdb is not None:
+        scores['input'] = scoreModel(ccp4File, inputPdb, self.resolution.get())
+      with open(self._getScoresFile(workDir), 'w') as f:
+        json.dump(scores, f, indent=2)
+      return scores
+
+    def _readScores(self, workDir=None):
+      if not os.path.exists(self._getScoresFile(workDir)):
+        return {}
+      with open(self._getScoresFile(workDir)) as f:
+        return json.load(f)
+
+    def _getScoresSummary(self, workDir=None):
+      """ Summary line with the correlations of the input and fitted structures """
+      scores = self._readScores(workDir)
+      line = ', '.join('{} {:.4f} / {:.4f}'.format(name, scores[key]['cc'], scores[key]['ccMask'])
+                       for key, name in [('input', 'input'), ('fitted', 'fitted')] if key in scores)
+      return 'Correlation with the map (global / masked): ' + line if line else None
+
+    def _getOutputFile(self, suffix, workDir=None):
+      """ Path of an iMODfit output file, e.g. _getOutputFile('fitted') -> <basename>_fitted.pdb """
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_{}.pdb'.format(self.outputBasename.get(), suffix))
+
+    def _convertInputs(self, volFile, sampling, origin, structFile, workDir):
+      """ Converts the input map and structure into the files passed to iMODfit in workDir """
+      ccp4File = self._convertInputVolume(volFile, sampling, origin, workDir)
+      pdbFile = self._convertInputStruct(structFile, workDir)
+      if self.cutoffMode.get() != CUTOFF_MANUAL:
+        self._estimateCutoff(ccp4File, pdbFile, workDir)
+      if self.cropVolume.get():
+        self._cropInputVolume(ccp4File, pdbFile)
+      return ccp4File, pdbFile
+
+    def _getCutoffFile(self, workDir=None):
+      workDir = workDir or self._getExtraPath()
+      return os.path.join(workDir, '{}_cutoff.json'.format(self.outputBasename.get()))
+
+    def _getCutoff(self, workDir=None):
+      """ Returns the density threshold, or None if it is automatic and has not been estimated yet """
+      if self.cutoffMode.get() == CUTOFF_MANUAL:
+        return self.cutoff.get()
+      if not os.path.exists(self._getCutoffFile(workDir)):
+        return None
+      with open(self._getCutoffFile(workDir)) as f:
+        return json.load(f)['cutoff']
+
+    def _estimateCutoff(self, ccp4File, pdbFile, workDir):
+      """ Estimates the density threshold from the histogram of the map, reading it in sections, and saves
+      it with the histogram in the cutoff file """
+      counts, edges, mean, std = mapHistogram(ccp4File)
+      record = {'mode': self.getEnumText('cutoffMode'), 'mean': mean, 'std': std}
+      if self.cutoffMode.get() == CUTOFF_NOISE:
+        cutoff, background, noise = noiseThreshold(counts, edges, self.cutoffSigma.get())
+        record.update(nSigma=self.cutoffSigma.get(), background=background, noiseSigma=noise)
+      else:
+        residues, _ = getResidues(readPdbAtoms(pdbFile))
+        volume = getExpectedVolume([resName for _, _, resName in residues])
+        nVoxels = volume / np.prod(readMapHeader(ccp4File)['sampling'])
+        cutoff = volumeThreshold(counts, edges, nVoxels)
+        record.update(expectedVolume=volume, nVoxels=nVoxels)
+      record['cutoff'] = cutoff
+      record['histogram'] = {'edges': edges.tolist(), 'counts': counts.tolist()}
+      with open(self._getCutoffFile(workDir), 'w') as f:
+        json.dump(record, f)
+
+    def _cropInputVolume(self, ccp4File, pdbFile):
+      """ Replaces the ccp4 map by its box around the structure """
+      margin = self.cropMargin.get() * self.resolution.get()
+      start, end = getBoxAroundCoords(readPdbCoordinates(pdbFile), readMapHeader(ccp4File), margin)
+      cropFile = ccp4File.replace('.ccp4', '_crop.ccp4')
+      cropMap(ccp4File, cropFile, start, end)
+      # The full map may be linked from the cache, so it is replaced instead of modified
+      os.replace(cropFile, ccp4File)
+
+    def _convertInputVolume(self, volFile, sampling, origin, workDir):
+      """ Writes the volume into workDir as a ccp4 file with a proper header. A MRC/CCP4 volume that already has
+      that header is linked instead """
+      ccp4File = self._getInputCcp4File(volFile, workDir)
+      if isCompatibleMap(volFile, sampling, origin):
+        # The input volume is kept by its protocol, unlike the cache entries
+        pwutils.cleanPath(ccp4File)
+        pwutils.createAbsLink(volFile, ccp4File)
+      elif self.useCache.get():
+        cache = Plugin.getInputCache()
+        key = cache.getKey(volFile, sampling, tuple(origin))
+        cache.fetch(key, 'ccp4', ccp4File,
+                    lambda fn: self._writeCcp4Volume(volFile, sampling, origin, fn))
+      else:
+        self._writeCcp4Volume(volFile, sampling, origin, ccp4File)
+      return ccp4File
+
+    def _writeCcp4Volume(self, volFile, sampling, origin, ccp4File):
+      """ Converts SPIDER (and Xmipp) volumes section by section. MRC/CCP4 volumes are copied, fixing their header """
+      if os.path.splitext(volFile)[1] in SPIDER_EXTENSIONS:
+        convertSpiderToCcp4(volFile, ccp4File, sampling, origin)
+        return
+
+      from pwem.convert import Ccp4Header
+      shutil.copy(volFile, ccp4File)
+
+      #Ensuring a proper ccp4 file header
+      ccp4H = Ccp4Header(ccp4File)
+      ccp4H.copyCCP4Header(origin, sampling, Ccp4Header.ORIGIN)
+
+    def _convertInputStruct(self, structFile, workDir):
+      """ Returns the input structure as a pdb file, converting it if needed. mmCIF files are converted in a single
+      pass, writing also the table that maps the pdb atoms to their mmCIF identifiers """
+      pdbFile = self._getInputPdbFile(structFile, workDir)
+      if os.path.splitext(structFile)[1] == '.cif':
+        mappingFile = self._getMappingFile(structFile, workDir)
+        if self.useCache.get():
+          cache = Plugin.getInputCache()
+          key = cache.getKey(structFile, 'mapping')
+          cache.fetch(key, 'pdb', pdbFile, lambda fn: convertCifToPdb(structFile, fn, mappingFile))
+          # The mapping is written with the pdb, and only converted again if it was evicted on its own
+          cache.fetch(key, 'tsv', mappingFile, lambda fn: self._writeMapping(structFile, mappingFile, fn))
+        else:
+          convertCifToPdb(structFile, pdbFile, mappingFile)
+      return pdbFile
+
+    def _writeMapping(self, structFile, mappingFile, outFile):
+      """ Writes the mapping table into outFile, copying mappingFile if it was already written """
+      if os.path.exists(mappingFile):
+        shutil.copyfile(mappingFile, outFile)
+      else:
+        convertCifToPdb(structFile, outFile + '.pdb', outFile)
+        os.remove(outFile + '.pdb')
+
+    def _getMappingFile(self, structFile=None, workDir=None):
+      """ Path of the table mapping the atoms of a pdb converted from mmCIF to their mmCIF identifiers """
+      structFile = structFile or self.inputAtomStruct.get().getFileName()
+      workDir = workDir or self._getExtraPath()
+      return os.path.abspath(os.path.join(workDir, pwutils.replaceBaseExt(structFile, 'tsv')))
+
+    def _usesSymmetry(self):
+      """ Whether only an asymmetric unit of a symmetric assembly is fitted """
+      return hasattr(self, 'symmetryGroup') and self.symmetryGroup.get().strip().upper() not in ('', 'C1')
+
+    def _getSymmetryFile(self):
+      return self._getExtraPath('{}_symmetry.json'.format(self.outputBasename.get()))
+
+    def _readSymmetry(self):
+      """ Returns the symmetry dict with the group, centre, asymmetric unit chains and their copies """
+      with open(self._getSymmetryFile()) as f:
+        return json.load(f)
+
+    def _getFittingInputs(self):
+      """ Returns the pdb and ccp4 files fitted by iMODfit: the asymmetric unit and its map region when there is
+      symmetry, the converted inputs otherwise """
+      if self._usesSymmetry():
+        return os.path.abspath(self._getOutputFile('asu')), self._getInputCcp4File().replace('.ccp4', '_asu.ccp4')
+      return self._getInputPdbFile(), self._getInputCcp4File()
+
+    def _extractAsymUnit(self, centre):
+      """ Writes the asymmetric unit of the input structure and the map cropped around it with some context """
+      matrices = getSymmetryMatrices(self.symmetryGroup.get())
+      atomLines = readPdbAtoms(self._getInputPdbFile())
+      chains, copies = findAsymUnit(atomLines, matrices, centre, self.symmetryTolerance.get())
+      asuLines = selectChains(atomLines, chains)
+      asuPdb, asuMap = self._getFittingInputs()
+      writeTopology(asuLines, asuPdb)
+
+      ccp4File = self._getInputCcp4File()
+      margin = self.symmetryMargin.get() * self.resolution.get()
+      start, end = getBoxAroundCoords(readPdbCoordinates(asuPdb), readMapHeader(ccp4File), margin)
+      cropMap(ccp4File, asuMap, start, end)
+      with open(self._getSymmetryFile(), 'w') as f:
+        json.dump({'group': self.symmetryGroup.get(), 'centre': list(centre), 'chains': chains, 'copies': copies,
+                   'nCopies': len(matrices), 'nAtoms': len(asuLines)}, f, indent=2)
+
+    def _expandAsymUnit(self):
+      """ Writes the fitted assembly, applying the symmetry operators to the fitted asymmetric unit """
+      symmetry = self._readSymmetry()
+      expandAsymUnit(readPdbAtoms(self._getOutputFile('fitted')), getSymmetryMatrices(symmetry['group']),
+                     np.array(symmetry['centre']), symmetry['copies'], self._getOutputFile('fitted_assembly'))
+
+    def _getStages(self):
+      """ Parses the coarse stages schedule. Returns a list of dicts with the cgModel, resolution,
+      binning and maxIter of each stage. Raises ValueError with the wrong line """
+      cgChoices = [choice.lower() for choice in self._get_cgChoices()]
+      stages = []
+      for line in self.stageSchedule.get().splitlines():
+        fields = line.split('#')[0].split()
+        if not fields:
+          continue
+        try:
+          if len(fields) != 4:
+            raise ValueError('4 fields expected')
+          cgModel = fields[0]
+          cgModel = int(cgModel) if cgModel.isdigit() else cgChoices.index(cgModel.lower())
+          if cgModel >= len(cgChoices):
+            raise ValueError('unknown model')
+          stage = {'cgModel': cgModel, 'resolution': float(fields[1]),
+                   'binning': int(fields[2]), 'maxIter': int(fields[3])}
+          if stage['resolution'] <= 0 or stage['binning'] < 1 or stage['maxIter'] < 1:
+            raise ValueError('non positive value')
+        except ValueError:
+          raise ValueError('Wrong coarse stage "{}": expected the model ({}), the resolution, an integer binning '
+                           'and the iterations'.format(line.strip(), ', '.join(self._get_cgChoices())))
+        stages.append(stage)
+      return stages
+
+    def _getStagePath(self, stageNum, *paths):
+      return self._getExtraPath('stage_%d' % stageNum, *paths)
+
+    def _getStageInputPdb(self, stageNum):
+      """ The input of a stage is the fitted structure of the previous one """
+      if stageNum == 1:
+        return self._getInputPdbFile()
+      return os.path.abspath(self._getOutputFile('fitted', self._getStagePath(stageNum - 1)))
+
+    def _getStagesFile(self):
+      return self._getExtraPath('stages.json')
+
+    def _recordStage(self, stageNum, stage, stageDir, runTime):
+      """ Records the running time and final score of a stage """
+      record = dict(stage, stage=stageNum, time=runTime, score=getFinalScore(self._getLogFile(stageDir)))
+
+      records = [r for r in self._readStages() if r['stage'] != stageNum]
+      with open(self._getStagesFile(), 'w') as f:
+        json.dump(sorted(records + [record], key=lambda r: r['stage']), f, indent=2)
+
+    def _readStages(self):
+      if not os.path.exists(self._getStagesFile()):
+        return []
+      with open(self._getStagesFile()) as f:
+        return json.load(f)
+
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         # Insert processing steps
         self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('imodfitStep')
-        self._insertFunctionStep('createOutputStep')
+        if self.multiStage.get():
+            for stageNum in range(1, len(self._getStages()) + 1):
+                self._insertFunctionStep('imodfitStageStep', stageNum)
+        # The iterations are an argument of the fitting and following steps, so continuing the protocol
+        # with more iterations executes them again, extending the finished fitting
+        maxIter = self.maxIter.get()
+        self._insertFunctionStep('imodfitStep', maxIter)
+        if self._compactsMovie():
+            self._insertFunctionStep('convertMovieStep', maxIter)
+        if self.outputMovie.get() and self.movieAnalysis.get():
+            self._insertFunctionStep('analyseMovieStep', maxIter)
+        self._insertFunctionStep('scoreStep', maxIter)
+        self._insertFunctionStep('createOutputStep', maxIter)
 
+    @profileStep
     def convertInputStep(self):
       inpVol = self.inputVolume.get()
-      self.ccp4File = self._getExtraPath(pwutils.replaceBaseExt(inpVol.getFileName(), 'ccp4'))
-      shutil.copy(inpVol.getFileName(), self.ccp4File)
-
-      #Ensuring a proper ccp4 file header
       sampling = inpVol.getSamplingRate()
       origin = inpVol.getOrigin(force=True).getShifts()
-      ccp4H = Ccp4Header(self.ccp4File)
-      ccp4H.copyCCP4Header(origin, sampling, Ccp4Header.ORIGIN)
+      self._convertInputs(inpVol.getFileName(), sampling, origin,
+                          self.inputAtomStruct.get().getFileName(), self._getExtraPath())
+      if self._usesSymmetry():
+        if self.symmetryCentre.get().strip():
+          centre = [float(x) for x in self.symmetryCentre.get().split()]
+        else:
+          centre = [o + n * sampling / 2 for o, n in zip(origin, inpVol.getDim())]
+        self._extractAsymUnit(np.array(centre))
+      sizes = self._getInputSizes(*self._getFittingInputs())
+      with open(self._getPredictionFile(), 'w') as f:
+        json.dump(self._predictResources(sizes['nAtoms'], sizes['nResidues'], sizes['nVoxels']), f, indent=2)
+
+    @profileStep
+    def imodfitStageStep(self, stageNum):
+      """ Runs one of the coarse stages of a multi-stage fitting """
+      stage = self._getStages()[stageNum - 1]
+      stageDir = self._getStagePath(stageNum)
+      pwutils.makePath(stageDir)
+
+      ccp4File = self._getInputCcp4File()
+      if stage['binning'] > 1:
+        binFile = os.path.join(stageDir, pwutils.replaceBaseExt(ccp4File, 'ccp4'))
+        binMap(ccp4File, binFile, stage['binning'])
+        ccp4File = binFile
+
+      # Intermediate models are written in full-atom, as they are the input of the next stage
+      args = self._getImodfitArgs(self._getStageInputPdb(stageNum), ccp4File,
+                                  resolution=stage['resolution'], maxIter=stage['maxIter'],
+                                  cgModel=stage['cgModel'], fullAtom=True, outputMovie=False)
+      self._recordStage(stageNum, stage, stageDir, self._runImodfit(args, stageDir))
 
-      self.pdbFile = self._getPdbInputStruct()
+    @profileStep
+    def imodfitStep(self, maxIter):
+      if self.multiStage.get():
+        stageNum = len(self._getStages()) + 1
+        self._runResumable(self._getStageInputPdb(stageNum), self._getInputCcp4File(), self._getExtraPath(),
+                           earlyStop=self.earlyStop.get(), maxIter=maxIter)
+        stage = {'cgModel': self.cgModel.get(), 'resolution': self.resolution.get(),
+                 'binning': 1, 'maxIter': maxIter}
+        self._recordStage(stageNum, stage, self._getExtraPath(),
+                          readCheckpoint(self._getCheckpointFile())['elapsed'])
+      else:
+        pdbFile, ccp4File = self._getFittingInputs()
+        self._runResumable(pdbFile, ccp4File, self._getExtraPath(), earlyStop=self.earlyStop.get(), maxIter=maxIter)
+
+    @profileStep
+    def convertMovieStep(self, maxIter=None):
+        self._compactMovie()
 
-    def imodfitStep(self):
-      Plugin.runIMODfit(self, 'imodfit_mkl',
-                        args=self._getImodfitArgs(),
-                        cwd=self._getExtraPath())
+    @profileStep
+    def analyseMovieStep(self, maxIter=None):
+        self._analyseMovie()
 
-    def createOutputStep(self):
-        fittedPDB = AtomStruct(self._getExtraPath('{}_fitted.pdb'.format(self.outputBasename.get())))
-        moviePDB = AtomStruct(self._getExtraPath('{}_movie.pdb'.format(self.outputBasename.get())))
+    @profileStep
+    def scoreStep(self, maxIter=None):
+        pdbFile, ccp4File = self._getFittingInputs()
+        self._scoreFitting(self._getExtraPath(), ccp4File, pdbFile)
+
+    @profileStep
+    def createOutputStep(self, maxIter=None):
+        if self._usesSymmetry():
+            # The fitted structure is the assembly, and the asymmetric unit is also kept
+            self._expandAsymUnit()
+            asuPDB = self._getFittedAtomStruct()
+            asuPDB.setVolume(self.inputVolume.get())
+            self._defineOutputs(fittedAsymUnit=asuPDB)
+            fittedPDB = self._getFittedAtomStruct(suffix='fitted_assembly')
+        else:
+            fittedPDB = self._getFittedAtomStruct()
+        moviePDB = self._getMovieAtomStruct()
         fittedPDB.setVolume(self.inputVolume.get())
         moviePDB.setVolume(self.inputVolume.get())
 
@@ -202,8 +1074,88 @@ class imodfitFlexFitting(Protocol):
         self._defineOutputs(movieAtomStruct=moviePDB)
 
     # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+        if self.earlyStop.get() and not self.outputMovie.get():
+            errors.append('The movie output is needed to stop the fitting when the score converges')
+        if self._usesSymmetry():
+            try:
+                getSymmetryMatrices(self.symmetryGroup.get())
+            except ValueError as e:
+                errors.append(str(e))
+            if self.symmetryCentre.get().strip() and len(self.symmetryCentre.get().split()) != 3:
+                errors.append('The symmetry centre must be given as x y z')
+            if self.multiStage.get():
+                errors.append('The multi-stage fitting is not available with symmetry')
+        if self.multiStage.get():
+            try:
+                if not self._getStages():
+                    errors.append('The coarse stages schedule is empty')
+            except ValueError as e:
+                errors.append(str(e))
+        return errors
+
+    def _warnings(self):
+        # The fitting needing the most memory decides whether the node can run them
+        predictions = [self._predictResources(*getStructureSizes(structFile), nVoxels)
+                       for structFile, nVoxels in self._getPredictionInputs()]
+        return self._getResourceWarnings(max(predictions, key=lambda p: p['peakMemoryMB']))
+
     def _summary(self):
         summary = []
+        cgChoices = self._get_cgChoices()
+        for record in self._readStages():
+            summary.append('Stage {}: {} model, {} A resolution, binning {}: {:.1f} s, final score {}'.format(
+                record['stage'], cgChoices[record['cgModel']], record['resolution'], record['binning'],
+                record['time'], record['score']))
+
+        checkpoint = readCheckpoint(self._getCheckpointFile())
+        if checkpoint is not None and not self.isFinished():
+            summary.append('Last checkpoint at iteration {}'.format(checkpoint['iteration']))
+
+        if os.path.exists(self._getResultFile()):
+            summary.append('The fitting reused the result of an identical previous fitting')
+
+        if os.path.exists(self._getPredictionFile()):
+            with open(self._getPredictionFile()) as f:
+                prediction = json.load(f)
+            summary.append('Predicted iMODfit time {} with {} threads and {:.0f} MB peak memory ({} calibration '
+                           'records); recommended threads: {}'.format(
+                formatTime(prediction['wallTime']), prediction['threads'], prediction['peakMemoryMB'],
+                prediction['calibrationRecords'], prediction['recommendedThreads']))
+            summary += self._getResourceWarnings(prediction)
+
+        if self._usesSymmetry() and os.path.exists(self._getSymmetryFile()):
+            symmetry = self._readSymmetry()
+            summary.append('Symmetry {}: fitted one asymmetric unit (chains {}, {} atoms) of {} copies'.format(
+                symmetry['group'], ' '.join(symmetry['chains']), symmetry['nAtoms'], symmetry['nCopies']))
+
+        summaryFile = self._getAnalysisFiles()[2]
+        if os.path.exists(summaryFile):
+            with open(summaryFile) as f:
+                analysis = json.load(f)
+            line = 'Movie analysis ({} frames): final RMSD {:.2f} A, largest residue displacement {:.2f} A'.format(
+                analysis['nFrames'], analysis['finalRmsd'], analysis['maxDisplacement'])
+            if analysis['explainedVariance']:
+                line += ', PC1 explains {:.0f}% of the motion'.format(100 * analysis['explainedVariance'][0])
+            summary.append(line)
+
+        progress = readProgress(self._getProgressFile())
+        if progress:
+            iteration, score, elapsed = progress[-1]
+            speed = ' ({:.2f} iterations/s)'.format(iteration / elapsed) if elapsed > 0 else ''
+            summary.append('Fitting progress: iteration {}, score {}{}'.format(iteration, score, speed))
+
+        if self.cutoffMode.get() != CUTOFF_MANUAL and self._getCutoff() is not None:
+            summary.append('Automatic density threshold ({}): {:.4g}'.format(
+                self.getEnumText('cutoffMode'), self._getCutoff()))
+        scoresLine = self._getScoresSummary()
+        if scoresLine:
+            summary.append(scoresLine)
+        fittedPDB = getattr(self, 'fittedAtomStruct', None)
+        if fittedPDB is not None and hasattr(fittedPDB, '_stopReason'):
+            summary.append(fittedPDB._stopReason.get())
+        summary += self._getProfileSummary()
         return summary
 
     def _methods(self):
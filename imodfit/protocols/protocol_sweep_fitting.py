@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+This protocol performs the iMODfit flexible fitting of a structure over a map with every combination
+of a set of parameter values, running the combinations in parallel and selecting the best fitting.
+"""
+import os
+import json
+import math
+import itertools
+
+import numpy as np
+
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.object import String, Float, Integer
+from pwem.objects.data import SetOfAtomStructs
+from pyworkflow.utils import Message
+import pyworkflow.utils as pwutils
+from imodfit.monitor import getFinalScore
+from imodfit.profiling import profileStep
+from imodfit.checkpoint import readCheckpoint
+
+from .protocol_flexible_fitting import imodfitFlexFitting
+
+SWEEP_PARAMS = ['resolution', 'cutoff', 'modesRange', 'excitedModesRange', 'cgModel']
+
+
+class imodfitSweepFlexFitting(imodfitFlexFitting):
+    """
+    Performs the flexible fitting of a protein structure to a map with every combination of several values
+    of the iMODfit parameters, ranks the fittings by their final score and runtime and outputs the best one.
+    The combinations run in parallel, as many at the same time as Scipion threads minus one, sharing the
+    converted inputs. With successive halving, all the combinations start with a short fitting and only
+    the best ones continue, from their fitted structure, in the following rounds.
+    A rigid fitting for ensuring their prior best positions is needed before performing this flexible fitting.
+    """
+    _label = 'Parameter sweep flexible fitting'
+    stepsExecutionMode = STEPS_PARALLEL
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inputVolume', params.PointerParam,
+                      pointerClass='Volume', allowsNull=False,
+                      label="Input volume",
+                      help='Target EM map')
+        form.addParam('inputAtomStruct', params.PointerParam,
+                      pointerClass='AtomStruct', allowsNull=False,
+                      label="Input atom structure",
+                      help='Select the atom structure to be fitted in the volume')
+
+        form.addSection(label='Sweep')
+        valuesHelp = 'Values separated by spaces and/or ranges start:stop:step, e.g. "5 8:12:2" for 5, 8, 10 ' \
+                     'and 12. If empty, the value of the Parameters tab is used.'
+        form.addParam('sweepResolution', params.StringParam, default='',
+                      label='Resolution values (A)', help=valuesHelp)
+        form.addParam('sweepCutoff', params.StringParam, default='',
+                      label='Threshold values', help=valuesHelp)
+        form.addParam('sweepModesRange', params.StringParam, default='',
+                      label='Used modes range values', help=valuesHelp)
+        form.addParam('sweepExcitedModesRange', params.StringParam, default='',
+                      label='Excited modes range values', help=valuesHelp)
+        form.addParam('sweepCgModel', params.StringParam, default='',
+                      label='Coarse-Grained models',
+                      help='Models separated by spaces, e.g. "CA 3BB2R". '
+                           'If empty, the model of the Parameters tab is used.')
+
+        form.addParam('successiveHalving', params.BooleanParam, default=False,
+                      label='Successive halving',
+                      help='Fits all the combinations with a fraction of the maximum iterations and continues '
+                           'only the best ones in each round, from their fitted structure, until the last round '
+                           'reaches the maximum iterations. Poor combinations are discarded early, so the sweep '
+                           'is much cheaper than fitting the full grid.')
+        form.addParam('halvingRounds', params.IntParam, default=3,
+                      condition='successiveHalving',
+                      label='Rounds',
+                      help='Number of rounds. Round r of R runs up to maxIter / eta^(R - r) iterations in total')
+        form.addParam('halvingEta', params.IntParam, default=2,
+                      condition='successiveHalving',
+                      label='Reduction factor (eta)',
+                      help='Only the best 1/eta of the combinations of each round continue to the next one')
+
+        self._defineFittingParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+        form.addParam('fitThreads', params.IntParam,
+                      default=1, label='Threads per fitting',
+                      help='MKL threads of each iMODfit execution. The number of fittings running at the '
+                           'same time is given by the number of threads minus one.')
+
+    # --------------------------- UTILS functions ------------------------------
+    def _getFitThreads(self):
+        return self.fitThreads.get()
+
+    def _getProgressFiles(self):
+        return [('Combination %d, round %d' % (configId, roundNum),
+                 self._getProgressFile(self._getRoundPath(configId, roundNum)))
+                for configId in range(1, len(self._getConfigs()) + 1)
+                for roundNum in range(self._getNumberOfRounds())
+                if os.path.exists(self._getRoundPath(configId, roundNum))]
+
+    def _parseSweepValues(self, paramName):
+        """ Returns the list of values of a swept parameter """
+        text = getattr(self, 'sweep' + paramName[0].upper() + paramName[1:]).get() or ''
+        tokens = text.replace(',', ' ').split()
+        if not tokens:
+            return [self._getCutoff() if paramName == 'cutoff' else getattr(self, paramName).get()]
+
+        if paramName == 'cgModel':
+            cgChoices = [choice.lower() for choice in self._get_cgChoices()]
+            return [int(t) if t.isdigit() else cgChoices.index(t.lower()) for t in tokens]
+
+        values = []
+        for token in tokens:
+            if ':' in token:
+                fields = token.split(':')
+                if len(fields) != 3:
+                    raise ValueError('"{}" is not a start:stop:step range'.format(token))
+                start, stop, step = (float(v) for v in fields)
+                if step <= 0 or stop < start:
+                    raise ValueError('the range "{}" needs a positive step and a stop not lower than '
+                                     'the start'.format(token))
+                values += [round(v, 6) for v in np.arange(start, stop + step / 2.0, step)]
+            else:
+                values.append(float(token))
+        return values
+
+    def _getConfigs(self):
+        """ Returns the list of parameter combinations, as dicts of _getImodfitArgs overrides """
+        valueLists = [self._parseSweepValues(paramName) for paramName in SWEEP_PARAMS]
+        return [dict(zip(SWEEP_PARAMS, values)) for values in itertools.product(*valueLists)]
+
+    def _getNumberOfRounds(self):
+        return self.halvingRounds.get() if self.successiveHalving.get() else 1
+
+    def _getRoundIterations(self, roundNum):
+        """ Total iterations fitted by a combination at the end of round roundNum (0 based) """
+        if not self.successiveHalving.get():
+            return self.maxIter.get()
+        eta, nRounds = self.halvingEta.get(), self.halvingRounds.get()
+        return max(1, int(math.ceil(self.maxIter.get() / float(eta ** (nRounds - 1 - roundNum)))))
+
+    def _getConfigPath(self, configId, *paths):
+        return self._getExtraPath('config_%03d' % configId, *paths)
+
+    def _getRoundPath(self, configId, roundNum):
+        return self._getConfigPath(configId, 'round_%d' % roundNum)
+
+    def _getConfigResultFile(self, configId, roundNum):
+        return os.path.join(self._getRoundPath(configId, roundNum), 'result.json')
+
+    def _getRoundFile(self, roundNum):
+        return self._getExtraPath('round_%d.json' % roundNum)
+
+    def _getResultsFile(self):
+        return self._getExtraPath('sweep_results.csv')
+
+    def _readJson(self, jsonFile, default=None):
+        if not os.path.exists(jsonFile):
+            return default
+        with open(jsonFile) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _rankKey(record):
+        """ Combinations reaching later rounds first, then by decreasing score and increasing time """
+        score = record['score'] if record['score'] is not None else -np.inf
+        return -record['round'], -score, record['time']
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        prevId = self._insertFunctionStep('convertInputStep', prerequisites=[])
+        for roundNum in range(self._getNumberOfRounds()):
+            fitSteps = [self._insertFunctionStep('fitConfigStep', configId, roundNum, prerequisites=[prevId])
+                        for configId in range(1, len(self._getConfigs()) + 1)]
+            prevId = self._insertFunctionStep('selectRoundStep', roundNum, prerequisites=fitSteps)
+        self._insertFunctionStep('createOutputStep', prerequisites=[prevId])
+
+    @profileStep
+    def fitConfigStep(self, configId, roundNum):
+        """ Fits a combination in a round, starting from its fitted structure in the previous round """
+        prevResult = None
+        if roundNum > 0:
+            if configId not in self._readJson(self._getRoundFile(roundNum - 1))['survivors']:
+                return
+            prevResult = self._readJson(self._getConfigResultFile(configId, roundNum - 1))
+
+        workDir = self._getRoundPath(configId, roundNum)
+        pwutils.makePath(workDir)
+        if prevResult is None:
+            pdbFile, prevIter, prevTime = self._getInputPdbFile(), 0, 0.0
+        else:
+            pdbFile = os.path.abspath(self._getOutputFile('fitted', self._getRoundPath(configId, roundNum - 1)))
+            prevIter, prevTime = prevResult['iterations'], prevResult['time']
+
+        config = self._getConfigs()[configId - 1]
+        iterations = self._getRoundIterations(roundNum)
+        self._runResumable(pdbFile, self._getInputCcp4File(), workDir, earlyStop=self.earlyStop.get(),
+                           maxIter=iterations - prevIter, **config)
+        # Running time of all the executions of the round, in case it was resumed
+        runTime = readCheckpoint(self._getCheckpointFile(workDir))['elapsed']
+        if self._compactsMovie():
+            self._compactMovie(workDir)
+
+        scores = self._scoreFitting(workDir, self._getInputCcp4File())['fitted']
+        record = {'config': configId, 'round': roundNum, 'iterations': iterations, 'params': config,
+                  'score': getFinalScore(self._getLogFile(workDir)), 'time': prevTime + runTime,
+                  'cc': scores['cc'], 'ccMask': scores['ccMask']}
+        with open(self._getConfigResultFile(configId, roundNum), 'w') as f:
+            json.dump(record, f, indent=2)
+
+    @profileStep
+    def selectRoundStep(self, roundNum):
+        """ Ranks the combinations fitted in a round and selects the ones continuing to the next round """
+        records = [self._readJson(self._getConfigResultFile(configId, roundNum))
+                   for configId in range(1, len(self._getConfigs()) + 1)]
+        records = sorted([r for r in records if r is not None], key=self._rankKey)
+        nSurvivors = int(math.ceil(len(records) / float(self.halvingEta.get()))) \
+            if self.successiveHalving.get() else len(records)
+        with open(self._getRoundFile(roundNum), 'w') as f:
+            json.dump({'ranking': records, 'survivors': [r['config'] for r in records[:nSurvivors]]}, f, indent=2)
+
+    @profileStep
+    def createOutputStep(self):
+        records = self._getFinalRanking()
+        self._writeResultsTable(records)
+
+        fittedSet = SetOfAtomStructs.create(self._getPath(), suffix='fitted')
+        for rank, record in enumerate(records, 1):
+            fittedPDB = self._getFittedAtomStruct(self._getRoundPath(record['config'], record['round']))
+            fittedPDB.setVolume(self.inputVolume.get())
+            fittedPDB._sweepRank = Integer(rank)
+            fittedPDB._sweepParams = String(json.dumps(record['params']))
+            fittedPDB._imodfitScore = Float(record['score'])
+            fittedPDB._imodfitTime = Float(record['time'])
+            fittedSet.append(fittedPDB)
+        fittedSet.write()
+
+        bestDir = self._getRoundPath(records[0]['config'], records[0]['round'])
+        bestPDB = self._getFittedAtomStruct(bestDir)
+        bestPDB.setVolume(self.inputVolume.get())
+        self._defineOutputs(fittedAtomStruct=bestPDB, fittedAtomStructs=fittedSet)
+
+        moviePDB = self._getMovieAtomStruct(bestDir)
+        if os.path.exists(moviePDB.getFileName()):
+            moviePDB.setVolume(self.inputVolume.get())
+            self._defineOutputs(movieAtomStruct=moviePDB)
+
+    def _getFinalRanking(self):
+        """ Ranking of all the combinations, each one with its result in the last round it reached """
+        lastRecords = {}
+        for roundNum in range(self._getNumberOfRounds()):
+            for record in self._readJson(self._getRoundFile(roundNum), {'ranking': []})['ranking']:
+                lastRecords[record['config']] = record
+        return sorted(lastRecords.values(), key=self._rankKey)
+
+    def _writeResultsTable(self, records):
+        with open(self._getResultsFile(), 'w') as f:
+            f.write(','.join(['rank', 'config'] + SWEEP_PARAMS +
+                             ['iterations', 'score', 'time', 'cc', 'ccMask']) + '\n')
+            for rank, record in enumerate(records, 1):
+                values = [rank, record['config']] + [record['params'][p] for p in SWEEP_PARAMS] + \
+                         [record['iterations'], record['score'], '%.1f' % record['time'],
+                          '%.4f' % record['cc'], '%.4f' % record['ccMask']]
+                f.write(','.join(str(v) for v in values) + '\n')
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = super()._validate()
+        if self.multiStage.get():
+            errors.append('The multi-stage fitting is not available in the parameter sweep')
+        try:
+            self._getConfigs()
+        except ValueError as e:
+            errors.append('Wrong sweep values: {}'.format(e))
+        if self.successiveHalving.get() and (self.halvingRounds.get() < 1 or self.halvingEta.get() < 2):
+            errors.append('Successive halving needs at least 1 round and a reduction factor of at least 2')
+        return errors
+
+    def _summary(self):
+        summary = []
+        if not os.path.exists(self._getResultsFile()):
+            summary.append('{} parameter combinations'.format(len(self._getConfigs())))
+            return summary
+
+        with open(self._getResultsFile()) as f:
+            lines = f.read().splitlines()
+        summary.append('Best combinations (of {}):'.format(len(lines) - 1))
+        summary += ['    ' + line.replace(',', '  ') for line in lines[:6]]
+        summary += self._getProfileSummary()
+        return summary
@@ -0,0 +1,168 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Node level scheduler of the cores used by concurrent iMODfit processes.
+
+All the iMODfit jobs of a node, of any user, share a state file with the cores taken by each job. A job takes
+a set of free cores, preferably from a single NUMA node, and is pinned to them, so concurrent jobs
+do not compete for the same cores. When there are not enough free cores, the job waits for them.
+"""
+import os
+import glob
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+STATE_DIR_MODE = 0o777
+STATE_FILE_MODE = 0o666
+
+
+def getNumaNodes(cores):
+    """ Returns the list of core lists of each NUMA node, restricted to cores.
+    A single node with all the cores is returned if the topology is not available """
+    nodes = []
+    for cpuList in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+        with open(cpuList) as f:
+            nodeCores = [c for c in parseCpuList(f.read()) if c in cores]
+        if nodeCores:
+            nodes.append(nodeCores)
+    return nodes or [sorted(cores)]
+
+
+def parseCpuList(cpuList):
+    """ Parses a kernel cpu list, e.g. '0-3,8,10-11' """
+    cores = []
+    for field in cpuList.strip().split(','):
+        if '-' in field:
+            first, last = field.split('-')
+            cores += range(int(first), int(last) + 1)
+        elif field:
+            cores.append(int(field))
+    return cores
+
+
+def _pidExists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class CoreScheduler:
+    """ Allocates disjoint sets of cores to the jobs of a node. The allocations are kept in stateFile
+    as {jobId: {'pid': pid, 'cores': [...]}} and the ones of finished processes are discarded """
+    def __init__(self, stateFile, cores=None, pollInterval=2):
+        self.stateFile = stateFile
+        self.cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+        self.nodes = getNumaNodes(self.cores)
+        self.pollInterval = pollInterval
+
+    @contextmanager
+    def allocate(self, nCores, log=None):
+        """ Context manager that waits for nCores free cores and yields their list. If the state file cannot be
+        written, e.g. it was created without write permission for other users, None is yielded and the job is
+        not pinned """
+        jobId = '{}.{}'.format(os.getpid(), threading.get_ident())
+        nCores = max(1, min(nCores, len(self.cores)))
+        try:
+            cores = self.tryAcquire(jobId, nCores)
+        except PermissionError as e:
+            if log is not None:
+                log('The cores cannot be allocated, the job is not pinned: {}'.format(e))
+            yield None
+            return
+        if cores is None and log is not None:
+            log('Waiting for {} free cores'.format(nCores))
+        while cores is None:
+            time.sleep(self.pollInterval)
+            cores = self.tryAcquire(jobId, nCores)
+        try:
+            yield cores
+        finally:
+            self.release(jobId)
+
+    def tryAcquire(self, jobId, nCores):
+        """ Takes nCores free cores for jobId and returns them, or None if there are not enough """
+        with self._lockedState() as state:
+            busy = {c for job in state.values() for c in job['cores']}
+            cores = self._chooseCores(nCores, busy)
+            if cores is not None:
+                state[jobId] = {'pid': os.getpid(), 'cores': cores}
+            return cores
+
+    def release(self, jobId):
+        with self._lockedState() as state:
+            state.pop(jobId, None)
+
+    def _chooseCores(self, nCores, busy):
+        """ Chooses the free cores from the NUMA node with the fewest free cores that can hold the job,
+        leaving the emptier nodes for larger jobs. Jobs not fitting in a node take the free cores of the
+        nodes with more free cores first """
+        freeNodes = [[c for c in node if c not in busy] for node in self.nodes]
+        if sum(len(node) for node in freeNodes) < nCores:
+            return None
+        fitting = [node for node in freeNodes if len(node) >= nCores]
+        if fitting:
+            return min(fitting, key=len)[:nCores]
+        cores = []
+        for node in sorted(freeNodes, key=len, reverse=True):
+            cores += node[:nCores - len(cores)]
+        return cores
+
+    @contextmanager
+    def _lockedState(self):
+        """ Yields the allocations dict, without the ones of finished processes, and saves it. The state file is
+        created writable by all the users, in a folder without the sticky bit of the temporary folders, where
+        the users could not open the files of others, and is rewritten in place while locked """
+        stateDir = os.path.dirname(os.path.abspath(self.stateFile))
+        if not os.path.isdir(stateDir):
+            os.makedirs(stateDir, exist_ok=True)
+            if os.stat(stateDir).st_uid == os.getuid():
+                os.chmod(stateDir, STATE_DIR_MODE)
+        fd = os.open(self.stateFile, os.O_RDWR | os.O_CREAT, STATE_FILE_MODE)
+        with os.fdopen(fd, 'r+') as f:
+            if os.fstat(fd).st_uid == os.getuid():
+                os.fchmod(fd, STATE_FILE_MODE)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.load(f)
+                except ValueError:
+                    # New or left incomplete by a killed process
+                    state = {}
+                state = {jobId: job for jobId, job in state.items() if _pidExists(job['pid'])}
+                yield state
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,225 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Model to map correlation scoring.
+
+The density of a structure is simulated by adding a Gaussian per atom, weighted by its atomic number,
+with a width given by the resolution. Each Gaussian is evaluated only in the voxels of a box of 3 sigmas
+around its atom, as the product of its x, y and z profiles, for chunks of atoms at a time. Only the box
+of the map around the structure is simulated and the rest of the map is read section by section.
+"""
+import numpy as np
+
+from .convert import readMapHeader, openMapData, getBoxAroundCoords, readPdbAtoms, _checkAxesOrder
+from .trajectory import linesToCoords
+
+# sigma = resolution / (pi * sqrt(2)), as in the ChimeraX molmap command
+SIGMA_FACTOR = 1 / (np.pi * np.sqrt(2))
+SIGMA_CUTOFF = 3
+ATOMIC_NUMBERS = {'H': 1, 'C': 6, 'N': 7, 'O': 8, 'P': 15, 'S': 16}
+CHUNK_SIZE = 4096
+
+
+def getAtomWeights(atomLines):
+    """ Returns the atomic numbers of a list of pdb atom lines, taking the element from its columns or
+    from the atom name. Unknown elements are weighted as carbon """
+    weights = np.empty(len(atomLines), dtype=np.float32)
+    for i, line in enumerate(atomLines):
+        element = line[76:78].strip() or line[12:16].strip().lstrip('0123456789')[:1]
+        weights[i] = ATOMIC_NUMBERS.get(element.upper(), 6)
+    return weights
+
+
+def _atomStencils(pos, dims, sampling, radius):
+    """ For each atom of pos (voxel coordinates, (n, 3)), returns per axis the indexes of the voxels within
+    radius (Angstroms) along that axis, (n, w), and their distances to the atom, which are inf out of the grid """
+    stencils = []
+    for axis in range(3):
+        r = int(np.ceil(radius / sampling[axis]))
+        idx = np.rint(pos[:, axis]).astype(int)[:, None] + np.arange(-r, r + 1)
+        dist = (idx - pos[:, axis, None]) * sampling[axis]
+        outside = (idx < 0) | (idx >= dims[axis])
+        dist[outside] = np.inf
+        idx[outside] = 0
+        stencils.append((idx, dist))
+    return stencils
+
+
+def _flatIndexes(stencils, dims):
+    """ Flat indexes, (n, wz, wy, wx), of the voxels of the atom stencils in a (nz, ny, nx) grid """
+    (ix, _), (iy, _), (iz, _) = stencils
+    return (iz[:, :, None, None] * dims[1] + iy[:, None, :, None]) * dims[0] + ix[:, None, None, :]
+
+
+def simulateMap(coords, weights, header, resolution, chunkSize=CHUNK_SIZE):
+    """ Simulates the density of the atoms in the grid of the map described by header.
+    Returns the (x, y, z) start voxel of the simulated box and its (nz, ny, nx) float32 density """
+    sampling = np.array(header['sampling'])
+    sigma = SIGMA_FACTOR * resolution
+    start, end = getBoxAroundCoords(coords, header, SIGMA_CUTOFF * sigma)
+    dims = end - start
+    density = np.zeros(dims[::-1], dtype=np.float32)
+    if not dims.all():
+        return start, density
+
+    pos = (coords - np.array(header['origin'])) / sampling - start
+    flatDensity = density.reshape(-1)
+    for first in range(0, len(coords), chunkSize):
+        stencils = _atomStencils(pos[first:first + chunkSize], dims, sampling, SIGMA_CUTOFF * sigma)
+        px, py, pz = [np.exp(-dist ** 2 / (2 * sigma ** 2)).astype(np.float32) for _, dist in stencils]
+        values = weights[first:first + chunkSize, None, None, None] * \
+            pz[:, :, None, None] * py[:, None, :, None] * px[:, None, None, :]
+        np.add.at(flatDensity, _flatIndexes(stencils, dims).ravel(), values.ravel())
+    return start, density
+
+
+def assignVoxels(pos, labels, dims, sampling, radius, chunkSize=CHUNK_SIZE):
+    """ Assigns each voxel of a (nz, ny, nx) grid within radius of an atom the label of its nearest atom.
+    pos are the atom voxel coordinates. Returns an int32 grid with -1 in the voxels far from any atom """
+    bestDist = np.full(int(np.prod(dims)), np.inf, dtype=np.float32)
+    voxelLabels = np.full(int(np.prod(dims)), -1, dtype=np.int32)
+    # First the distance to the nearest atom of each voxel and then the label of the atoms at that distance
+    for fillLabels in (False, True):
+        for first in range(0, len(pos), chunkSize):
+            stencils = _atomStencils(pos[first:first + chunkSize], dims, sampling, radius)
+            (_, dx), (_, dy), (_, dz) = stencils
+            dist = (dz[:, :, None, None] ** 2 + dy[:, None, :, None] ** 2 + dx[:, None, None, :] ** 2)
+            dist = dist.astype(np.float32)
+            flatIdx = _flatIndexes(stencils, dims)
+            inside = dist <= radius ** 2
+            if not fillLabels:
+                np.minimum.at(bestDist, flatIdx[inside], dist[inside])
+            else:
+                nearest = inside & (dist == bestDist[flatIdx])
+                chunkLabels = np.broadcast_to(labels[first:first + chunkSize, None, None, None], dist.shape)
+                voxelLabels[flatIdx[nearest]] = chunkLabels[nearest]
+    return voxelLabels.reshape(dims[::-1])
+
+
+def _correlation(n, sx, sy, sxx, syy, sxy):
+    cov = sxy - sx * sy / n
+    var = (sxx - sx ** 2 / n) * (syy - sy ** 2 / n)
+    return float(cov / np.sqrt(var)) if var > 0 else 0.0
+
+
+def scoreCoords(mapFile, coords, weights, resolution, maskThreshold=0.1):
+    """ Returns the correlation between the map and the density simulated from the atoms as a dict with:
+    cc: cross-correlation over the whole map.
+    ccMask: cross-correlation over the voxels where the simulated density is above maskThreshold times
+    its maximum, i.e. around the structure """
+    header = readMapHeader(mapFile)
+    _checkAxesOrder(header)
+    start, sim = simulateMap(coords, weights, header, resolution)
+    data = openMapData(mapFile, header)
+    (x0, y0, z0), (nz, ny, nx) = start, sim.shape
+    exp = np.asarray(data[z0:z0 + nz, y0:y0 + ny, x0:x0 + nx], dtype=np.float32)
+
+    # Sums of the whole map, section by section. The simulated density is 0 out of its box
+    n, sx, sxx = 0, 0.0, 0.0
+    for section in data:
+        section = np.asarray(section, dtype=np.float64)
+        n += section.size
+        sx += section.sum()
+        sxx += np.square(section).sum()
+    sy, syy = float(sim.sum(dtype=np.float64)), float(np.square(sim, dtype=np.float64).sum())
+    sxy = float(np.dot(exp.ravel().astype(np.float64), sim.ravel()))
+    scores = {'cc': _correlation(n, sx, sy, sxx, syy, sxy)}
+
+    mask = sim > maskThreshold * sim.max() if sim.size else np.zeros(0, dtype=bool)
+    x, y = exp[mask].astype(np.float64), sim[mask].astype(np.float64)
+    scores['ccMask'] = _correlation(x.size, x.sum(), y.sum(), np.dot(x, x), np.dot(y, y), np.dot(x, y)) \
+        if x.size else 0.0
+    return scores
+
+
+def scoreModel(mapFile, pdbFile, resolution, maskThreshold=0.1):
+    """ Returns the global and masked correlations (see scoreCoords) of a pdb structure in a map """
+    atomLines = readPdbAtoms(pdbFile)
+    return scoreCoords(mapFile, linesToCoords(atomLines).reshape(-1, 3), getAtomWeights(atomLines),
+                       resolution, maskThreshold)
+
+
+# --------------------------- RESIDUE SCORES ------------------------------
+def getResidues(atomLines):
+    """ Returns the list of residues of a list of pdb atom lines as (chain, resSeq + iCode, resName) tuples,
+    in order of appearance, and the index of the residue of each atom """
+    residues, residueIndex, atomResidues = [], {}, np.empty(len(atomLines), dtype=np.int32)
+    for i, line in enumerate(atomLines):
+        key = (line[21], line[22:27].strip(), line[17:20].strip())
+        if key not in residueIndex:
+            residueIndex[key] = len(residues)
+            residues.append(key)
+        atomResidues[i] = residueIndex[key]
+    return residues, atomResidues
+
+
+def scoreResidues(mapFile, atomLines, resolution, radius=None):
+    """ Returns the local correlation of each residue (see getResidues), computed between the map and the
+    simulated density in the voxels whose nearest atom belongs to the residue, within radius (Angstroms,
+    default half the resolution). Residues without voxels get a nan score """
+    header = readMapHeader(mapFile)
+    _checkAxesOrder(header)
+    coords = linesToCoords(atomLines).reshape(-1, 3)
+    residues, atomResidues = getResidues(atomLines)
+    start, sim = simulateMap(coords, getAtomWeights(atomLines), header, resolution)
+    (x0, y0, z0), (nz, ny, nx) = start, sim.shape
+    exp = np.asarray(openMapData(mapFile, header)[z0:z0 + nz, y0:y0 + ny, x0:x0 + nx], dtype=np.float64)
+
+    sampling = np.array(header['sampling'])
+    radius = radius or max(resolution / 2.0, 1.5 * sampling.max())
+    pos = (coords - np.array(header['origin'])) / sampling - start
+    voxelLabels = assignVoxels(pos, atomResidues, np.array((nx, ny, nz)), sampling, radius)
+
+    assigned = voxelLabels >= 0
+    labels, x, y = voxelLabels[assigned], exp[assigned], sim[assigned].astype(np.float64)
+    nRes = len(residues)
+    n = np.bincount(labels, minlength=nRes).astype(np.float64)
+    sx, sy = np.bincount(labels, x, nRes), np.bincount(labels, y, nRes)
+    sxx, syy, sxy = np.bincount(labels, x * x, nRes), np.bincount(labels, y * y, nRes), \
+        np.bincount(labels, x * y, nRes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sy / n
+        var = (sxx - sx ** 2 / n) * (syy - sy ** 2 / n)
+        cc = np.where(var > 0, cov / np.sqrt(var), np.nan)
+    return residues, cc
+
+
+def writeResidueAttributes(residues, scores, defattrFile, attrName='imodfitcc'):
+    """ Writes the residue scores as a ChimeraX attribute assignment file """
+    with open(defattrFile, 'w') as f:
+        f.write('attribute: {}\nrecipient: residues\nmatch mode: 1-to-1\n'.format(attrName))
+        for (chain, resSeq, _), score in zip(residues, scores):
+            if not np.isnan(score):
+                f.write('\t/{}:{}\t{:.4f}\n'.format(chain.strip() or 'A', resSeq, score))
+
+
+def writeResidueBfactors(atomLines, atomScores, pdbFile):
+    """ Writes a pdb file with the score of each atom in the B-factor column, e.g. to be coloured by VMD """
+    with open(pdbFile, 'w') as f:
+        for line, score in zip(atomLines, atomScores):
+            line = line.rstrip('\n').ljust(66)
+            f.write('{}{:6.2f}{}\n'.format(line[:60], 0.0 if np.isnan(score) else score, line[66:]))
+        f.write('END\n')
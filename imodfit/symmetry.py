@@ -0,0 +1,132 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Point group symmetry of assemblies.
+
+The rotation matrices of a point group are taken from pwem, in the orientations used by Scipion: Cn and Dn
+along z (with the Dn two-fold axes along x), T and O with their two and four-fold axes along x, y and z, and
+the icosahedral group in the 222 orientations (I1 with a five-fold axis in the yz plane, I2 in the xz plane).
+The copies of each chain of a symmetric structure are found by matching the images of its centroid, so
+only one asymmetric unit is fitted and the fitted assembly is rebuilt applying the operators to it.
+"""
+import re
+
+import numpy as np
+from pwem import constants as emcts
+from pwem.convert.symmetry import getSymmetryMatrices as getEmSymmetryMatrices
+
+from .convert import getChains, selectChains
+from .trajectory import linesToCoords
+
+# pwem symmetry of each point group symbol, besides Cn and Dn
+SYMMETRIES = {'T': emcts.SYM_TETRAHEDRAL_222, 'O': emcts.SYM_OCTAHEDRAL,
+              'I': emcts.SYM_I222, 'I1': emcts.SYM_I222, 'I2': emcts.SYM_I222r}
+
+
+def getSymmetryMatrices(symbol):
+    """ Returns the rotation matrices of the point group symbol (C1, Cn, Dn, T, O, I, I1 or I2), starting with
+    the identity """
+    symbol = symbol.strip().upper()
+    match = re.match(r'^([CD])(\d+)$', symbol)
+    if match:
+        order = int(match.group(2))
+        if order < 1:
+            raise ValueError('Wrong symmetry order in {}'.format(symbol))
+        sym = emcts.SYM_CYCLIC if match.group(1) == 'C' else emcts.SYM_DIHEDRAL_X
+    elif symbol in SYMMETRIES:
+        order, sym = 1, SYMMETRIES[symbol]
+    else:
+        raise ValueError('Unknown symmetry {}'.format(symbol))
+    return [matrix[:3, :3] for matrix in getEmSymmetryMatrices(sym, n=order)]
+
+
+def applyOperator(coords, matrix, centre):
+    """ Rotates the coordinates (n, 3) by matrix around centre """
+    return (coords - centre) @ matrix.T + centre
+
+
+def _chainCentroids(atomLines):
+    return {chain: linesToCoords(selectChains(atomLines, [chain])).mean(axis=0) for chain in getChains(atomLines)}
+
+
+def _matchCopies(chain, candidates, centroids, matrices, centre, tolerance):
+    """ Returns the chain of candidates at the image of chain by each operator, or None if any image is missing """
+    copies = []
+    for matrix in matrices:
+        image = applyOperator(centroids[chain][None], matrix, centre)[0]
+        distances = {c: np.linalg.norm(centroids[c] - image) for c in candidates}
+        nearest = min(distances, key=distances.get)
+        if distances[nearest] > tolerance:
+            return None
+        copies.append(nearest)
+    return copies
+
+
+def findAsymUnit(atomLines, matrices, centre, tolerance=5.0):
+    """ Finds the chains of one asymmetric unit of a symmetric structure. Returns the list of chains and, for each
+    one, the list of its copies in the structure (the chain at its image by each operator), or None if the
+    structure is already a single asymmetric unit. The asymmetric unit is built with the copies of each chain
+    that are closest to its first chain """
+    centroids = _chainCentroids(atomLines)
+    chains = list(centroids)
+    if len(matrices) == 1:
+        return chains, None
+    images = [applyOperator(centroids[chains[0]][None], matrix, centre)[0] for matrix in matrices[1:]]
+    if min(np.linalg.norm(centroids[c] - image) for c in chains for image in images) > tolerance:
+        # The first chain has no symmetry copies: the structure is a single asymmetric unit
+        return chains, None
+
+    asu, copies, unassigned = [], {}, list(chains)
+    while unassigned:
+        chainCopies = _matchCopies(unassigned[0], unassigned, centroids, matrices, centre, tolerance)
+        if chainCopies is None or len(set(chainCopies)) != len(matrices):
+            raise ValueError('The {} symmetry copies of chain {} were not found within {} A'.format(
+                len(matrices), unassigned[0], tolerance))
+        representative = chainCopies[0] if not asu else \
+            min(chainCopies, key=lambda c: np.linalg.norm(centroids[c] - centroids[asu[0]]))
+        copies[representative] = _matchCopies(representative, chainCopies, centroids, matrices, centre, tolerance)
+        asu.append(representative)
+        unassigned = [c for c in unassigned if c not in chainCopies]
+    return asu, copies
+
+
+def expandAsymUnit(asuLines, matrices, centre, copies, assemblyPdb):
+    """ Writes the assembly generated by the operators from the atom lines of an asymmetric unit. With the copies
+    found by findAsymUnit, the copies take the chain identifiers of the input structure, in a single model.
+    Otherwise, each copy is written as a model with the chains of the asymmetric unit """
+    coords = linesToCoords(asuLines)
+    with open(assemblyPdb, 'w') as f:
+        serial = 0
+        for i, matrix in enumerate(matrices):
+            if copies is None:
+                f.write('MODEL     %4d\n' % (i + 1))
+            for line, xyz in zip(asuLines, applyOperator(coords, matrix, centre)):
+                serial += 1
+                chain = line[21] if copies is None else copies[line[21]][i]
+                f.write('{}{:5d}{}{}{}{:8.3f}{:8.3f}{:8.3f}{}'.format(
+                    line[:6], serial % 100000, line[11:21], chain, line[22:30], *xyz, line[54:]))
+            f.write('ENDMDL\n' if copies is None else 'TER\n')
+        f.write('END\n')
@@ -25,3 +25,4 @@
 # **************************************************************************
 
 from .test_protocols_imodfit import TestImodfit
+from .test_utils_imodfit import TestImodfitUtils
@@ -26,26 +26,41 @@
 
 from pyworkflow.tests import BaseTest, setupTestProject
 from pwem.protocols import ProtImportVolumes, ProtImportPdb
-import pwem
 import shutil, os
-from ..constants import IMODFIT, IMODFIT_DEFAULT_VERSION
-from ..protocols import imodfitFlexFitting
-from pwem import Domain
+import numpy as np
+from ..constants import IMODFIT_HOME, IMODFIT_CACHE, IMODFIT_RESULTS, IMODFIT_CALIBRATION
+from ..profiling import readRecords
+from ..checkpoint import readCheckpoint
+from ..monitor import readProgress
+from ..trajectory import DcdTrajectory, iterPdbModels
+from ..convert import openMapData
+from ..mmcif import iterAtomSite
+from ..benchmarks.synthetic import generateCase
+from ..benchmarks.standin import createStandinHome
+from ..protocols import imodfitFlexFitting, imodfitBatchFlexFitting, imodfitSweepFlexFitting, \
+    imodfitDomainFlexFitting, imodfitEnsembleFlexFitting
 
 
 FROM_FILE, FROM_SCIPION = 0, 1
 
 class TestImodfit(BaseTest):
+    """ Runs the protocols on a synthetic structure of 240 atoms (60 residues, chain A) and its simulated map,
+    with the stand-in of iMODfit (imodfit.benchmarks.standin), so they do not need the iMODfit binary """
     @classmethod
     def setUpClass(cls):
-        testFolder = pwem.Config.EM_ROOT + '/{}-{}/imodfit_test/'.format(IMODFIT, IMODFIT_DEFAULT_VERSION)
-        cls.pdbFile = testFolder + '1oel.pdb'
-        cls.volFile = testFolder + '1sx4A.ccp4'
-        cls.mrcFile = testFolder + '1sx4A.mrc'
-        if not os.path.exists(cls.mrcFile):
-            shutil.copy(cls.volFile, cls.mrcFile)
-
         setupTestProject(cls)
+        cls.pdbFile = os.path.abspath(cls.proj.getTmpPath('synthetic.pdb'))
+        cls.mrcFile = os.path.abspath(cls.proj.getTmpPath('synthetic.mrc'))
+        cls.sampling, _ = generateCase(cls.pdbFile, cls.mrcFile, 240, 48)
+
+        # Read by the protocol processes: the stand-in replaces iMODfit and the caches and calibration of
+        # the user are not used
+        os.environ[IMODFIT_HOME] = createStandinHome(os.path.abspath(cls.proj.getTmpPath('standin')))
+        os.environ.setdefault('IMODFIT_STANDIN_DELAY', '0.001')
+        os.environ[IMODFIT_CACHE] = os.path.abspath(cls.proj.getTmpPath('imodfit_cache'))
+        os.environ[IMODFIT_RESULTS] = os.path.abspath(cls.proj.getTmpPath('imodfit_results'))
+        cls.calibrationFile = cls.proj.getTmpPath('imodfit_calibration.jsonl')
+        os.environ[IMODFIT_CALIBRATION] = os.path.abspath(cls.calibrationFile)
         cls._runImportPDB()
         cls._runImportVolumes()
 
@@ -56,7 +71,7 @@ class TestImodfit(BaseTest):
             ProtImportVolumes,
             importFrom=0,
             filesPath=TestImodfit.mrcFile,
-            samplingRate=2)
+            samplingRate=TestImodfit.sampling)
         cls.launchProtocol(protImportVol)
         cls.protImportVol = protImportVol
 
@@ -69,19 +84,294 @@ class TestImodfit(BaseTest):
         cls.launchProtocol(protImportPDB)
         cls.protImportPDB = protImportPDB
 
-    def _runIMODFIT(self):
+    def _runIMODFIT(self, **kwargs):
+        # Results stored by other runs are only reused when a test asks for it
+        kwargs.setdefault('reuseResults', False)
         protImodfit = self.newProtocol(
             imodfitFlexFitting,
             inputVolume=self.protImportVol.outputVolume,
-            inputAtomStruct=self.protImportPDB.outputPdb)
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            **kwargs)
 
         self.launchProtocol(protImodfit)
         pdbOut = getattr(protImodfit, 'fittedAtomStruct', None)
         self.assertIsNotNone(pdbOut)
+        return protImodfit
+
+    def _runBatchIMODFIT(self):
+        protImodfit = self.newProtocol(
+            imodfitBatchFlexFitting,
+            inputVolumes=self.protImportVol.outputVolume,
+            inputAtomStructs=self.protImportPDB.outputPdb,
+            numberOfThreads=2, reuseResults=False)
+
+        self.launchProtocol(protImodfit)
+        pdbsOut = getattr(protImodfit, 'fittedAtomStructs', None)
+        self.assertIsNotNone(pdbsOut)
+        self.assertEqual(len([pdb for pdb in pdbsOut]), 1)
+        # The movie of each pair is analysed
+        self.assertEqual(protImodfit.movieAtomStructs.getSize(), 1)
+        for moviePDB in protImodfit.movieAtomStructs:
+            self.assertTrue(os.path.exists(moviePDB._analysisFile.get()))
+
+    def _runSweepIMODFIT(self):
+        protImodfit = self.newProtocol(
+            imodfitSweepFlexFitting,
+            inputVolume=self.protImportVol.outputVolume,
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            sweepResolution='10 15', sweepCgModel='CA 3BB2R',
+            successiveHalving=True, halvingRounds=2, maxIter=100,
+            numberOfThreads=3, reuseResults=False)
+
+        self.launchProtocol(protImodfit)
+        self.assertIsNotNone(getattr(protImodfit, 'fittedAtomStruct', None))
+        pdbsOut = getattr(protImodfit, 'fittedAtomStructs', None)
+        self.assertIsNotNone(pdbsOut)
+        self.assertEqual(len([pdb for pdb in pdbsOut]), 4)
+
+    def _runDomainIMODFIT(self):
+        protImodfit = self.newProtocol(
+            imodfitDomainFlexFitting,
+            inputVolume=self.protImportVol.outputVolume,
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            domainMode=1, domainGroups='A', maxIter=200, refineIter=100,
+            numberOfThreads=2, reuseResults=False)
+
+        self.launchProtocol(protImodfit)
+        self.assertIsNotNone(getattr(protImodfit, 'fittedAtomStruct', None))
+        self.assertEqual(len(protImodfit._readDomains()), 1)
+        self.assertEqual(protImodfit._getDomains(), [['A']])
+        self.assertTrue(os.path.exists(protImodfit._getMergedFile()))
+
+    def _runEnsembleIMODFIT(self):
+        mapsFolder = self.proj.getTmpPath('ensemble_maps')
+        os.makedirs(mapsFolder, exist_ok=True)
+        for i in range(3):
+            shutil.copy(self.mrcFile, os.path.join(mapsFolder, 'class_%d.mrc' % i))
+        protImportVols = self.newProtocol(
+            ProtImportVolumes,
+            importFrom=0,
+            filesPath=mapsFolder, filesPattern='class_*.mrc',
+            samplingRate=self.sampling)
+        self.launchProtocol(protImportVols)
+
+        protImodfit = self.newProtocol(
+            imodfitEnsembleFlexFitting,
+            inputVolumes=protImportVols.outputVolumes,
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            maxIter=1000, warmIter=200, numberOfThreads=3, reuseResults=False)
+
+        self.launchProtocol(protImodfit)
+        pdbsOut = getattr(protImodfit, 'fittedAtomStructs', None)
+        self.assertIsNotNone(pdbsOut)
+        self.assertEqual(len([pdb for pdb in pdbsOut]), 3)
+        records = protImodfit._readMapRecords()
+        self.assertEqual(len([r for r in records if r['parent'] is None]), 1)
+        self.assertTrue(all(r['iterations'] == 200 for r in records if r['parent'] is not None))
 
     def test_IMODFIT_fromScipion(self):
-        self._runIMODFIT()
+        protImodfit = self._runIMODFIT()
+        self.assertTrue(os.path.exists(protImodfit._getProgressFile()))
+        self.assertTrue(-1 <= protImodfit.fittedAtomStruct._imodfitCC.get() <= 1)
+        self.assertTrue(os.path.exists(protImodfit.fittedAtomStruct._residueScoresFile.get()))
+        fitRecords = [r for r in readRecords(protImodfit._getProfileFile()) if r['step'] == 'imodfitStep']
+        self.assertEqual(len(fitRecords), 1)
+        self.assertGreater(fitRecords[0]['nAtoms'], 0)
+
+    def test_IMODFIT_cropVolume(self):
+        self._runIMODFIT(cropVolume=True)
+
+    def test_IMODFIT_autoCutoff(self):
+        protImodfit = self._runIMODFIT(cutoffMode=2)
+        self.assertIsNotNone(protImodfit._getCutoff())
+
+    def test_IMODFIT_multiStage(self):
+        self._runIMODFIT(multiStage=True, stageSchedule='CA 20 4 100\n3BB2R 15 2 100')
+
+    def test_IMODFIT_stageValidation(self):
+        for schedule, error in [('CA 20 x 100', 'Wrong coarse stage "CA 20 x 100"'),
+                                ('CB 20 4 100', 'Wrong coarse stage "CB 20 4 100"'),
+                                ('CA 20 4', 'Wrong coarse stage "CA 20 4"'),
+                                ('# model  resolution(A)  binning  iterations', 'empty')]:
+            protImodfit = self.newProtocol(
+                imodfitFlexFitting,
+                inputVolume=self.protImportVol.outputVolume,
+                inputAtomStruct=self.protImportPDB.outputPdb,
+                multiStage=True, stageSchedule=schedule)
+            self.assertTrue(any(error in e for e in protImodfit._validate()), schedule)
+
+        protImodfit = self.newProtocol(
+            imodfitBatchFlexFitting,
+            inputVolumes=self.protImportVol.outputVolume,
+            inputAtomStructs=self.protImportPDB.outputPdb,
+            multiStage=True)
+        self.assertIn('The multi-stage fitting is not available in the batch fitting', protImodfit._validate())
+
+    def test_IMODFIT_earlyStop(self):
+        protImodfit = self._runIMODFIT(earlyStop=True, stopThreshold=0.001, stopWindow=100)
+        self.assertIn('Best model at iteration', protImodfit.fittedAtomStruct._stopReason.get())
+
+    def test_IMODFIT_extend(self):
+        # 21 frames (the starting model and one every 50 iterations), of which every third and the last are kept
+        protImodfit = self._runIMODFIT(maxIter=1000, checkpointInterval=200, movieFrames=1, movieStep=3)
+        self.assertEqual(readCheckpoint(protImodfit._getCheckpointFile())['iteration'], 1000)
+        self.assertEqual(len(DcdTrajectory(protImodfit._getTrajectoryFiles()[0])), 8)
+
+        # The 8 frames are kept and only the 20 new ones are reduced, to 8
+        protImodfit.maxIter.set(2000)
+        self.launchProtocol(protImodfit)
+        self.assertEqual(readCheckpoint(protImodfit._getCheckpointFile())['iteration'], 2000)
+        self.assertEqual(readProgress(protImodfit._getProgressFile())[-1][0], 2000)
+        self.assertEqual(len(DcdTrajectory(protImodfit._getTrajectoryFiles()[0])), 16)
+
+    def test_IMODFIT_reuseResult(self):
+        self._runIMODFIT(maxIter=500)
+        protImodfit = self._runIMODFIT(maxIter=500, outputBasename='reused', reuseResults=True)
+        self.assertTrue(os.path.exists(protImodfit._getResultFile()))
+        fitRecords = [r for r in readRecords(protImodfit._getProfileFile()) if r['step'] == 'imodfitStep']
+        self.assertIn('reusedResult', fitRecords[0])
+
+    def test_IMODFIT_prediction(self):
+        from ..prediction import ResourceModel
+        protImodfit = self._runIMODFIT(maxIter=500, numberOfThreads=1)
+        calibration = readRecords(self.calibrationFile)
+        self.assertEqual((calibration[-1]['nAtoms'], calibration[-1]['nResidues']), (240, 60))
+        self.assertEqual(calibration[-1]['iterations'], 500)
+        self.assertTrue(os.path.exists(protImodfit._getPredictionFile()))
+        self.assertEqual(protImodfit._warnings(), [])
+        self.assertGreater(ResourceModel.fromFile(self.calibrationFile).nRecords, 0)
 
+    def test_IMODFIT_movieFrames(self):
+        protImodfit = self._runIMODFIT(maxIter=1000, movieFrames=1, movieStep=3)
+        # 21 frames: every third one plus the last
+        self.assertEqual(len(DcdTrajectory(protImodfit._getTrajectoryFiles()[0])), 8)
+        protImodfit = self._runIMODFIT(maxIter=1000, movieFrames=2, keyframeRmsd=0.5, compactMovie=False)
+        moviePdb = protImodfit.movieAtomStruct.getFileName()
+        self.assertEqual(len(list(iterPdbModels(moviePdb))), 2)
 
+    def test_IMODFIT_emptyMovie(self):
+        # A movie stopped before its first model is complete is kept as the movie output
+        protImodfit = self.newProtocol(
+            imodfitFlexFitting,
+            inputVolume=self.protImportVol.outputVolume,
+            inputAtomStruct=self.protImportPDB.outputPdb)
+        workDir = self.proj.getTmpPath('empty_movie')
+        os.makedirs(workDir, exist_ok=True)
+        movieFile = protImodfit._getOutputFile('movie', workDir)
+        with open(movieFile, 'w') as f:
+            f.write('MODEL        1\n')
+        protImodfit._compactMovie(workDir)
+        self.assertTrue(os.path.exists(movieFile))
+        self.assertFalse(os.path.exists(protImodfit._getTrajectoryFiles(workDir)[0]))
+        self.assertEqual(protImodfit._getMovieAtomStruct(workDir).getFileName(), movieFile)
+        protImodfit._analyseMovie(workDir)
+        self.assertFalse(os.path.exists(protImodfit._getAnalysisFiles(workDir)[0]))
+
+    def test_IMODFIT_movieAnalysis(self):
+        from ..analysis import readFrameAnalysis
+        protImodfit = self._runIMODFIT(maxIter=1000)
+        columns = readFrameAnalysis(protImodfit.movieAtomStruct._analysisFile.get())
+        self.assertEqual(len(columns['frame']), len(DcdTrajectory(protImodfit._getTrajectoryFiles()[0])))
+        self.assertAlmostEqual(columns['rmsdStart'][0], 0.0)
+        self.assertAlmostEqual(columns['rmsdFinal'][-1], 0.0)
+        self.assertGreater(columns['rmsdStart'][-1], 0.0)
+        self.assertTrue(os.path.exists(protImodfit.movieAtomStruct._analysisPlot.get()))
+
+    def test_IMODFIT_spiderVolume(self):
+        from pwem.emlib.image import ImageHandler
+        spiderFile = self.proj.getTmpPath('synthetic.spi')
+        ImageHandler().convert(self.mrcFile, spiderFile)
+        protImportVol = self.newProtocol(
+            ProtImportVolumes,
+            importFrom=0,
+            filesPath=spiderFile,
+            samplingRate=self.sampling)
+        self.launchProtocol(protImportVol)
+
+        protImodfit = self.newProtocol(
+            imodfitFlexFitting,
+            inputVolume=protImportVol.outputVolume,
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            reuseResults=False)
+        self.launchProtocol(protImodfit)
+        self.assertIsNotNone(getattr(protImodfit, 'fittedAtomStruct', None))
+        ccp4Data = openMapData(protImodfit._getInputCcp4File())
+        self.assertTrue(np.allclose(ccp4Data, openMapData(self.mrcFile)))
+
+    def test_IMODFIT_cifStruct(self):
+        from pwem.convert.atom_struct import toCIF
+        cifFile = self.proj.getTmpPath('synthetic.cif')
+        toCIF(self.pdbFile, cifFile)
+        protImportPDB = self.newProtocol(
+            ProtImportPdb,
+            inputPdbData=1,
+            pdbFile=cifFile)
+        self.launchProtocol(protImportPDB)
+
+        protImodfit = self.newProtocol(
+            imodfitFlexFitting,
+            inputVolume=self.protImportVol.outputVolume,
+            inputAtomStruct=protImportPDB.outputPdb,
+            reuseResults=False)
+        self.launchProtocol(protImodfit)
+        fittedFile = protImodfit.fittedAtomStruct.getFileName()
+        self.assertTrue(fittedFile.endswith('.cif'))
+        self.assertEqual(len(list(iterAtomSite(fittedFile))), len(list(iterAtomSite(cifFile))))
+
+    def test_IMODFIT_symmetry(self):
+        from ..convert import readPdbAtoms
+        from ..symmetry import getSymmetryMatrices, expandAsymUnit
+        # C3 assembly of copies of the test structure, with chains A, B and C
+        atomLines = readPdbAtoms(self.pdbFile)
+        centre = np.mean([(float(l[30:38]), float(l[38:46]), float(l[46:54])) for l in atomLines], axis=0)
+        centre[0] += 15.0
+        assemblyFile = self.proj.getTmpPath('synthetic_c3.pdb')
+        expandAsymUnit(atomLines, getSymmetryMatrices('C3'), centre, {'A': ['A', 'B', 'C']}, assemblyFile)
+        protImportPDB = self.newProtocol(
+            ProtImportPdb,
+            inputPdbData=1,
+            pdbFile=assemblyFile)
+        self.launchProtocol(protImportPDB)
+
+        protImodfit = self.newProtocol(
+            imodfitFlexFitting,
+            inputVolume=self.protImportVol.outputVolume,
+            inputAtomStruct=protImportPDB.outputPdb,
+            symmetryGroup='C3',
+            symmetryCentre='%.3f %.3f %.3f' % tuple(centre),
+            reuseResults=False)
+        self.launchProtocol(protImodfit)
+        self.assertEqual(len(readPdbAtoms(protImodfit.fittedAsymUnit.getFileName())), len(atomLines))
+        fittedLines = readPdbAtoms(protImodfit.fittedAtomStruct.getFileName())
+        self.assertEqual(len(fittedLines), 3 * len(atomLines))
+        self.assertEqual(sorted(set(l[21] for l in fittedLines)), ['A', 'B', 'C'])
+
+    def test_IMODFIT_batch(self):
+        self._runBatchIMODFIT()
+
+    def test_IMODFIT_sweep(self):
+        self._runSweepIMODFIT()
 
+    def test_IMODFIT_sweepValidation(self):
+        protImodfit = self.newProtocol(
+            imodfitSweepFlexFitting,
+            inputVolume=self.protImportVol.outputVolume,
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            sweepResolution='10:20:0')
+        self.assertTrue(any(e.startswith('Wrong sweep values') for e in protImodfit._validate()))
+        protImodfit.sweepResolution.set('10:20:5')
+        self.assertEqual(protImodfit._parseSweepValues('resolution'), [10.0, 15.0, 20.0])
+
+    def test_IMODFIT_domains(self):
+        self._runDomainIMODFIT()
+
+    def test_IMODFIT_domainValidation(self):
+        protImodfit = self.newProtocol(
+            imodfitDomainFlexFitting,
+            inputVolume=self.protImportVol.outputVolume,
+            inputAtomStruct=self.protImportPDB.outputPdb,
+            domainMode=1, domainGroups='A\nZ')
+        self.assertIn('Chains not found in the input structure: Z', protImodfit._validate())
 
+    def test_IMODFIT_ensemble(self):
+        self._runEnsembleIMODFIT()
@@ -0,0 +1,391 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+from ..benchmarks.synthetic import generateCase
+from ..cache import FileCache
+from ..scheduler import CoreScheduler, STATE_DIR_MODE, STATE_FILE_MODE
+from ..convert import readPdbAtoms, readMapHeader, getBoxAroundCoords, cropMap
+from ..monitor import parseIterationLine, parseImodfitLog, ConvergenceCheck
+from ..checkpoint import Checkpointer, saveCheckpoint, readCheckpoint, archivePart, getPartFiles, stitchMovie
+from ..trajectory import iterPdbModels, linesToCoords, writeModels, truncateMovie, decimateMovie, \
+    convertMovieToDcd, convertDcdToMovie, getMovieInterval, DcdTrajectory
+from ..symmetry import getSymmetryMatrices
+from ..mmcif import _IdMapper, convertCifToPdb, writePdbAsCif, iterAtomSite, getChainMapping
+from ..analysis import analyseMovie, writeAnalysis, readFrameAnalysis
+
+
+class TestImodfitUtils(unittest.TestCase):
+    """ Tests of the functions of the plugin that do not need iMODfit nor a Scipion project, on a synthetic
+    structure of 240 atoms (60 residues) and its simulated map """
+    @classmethod
+    def setUpClass(cls):
+        cls.dataDir = tempfile.mkdtemp(prefix='imodfit_test_')
+        cls.pdbFile = os.path.join(cls.dataDir, 'synthetic.pdb')
+        cls.mrcFile = os.path.join(cls.dataDir, 'synthetic.mrc')
+        generateCase(cls.pdbFile, cls.mrcFile, 240, 32)
+        cls.atomLines = readPdbAtoms(cls.pdbFile)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataDir, ignore_errors=True)
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='imodfit_test_', dir=self.dataDir)
+
+    def _getPath(self, fileName):
+        return os.path.join(self.tmpDir, fileName)
+
+    def _writeMovie(self, nModels, fileName='movie.pdb'):
+        """ Writes a movie whose i-th model (0 based) is the structure shifted i Angstroms in x """
+        movieFile = self._getPath(fileName)
+        writeModels((self._shifted(i) for i in range(nModels)), movieFile)
+        return movieFile
+
+    def _shifted(self, shift):
+        return ['%s%8.3f%s' % (l[:30], float(l[30:38]) + shift, l[38:]) for l in self.atomLines]
+
+    def _getShifts(self, models):
+        """ Shift in x of each model from the structure """
+        x0 = linesToCoords(self.atomLines)[0, 0]
+        return [round(float(linesToCoords(model)[0, 0] - x0), 3) for model in models]
+
+    # --------------------------- cache ------------------------------
+    def _createEntry(self, size):
+        """ createFunc of FileCache.fetch writing size bytes, which counts its calls """
+        self.created = 0
+
+        def createFunc(fileName):
+            self.created += 1
+            with open(fileName, 'wb') as f:
+                f.write(b'x' * size)
+        return createFunc
+
+    def test_cacheFetch(self):
+        cache = FileCache(self._getPath('cache'), 1024)
+        key = cache.getKey(self.pdbFile, 'pdb')
+        self.assertEqual(key, cache.getKey(self.pdbFile, 'pdb'))
+        self.assertNotEqual(key, cache.getKey(self.pdbFile, 'other'))
+
+        createFunc = self._createEntry(100)
+        self.assertFalse(cache.fetch(key, 'pdb', self._getPath('run1.pdb'), createFunc))
+        self.assertTrue(cache.fetch(key, 'pdb', self._getPath('run2.pdb'), createFunc))
+        self.assertEqual(self.created, 1)
+        self.assertTrue(os.path.samefile(self._getPath('run2.pdb'), cache.getEntryPath(key, 'pdb')))
+
+        self.assertFalse(cache.get('missing', 'pdb', self._getPath('missing.pdb')))
+        cache.put('result', 'pdb', self.pdbFile)
+        self.assertTrue(cache.get('result', 'pdb', self._getPath('result.pdb')))
+        self.assertEqual(readPdbAtoms(self._getPath('result.pdb')), self.atomLines)
+
+    def test_cacheLinkOtherFileSystem(self):
+        # Without hardlinks the entry is copied, never symlinked
+        src = self._getPath('entry.pdb')
+        shutil.copyfile(self.pdbFile, src)
+        with mock.patch('os.link', side_effect=OSError('Invalid cross-device link')):
+            FileCache.link(src, self._getPath('linked.pdb'))
+        self.assertFalse(os.path.islink(self._getPath('linked.pdb')))
+        os.remove(src)
+        self.assertEqual(readPdbAtoms(self._getPath('linked.pdb')), self.atomLines)
+
+    def test_cacheEvict(self):
+        cache = FileCache(self._getPath('cache'), 250)
+        for i, key in enumerate(['a1', 'b2', 'c3']):
+            cache.fetch(key, 'map', self._getPath('run_%s.map' % key), self._createEntry(100))
+            entry = cache.getEntryPath(key, 'map')
+            os.utime(entry, (1000 + i, 1000 + i))
+        # The least recently used entry is evicted, the files of the runs are kept
+        cache.evict()
+        self.assertFalse(os.path.exists(cache.getEntryPath('a1', 'map')))
+        self.assertTrue(os.path.exists(cache.getEntryPath('b2', 'map')))
+        self.assertEqual(os.path.getsize(self._getPath('run_a1.map')), 100)
+
+        # The entry just created is kept even if it is the oldest one
+        cache.maxSize = 0
+        cache.evict(keep=cache.getEntryPath('b2', 'map'))
+        self.assertTrue(os.path.exists(cache.getEntryPath('b2', 'map')))
+        self.assertFalse(os.path.exists(cache.getEntryPath('c3', 'map')))
+
+    # --------------------------- monitor ------------------------------
+    def test_parseLog(self):
+        logFile = self._getPath('imodfit.log')
+        with open(logFile, 'w') as f:
+            f.write('iMODfit 1.51\n     10  0.512300  0.10\n   junk line\n     20  0.601000  0.20\n')
+        self.assertIsNone(parseIterationLine('   junk line'))
+        self.assertEqual(parseImodfitLog(logFile), [(10, 0.5123), (20, 0.601)])
+
+    def test_convergence(self):
+        converged = []
+        check = ConvergenceCheck(0.01, 30, lambda: converged.append(True))
+        for iteration, score in [(10, 0.5), (20, 0.6), (30, 0.605), (40, 0.607), (50, 0.608), (60, 0.609)]:
+            check(iteration, score, 0.0)
+        self.assertEqual((check.bestIteration, check.bestScore), (20, 0.6))
+        self.assertTrue(check.converged)
+        self.assertEqual(converged, [True])
+        self.assertEqual(check.iteration, 50)
+
+    def test_convergenceBestFrame(self):
+        # Run of 200 iterations resumed at iteration 1000, with the starting model and then a model every 10
+        # iterations (shifted by the iteration in x), and the best score at iteration 1073. The log is read in
+        # one go, after the movie was fully written, which gives the same frame
+        maxIter, startIteration = 200, 1000
+        interval = getMovieInterval(maxIter)
+        logFile = self._getPath('imodfit.log')
+        with open(logFile, 'w') as f:
+            for iteration in range(1, maxIter + 1):
+                f.write('  %6d  %.6f  %.2f\n' % (iteration, 0.9 - abs(iteration - 73) * 0.001, iteration * 0.01))
+        movieFile = self._getPath('movie.pdb')
+        writeModels((self._shifted(iteration) for iteration in range(0, maxIter + 1, interval)), movieFile)
+
+        check = ConvergenceCheck(0.0001, 50, movieInterval=interval, startIteration=startIteration)
+        for iteration, score in parseImodfitLog(logFile):
+            check(startIteration + iteration, score, 0.0)
+        self.assertTrue(check.converged)
+        self.assertEqual((check.bestIteration, check.bestFrame), (1073, 8))
+        bestModel = truncateMovie(movieFile, check.bestFrame)
+        self.assertEqual(self._getShifts([bestModel]), [70])
+        self.assertEqual(len(list(iterPdbModels(movieFile))), 8)
+
+    # --------------------------- trajectory ------------------------------
+    def test_dcdRoundTrip(self):
+        movieFile = self._writeMovie(5)
+        dcdFile, topologyFile = self._getPath('movie.dcd'), self._getPath('topology.pdb')
+        self.assertEqual(convertMovieToDcd(movieFile, dcdFile, topologyFile, step=2), 3)
+        trajectory = DcdTrajectory(dcdFile)
+        self.assertEqual(len(trajectory), 3)
+        np.testing.assert_allclose(trajectory.getFrame(2), linesToCoords(self._shifted(4)), atol=1e-3)
+
+        convertDcdToMovie(dcdFile, topologyFile, self._getPath('back.pdb'))
+        self.assertEqual(self._getShifts(iterPdbModels(self._getPath('back.pdb'))), [0, 2, 4])
+
+    def test_truncateMovie(self):
+        movieFile = self._writeMovie(4)
+        with open(movieFile, 'a') as f:
+            f.write('MODEL        5\n' + self.atomLines[0])
+        lastModel = truncateMovie(movieFile)
+        self.assertEqual(self._getShifts([lastModel]), [3])
+        self.assertEqual(len(list(iterPdbModels(movieFile))), 4)
+        self.assertEqual(self._getShifts([truncateMovie(movieFile, 2)]), [1])
+        self.assertEqual(len(list(iterPdbModels(movieFile))), 2)
+
+    def test_decimateMovie(self):
+        movieFile = self._writeMovie(10)
+        self.assertEqual(decimateMovie(movieFile, step=4), 4)
+        self.assertEqual(self._getShifts(iterPdbModels(movieFile)), [0, 4, 8, 9])
+        self.assertEqual(decimateMovie(movieFile, rmsd=4.5), 3)
+        self.assertEqual(self._getShifts(iterPdbModels(movieFile)), [0, 8, 9])
+
+    # --------------------------- checkpoint ------------------------------
+    def test_checkpoint(self):
+        checkpointFile = self._getPath('checkpoint.json')
+        saveCheckpoint(checkpointFile, self._shifted(1), 100, 5.0, 1234)
+        saveCheckpoint(checkpointFile, self._shifted(2), 200, 10.0, None)
+        checkpoint = readCheckpoint(checkpointFile)
+        self.assertEqual((checkpoint['iteration'], checkpoint['elapsed'], checkpoint['movieOffset']),
+                         (200, 10.0, None))
+        self.assertEqual(self._getShifts([readPdbAtoms(checkpoint['pdbFile'])]), [2])
+        # The model of the previous checkpoint is removed
+        self.assertEqual(len([f for f in os.listdir(self.tmpDir) if f.startswith('checkpoint_')]), 1)
+
+    def test_stitchMovie(self):
+        movieFile = self._writeMovie(3)
+        with open(movieFile, 'a') as f:
+            f.write('MODEL        4\n' + self.atomLines[0])
+        archivePart(movieFile, os.path.getsize(movieFile) - len('MODEL        4\n' + self.atomLines[0]))
+        self.assertEqual(len(getPartFiles(movieFile)), 1)
+        # The resumed run starts with the model of the restart point, the last one of the part
+        writeModels((self._shifted(i) for i in [2, 3, 4]), movieFile)
+        stitchMovie(movieFile)
+        self.assertEqual(getPartFiles(movieFile), [])
+        self.assertEqual(self._getShifts(iterPdbModels(movieFile)), [0, 1, 2, 3, 4])
+
+    def test_checkpointer(self):
+        # Run resumed at iteration 500, with the starting model and then a model every 10 iterations. The
+        # monitor reads the log late, when the movie already has the model of iteration 530
+        movieFile = self._writeMovie(4)
+        checkpointFile = self._getPath('checkpoint.json')
+        checkpointer = Checkpointer(checkpointFile, movieFile, 20, startIteration=500, movieInterval=10)
+        checkpointer(510, 0.6, 1.0)
+        self.assertIsNone(readCheckpoint(checkpointFile))
+        checkpointer(524, 0.7, 2.0)
+        checkpoint = readCheckpoint(checkpointFile)
+        self.assertEqual((checkpoint['iteration'], checkpoint['movieOffset']), (530, os.path.getsize(movieFile)))
+        self.assertEqual(self._getShifts([readPdbAtoms(checkpoint['pdbFile'])]), [3])
+
+    def test_selectFramesKept(self):
+        # The first 3 models were selected before and are kept, only the next ones are reduced
+        movieFile = self._writeMovie(10)
+        self.assertEqual(decimateMovie(movieFile, step=3, nSelected=3), 6)
+        self.assertEqual(self._getShifts(iterPdbModels(movieFile)), [0, 1, 2, 3, 6, 9])
+
+    # --------------------------- scheduler ------------------------------
+    def _getScheduler(self):
+        """ Scheduler of 4 cores in 2 NUMA nodes, whatever the cores of this machine """
+        scheduler = CoreScheduler(self._getPath(os.path.join('shared', 'cores.json')), cores=[0, 1, 2, 3])
+        scheduler.nodes = [[0, 1], [2, 3]]
+        return scheduler
+
+    def test_schedulerAllocation(self):
+        scheduler = self._getScheduler()
+        first = scheduler.tryAcquire('job1', 3)
+        self.assertEqual(len(first), 3)
+        self.assertIsNone(scheduler.tryAcquire('job2', 2))
+        second = scheduler.tryAcquire('job2', 1)
+        self.assertFalse(set(first) & set(second))
+        self.assertIsNone(scheduler.tryAcquire('job3', 1))
+        scheduler.release('job1')
+        self.assertEqual(len(scheduler.tryAcquire('job3', 3)), 3)
+
+        # The shared folder and state file are writable by all the users
+        self.assertEqual(os.stat(os.path.dirname(scheduler.stateFile)).st_mode & 0o777, STATE_DIR_MODE)
+        self.assertEqual(os.stat(scheduler.stateFile).st_mode & 0o777, STATE_FILE_MODE)
+
+    def test_schedulerRelease(self):
+        scheduler = self._getScheduler()
+        with scheduler.allocate(4) as cores:
+            self.assertEqual(cores, [0, 1, 2, 3])
+            self.assertIsNone(scheduler.tryAcquire('other', 1))
+        self.assertEqual(scheduler.tryAcquire('other', 4), [0, 1, 2, 3])
+
+        # The cores of finished processes are freed
+        with open(scheduler.stateFile, 'w') as f:
+            f.write('{"dead": {"pid": 999999999, "cores": [0, 1, 2, 3]}}')
+        self.assertEqual(scheduler.tryAcquire('other', 4), [0, 1, 2, 3])
+
+    def test_schedulerNotWritable(self):
+        # A state file that cannot be written leaves the job unpinned
+        scheduler = self._getScheduler()
+        messages = []
+        with mock.patch('os.open', side_effect=PermissionError('Permission denied')):
+            with scheduler.allocate(2, log=messages.append) as cores:
+                self.assertIsNone(cores)
+        self.assertIn('not pinned', messages[0])
+
+    # --------------------------- mmCIF ------------------------------
+    CIF_COLUMNS = ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_comp_id', 'label_asym_id',
+                   'label_seq_id', 'pdbx_PDB_ins_code', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy',
+                   'B_iso_or_equiv', 'auth_seq_id', 'auth_asym_id', 'pdbx_PDB_model_num']
+
+    def _writeCif(self, residues):
+        """ Writes a mmCIF file with two atoms for each (chain, residue number) and returns its rows """
+        rows = []
+        for chain, resSeq in residues:
+            for name, element in [('CA', 'C'), ('"C1\'"', 'C')]:
+                n = len(rows)
+                rows.append(['ATOM', str(n + 1), element, name, 'ALA', chain, str(resSeq), '?',
+                             '%.3f' % n, '%.3f' % (2 * n), '%.3f' % (3 * n), '1.00', '0.00',
+                             str(resSeq), chain, '1'])
+        cifFile = self._getPath('input.cif')
+        with open(cifFile, 'w') as f:
+            f.write('data_test\n#\nloop_\n')
+            f.writelines('_atom_site.{}\n'.format(column) for column in self.CIF_COLUMNS)
+            f.writelines(' '.join(row) + '\n' for row in rows)
+            f.write('#\n')
+        return cifFile, rows
+
+    def test_idMapper(self):
+        mapper = _IdMapper()
+        self.assertEqual(mapper.getResidue('C', '5', ' '), ('C', 5, ' '))
+        self.assertFalse(mapper.remapped)
+        # Long chain identifiers take a free one and large residue numbers are renumbered
+        self.assertEqual(mapper.getResidue('AA', '10000', ' '), ('A', 1, ' '))
+        self.assertEqual(mapper.getResidue('AA', '10001', ' '), ('A', 2, ' '))
+        self.assertTrue(mapper.remapped)
+        # A chain whose identifier is taken is moved to a free one
+        self.assertEqual(mapper.getResidue('A', '7', ' '), ('B', 1, ' '))
+
+        # Once all the identifiers are taken, chains continue in the least used one
+        mapper = _IdMapper()
+        for i in range(62):
+            mapper.getResidue('chain%d' % i, '1', ' ')
+        self.assertEqual(mapper.getResidue('extra', '1', ' '), ('A', 2, ' '))
+
+    def test_cifRoundTrip(self):
+        residues = [('C', 5), ('C', 6), ('AA', 10000), ('AA', 10001), ('A', 12345)]
+        cifFile, rows = self._writeCif(residues)
+        pdbFile, mappingFile = self._getPath('input.pdb'), self._getPath('input.tsv')
+        self.assertTrue(convertCifToPdb(cifFile, pdbFile, mappingFile))
+        atomLines = readPdbAtoms(pdbFile)
+        self.assertEqual([(l[21], int(l[22:26])) for l in atomLines[::2]],
+                         [('C', 5), ('C', 6), ('A', 1), ('A', 2), ('B', 1)])
+        self.assertEqual(getChainMapping(mappingFile), {'C': {'C'}, 'AA': {'A'}, 'A': {'B'}})
+
+        # A fitted movie of two models is written back with the original identifiers and the new coordinates
+        moviePdb, movieCif = self._getPath('movie.pdb'), self._getPath('movie.cif')
+        shifted = ['%s%8.3f%s' % (l[:30], float(l[30:38]) + 1, l[38:]) for l in atomLines]
+        writeModels([atomLines, shifted], moviePdb)
+        writePdbAsCif(moviePdb, mappingFile, movieCif)
+        outRows = [dict(row) for row in iterAtomSite(movieCif)]
+        self.assertEqual(len(outRows), 2 * len(rows))
+        for i, outRow in enumerate(outRows):
+            row = dict(zip(self.CIF_COLUMNS, rows[i % len(rows)]))
+            for column in ['label_atom_id', 'label_asym_id', 'label_seq_id', 'auth_seq_id', 'auth_asym_id']:
+                self.assertEqual(outRow[column], row[column])
+            self.assertEqual(float(outRow['Cartn_x']), float(row['Cartn_x']) + i // len(rows))
+            self.assertEqual((outRow['id'], outRow['pdbx_PDB_model_num']), (str(i + 1), str(i // len(rows) + 1)))
+
+    # --------------------------- symmetry ------------------------------
+    def test_symmetryMatrices(self):
+        for symbol, order in [('C1', 1), ('c3', 3), ('D4', 8), ('T', 12), ('O', 24), ('I1', 60), ('I2', 60)]:
+            matrices = getSymmetryMatrices(symbol)
+            self.assertEqual(len(matrices), order)
+            self.assertTrue(np.allclose(matrices[0], np.eye(3)))
+            for matrix in matrices:
+                self.assertTrue(np.allclose(matrix @ matrix.T, np.eye(3)))
+        # I2 is I1 rotated 90 degrees around z
+        rz = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]])
+        i1 = {tuple(np.round(rz @ m @ rz.T, 5).ravel() + 0.0) for m in getSymmetryMatrices('I1')}
+        self.assertEqual(i1, {tuple(np.round(m, 5).ravel() + 0.0) for m in getSymmetryMatrices('I2')})
+        with self.assertRaises(ValueError):
+            getSymmetryMatrices('X')
+
+    # --------------------------- analysis and maps ------------------------------
+    def test_singleFrameAnalysis(self):
+        # A movie stopped at its first frame has no motion components
+        movieFile = self._writeMovie(1)
+        analysis = analyseMovie(movieFile)
+        self.assertEqual(analysis['projections'].shape, (1, 0))
+        self.assertEqual(analysis['residueAmplitudes'].shape, (0, 60))
+        framesFile = self._getPath('frames.csv')
+        writeAnalysis(analysis, framesFile, self._getPath('residues.csv'), self._getPath('analysis.json'))
+        self.assertEqual(readFrameAnalysis(framesFile)['rmsdStart'].tolist(), [0.0])
+
+    def test_cropOutsideMap(self):
+        header = readMapHeader(self.mrcFile)
+        coords = linesToCoords(self.atomLines)
+        start, end = getBoxAroundCoords(coords, header, 5.0)
+        cropMap(self.mrcFile, self._getPath('crop.mrc'), start, end)
+        self.assertEqual(tuple(readMapHeader(self._getPath('crop.mrc'))['dims']), tuple(end - start))
+
+        start, end = getBoxAroundCoords(coords + 10000.0, header, 5.0)
+        with self.assertRaises(ValueError):
+            cropMap(self.mrcFile, self._getPath('outside.mrc'), start, end)
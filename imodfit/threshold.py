@@ -0,0 +1,69 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Estimation of the EM density map threshold from the histogram of the map values.
+"""
+import numpy as np
+
+# Average residue masses (Da) and protein volume per Dalton (A^3/Da, partial specific volume of 0.73 cm^3/g)
+NUCLEOTIDES = {'A', 'C', 'G', 'U', 'DA', 'DC', 'DG', 'DT', 'DU'}
+AMINOACID_MASS, NUCLEOTIDE_MASS = 110.0, 330.0
+VOLUME_PER_DALTON = 1.21
+
+
+def histogramQuantile(counts, edges, q):
+    """ Value below which there is the q fraction of the histogram counts """
+    cumCounts = np.cumsum(counts)
+    i = min(np.searchsorted(cumCounts, q * cumCounts[-1]), len(counts) - 1)
+    return float(edges[i + 1])
+
+
+def noiseThreshold(counts, edges, nSigma):
+    """ Threshold at nSigma times the background noise over the background level. The background level is the
+    median of the map values and its noise the median absolute deviation scaled to a standard deviation,
+    as most voxels of a map are background """
+    centers = (edges[:-1] + edges[1:]) / 2
+    median = histogramQuantile(counts, edges, 0.5)
+    deviations = np.abs(centers - median)
+    order = np.argsort(deviations)
+    cumCounts = np.cumsum(counts[order])
+    mad = deviations[order][min(np.searchsorted(cumCounts, 0.5 * cumCounts[-1]), len(counts) - 1)]
+    sigma = 1.4826 * mad
+    return median + nSigma * sigma, median, sigma
+
+
+def getExpectedVolume(residueNames):
+    """ Expected volume (A^3) of a structure with the given residue names """
+    nNucleotides = sum(1 for name in residueNames if name in NUCLEOTIDES)
+    mass = nNucleotides * NUCLEOTIDE_MASS + (len(residueNames) - nNucleotides) * AMINOACID_MASS
+    return mass * VOLUME_PER_DALTON
+
+
+def volumeThreshold(counts, edges, nVoxels):
+    """ Threshold leaving nVoxels voxels above it """
+    cumCounts = np.cumsum(counts[::-1])
+    j = min(np.searchsorted(cumCounts, nVoxels), len(counts) - 1)
+    return float(edges[len(counts) - 1 - j])
@@ -0,0 +1,273 @@
+# **************************************************************************
+# *
+# * Authors:  Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Fitting movie (trajectory) handling.
+
+The multi-model pdb movie written by iMODfit is converted into a binary CHARMM/NAMD DCD trajectory
+plus a topology pdb with the first model. DCD frames have a fixed size, so any frame can be read
+directly from its offset through a numpy memory map, and both VMD and ChimeraX can open them.
+Movies can be reduced to every Nth frame or to keyframes while they are read, keeping only a couple of
+models in memory.
+"""
+import os
+import struct
+
+import numpy as np
+
+from .constants import IMODFIT_MOVIE_FRAMES
+
+DCD_TITLE = 'iMODfit fitting movie'
+
+
+def getMovieInterval(maxIter):
+    """ Iterations between the models of the movie written by an iMODfit run of maxIter iterations """
+    return max(1, maxIter // IMODFIT_MOVIE_FRAMES)
+
+
+def getModelIteration(model, movieInterval, startIteration=0):
+    """ Iteration of the model-th model (1 based) of the movie of a run starting at startIteration, whose first
+    model is the starting one """
+    return startIteration + (model - 1) * movieInterval
+
+
+def getIterationModel(iteration, movieInterval, startIteration=0):
+    """ Number (1 based) of the last model of the movie of a run starting at startIteration written at or
+    before iteration """
+    return 1 + (iteration - startIteration) // movieInterval
+
+
+def iterPdbModels(pdbFile):
+    """ Iterates over the models of a multi-model pdb file, yielding for each one the list
+    of its ATOM/HETATM lines. Only one model is kept in memory at a time """
+    atomLines = []
+    with open(pdbFile) as f:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                atomLines.append(line)
+            elif line.startswith('ENDMDL'):
+                if atomLines:
+                    yield atomLines
+                atomLines = []
+    if atomLines:
+        yield atomLines
+
+
+def linesToCoords(atomLines):
+    """ Returns the coordinates of a list of pdb atom lines as a (nAtoms, 3) float32 array """
+    return np.array([(l[30:38], l[38:46], l[46:54]) for l in atomLines], dtype=np.float32)
+
+
+def coordsRmsd(coords1, coords2):
+    """ RMSD (Angstroms) between two frames of the same atoms, without superposition """
+    return float(np.sqrt(np.mean(np.sum(np.square(coords1 - coords2), axis=1))))
+
+
+def selectFrames(models, step=1, rmsd=None, nSelected=0):
+    """ Iterates over the models (lists of atom lines) keeping every step-th one or, if rmsd is given, only the
+    keyframes whose RMSD from the last kept one exceeds it. The first and last models are always kept, as well
+    as the first nSelected models, which were already selected. Each model is read one model ahead, to know
+    whether it is the last one """
+    lastCoords = None
+    models = iter(models)
+    model, i = next(models, None), -nSelected
+    while model is not None:
+        nextModel = next(models, None)
+        if i < 0:
+            keep = True
+            if rmsd is not None:
+                lastCoords = linesToCoords(model)
+        elif rmsd is None:
+            keep = i % step == 0 or nextModel is None
+        else:
+            coords = linesToCoords(model)
+            keep = lastCoords is None or nextModel is None or coordsRmsd(coords, lastCoords) > rmsd
+            if keep:
+                lastCoords = coords
+        if keep:
+            yield model
+        model, i = nextModel, i + 1
+
+
+def writeModels(models, moviePdb):
+    """ Writes the models (lists of atom lines) as a multi-model pdb movie. Returns the number of models """
+    nModels = 0
+    with open(moviePdb, 'w') as f:
+        for atomLines in models:
+            nModels += 1
+            f.write('MODEL     %4d\n' % nModels)
+            f.writelines(atomLines)
+            f.write('ENDMDL\n')
+    return nModels
+
+
+def decimateMovie(moviePdb, step=1, rmsd=None, nSelected=0):
+    """ Reduces a multi-model pdb movie in place to the frames chosen by selectFrames. Returns the number of
+    frames kept """
+    tmpFile = moviePdb + '.tmp'
+    nFrames = writeModels(selectFrames(iterPdbModels(moviePdb), step, rmsd, nSelected), tmpFile)
+    os.replace(tmpFile, moviePdb)
+    return nFrames
+
+
+def writeTopology(atomLines, topologyFile):
+    with open(topologyFile, 'w') as f:
+        f.writelines(atomLines)
+        f.write('END\n')
+
+
+class DcdWriter:
+    """ Writes frames into a DCD file. The number of frames of the header is updated on close """
+    def __init__(self, dcdFile, nAtoms):
+        self.dcdFile = dcdFile
+        self.nAtoms = nAtoms
+        self.nFrames = 0
+        self._f = open(dcdFile, 'wb')
+        self._writeHeader()
+
+    def _writeHeader(self):
+        # CORD block: NSET, ISTART, NSAVC, 6 zeros, NAMNF, DELTA, 9 zeros and CHARMM version 24
+        icntrl = struct.pack('<9i', self.nFrames, 1, 1, 0, 0, 0, 0, 0, 0) + struct.pack('<f', 1.0) + \
+                 struct.pack('<10i', 0, 0, 0, 0, 0, 0, 0, 0, 0, 24)
+        self._f.write(struct.pack('<i', 84) + b'CORD' + icntrl + struct.pack('<i', 84))
+        title = DCD_TITLE.ljust(80).encode()
+        self._f.write(struct.pack('<ii', 84, 1) + title + struct.pack('<i', 84))
+        self._f.write(struct.pack('<iii', 4, self.nAtoms, 4))
+
+    def write(self, coords):
+        """ Appends a (nAtoms, 3) frame """
+        if len(coords) != self.nAtoms:
+            raise ValueError('Frame with {} atoms, {} expected'.format(len(coords), self.nAtoms))
+        marker = struct.pack('<i', 4 * self.nAtoms)
+        for axis in range(3):
+            self._f.write(marker)
+            self._f.write(np.ascontiguousarray(coords[:, axis], dtype='<f4').tobytes())
+            self._f.write(marker)
+        self.nFrames += 1
+
+    def close(self):
+        self._f.seek(8)
+        self._f.write(struct.pack('<i', self.nFrames))
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DcdTrajectory:
+    """ Random access reader of DCD trajectories written by DcdWriter (no unit cell, no fixed atoms).
+    Frames are read from a memory map, without loading the whole file """
+    def __init__(self, dcdFile):
+        self.dcdFile = dcdFile
+        with open(dcdFile, 'rb') as f:
+            size1 = struct.unpack('<i', f.read(4))[0]
+            f.seek(size1 + 4, os.SEEK_CUR)
+            size2 = struct.unpack('<i', f.read(4))[0]
+            f.seek(size2 + 4, os.SEEK_CUR)
+            self.nAtoms = struct.unpack('<iii', f.read(12))[1]
+            self._offset = f.tell()
+
+        # Each coordinate block is surrounded by two 4 bytes markers, which take one float32 slot each
+        self._frameSize = 3 * (self.nAtoms + 2) * 4
+        self.nFrames = (os.path.getsize(dcdFile) - self._offset) // self._frameSize
+        self._data = np.memmap(dcdFile, dtype='<f4', mode='r', offset=self._offset,
+                               shape=(self.nFrames, 3, self.nAtoms + 2))
+
+    def __len__(self):
+        return self.nFrames
+
+    def getFrame(self, i):
+        """ Returns the coordinates of frame i as a (nAtoms, 3) array """
+        return np.array(self._data[i, :, 1:-1].T)
+
+    def getFrames(self, start=0, stop=None, step=1):
+        """ Returns the coordinates of a range of frames as a (nFrames, nAtoms, 3) array """
+        return np.array(self._data[start:stop:step, :, 1:-1].transpose(0, 2, 1))
+
+    def readBlocks(self, start=0, stop=None):
+        """ Reads a range of frames as they are stored, a (nFrames, 3, nAtoms) array with the x, y and z blocks
+        of each frame. The file pages are not kept mapped, so passes over long trajectories in ranges of
+        frames keep their memory bounded """
+        stop = self.nFrames if stop is None else min(stop, self.nFrames)
+        nFrames = max(stop - start, 0)
+        with open(self.dcdFile, 'rb') as f:
+            f.seek(self._offset + start * self._frameSize)
+            data = np.fromfile(f, dtype='<f4', count=nFrames * 3 * (self.nAtoms + 2))
+        return np.ascontiguousarray(data.reshape(nFrames, 3, self.nAtoms + 2)[:, :, 1:-1])
+
+    def __iter__(self):
+        for i in range(self.nFrames):
+            yield self.getFrame(i)
+
+
+def truncateMovie(moviePdb, nModels=None):
+    """ Removes the incomplete model that a Multi-PDB movie may end with when iMODfit is stopped
+    while writing it, or keeps only its first nModels models if given.
+    Returns the atom lines of the last model kept, or None """
+    end, models = 0, 0
+    with open(moviePdb, 'rb') as f:
+        for line in iter(f.readline, b''):
+            if line.startswith(b'ENDMDL'):
+                end = f.tell()
+                models += 1
+                if models == nModels:
+                    break
+    with open(moviePdb, 'rb+') as f:
+        f.truncate(end)
+
+    lastModel = None
+    for lastModel in iterPdbModels(moviePdb):
+        pass
+    return lastModel
+
+
+def convertDcdToMovie(dcdFile, topologyFile, moviePdb):
+    """ Writes the frames of a DCD trajectory as a multi-model pdb movie, taking the atoms from the topology pdb """
+    atomLines = next(iterPdbModels(topologyFile))
+    with open(moviePdb, 'w') as f:
+        for i, coords in enumerate(DcdTrajectory(dcdFile), 1):
+            f.write('MODEL     %4d\n' % i)
+            f.writelines(line[:30] + '%8.3f%8.3f%8.3f' % tuple(xyz) + line[54:]
+                         for line, xyz in zip(atomLines, coords))
+            f.write('ENDMDL\n')
+
+
+def convertMovieToDcd(moviePdb, dcdFile, topologyFile, step=1, rmsd=None, nSelected=0):
+    """ Converts a multi-model pdb movie into a DCD trajectory and a topology pdb with its first model.
+    Only the frames chosen by selectFrames(step, rmsd, nSelected) are written. Returns the number of frames """
+    writer = None
+    try:
+        for atomLines in selectFrames(iterPdbModels(moviePdb), step, rmsd, nSelected):
+            if writer is None:
+                writeTopology(atomLines, topologyFile)
+                writer = DcdWriter(dcdFile, len(atomLines))
+            writer.write(linesToCoords(atomLines))
+    finally:
+        if writer is not None:
+            writer.close()
+    return writer.nFrames if writer is not None else 0
@@ -25,10 +25,14 @@
 # **************************************************************************
 
 
+import os
+
+from .. import Plugin
 from ..protocols import imodfitFlexFitting
 import pyworkflow.protocol.params as params
-from pwem.viewers import Chimera, ChimeraView, VmdViewer, EmProtocolViewer
-from distutils.spawn import find_executable
+from pwem.viewers import Chimera, ChimeraView, VmdViewer, VmdView, EmProtocolViewer, EmPlotter
+from ..monitor import readProgress
+from ..analysis import readFrameAnalysis, plotFrameAnalysis
 
 VOLUME_CHIMERA, VOLUME_VMD = 0, 1
 FITTED_PDB, MOVIE_PDB = 0, 1
@@ -47,6 +51,18 @@ class viewerImodfitVMD(EmProtocolViewer):
                   help='*FittedPDB*: display final fitted structure\n'
                        '*VMD*: display fitting PDB movie'
                   )
+    form.addParam('structureNumber', params.IntParam,
+                  default=1,
+                  label='Structure of the set',
+                  help='For the protocols fitting several structures or maps (e.g. batch and ensemble), '
+                       'number of the structure of the output sets to display'
+                  )
+    form.addParam('colorByScore', params.BooleanParam,
+                  default=False, condition='displayOutput==%d' % FITTED_PDB,
+                  label='Colour by residue correlation',
+                  help='Colours the fitted structure by the local correlation of each residue with the map, '
+                       'from red (low) to blue (high)'
+                  )
     form.addParam('displayPDB', params.EnumParam,
                   choices=['Chimerax', 'VMD'],
                   default=VOLUME_VMD,
@@ -55,15 +71,29 @@ class viewerImodfitVMD(EmProtocolViewer):
                   help='*Chimerax*: display AtomStruct as cartoons with '
                        'ChimeraX.\n *VMD*: display AtomStruct and movies.'
                   )
+    form.addParam('displayProgress', params.LabelParam,
+                  label='Fitting progress',
+                  help='Plots the score along the iterations and the iterations along the time of each '
+                       'iMODfit execution. It can be displayed while the protocol is still running.'
+                  )
+
+    form.addParam('displayMovieAnalysis', params.LabelParam,
+                  label='Movie analysis',
+                  help='Plots the RMSD of each movie frame to the start and final models, its radius of '
+                       'gyration, the largest residue displacement from the start and the projection of the '
+                       'frames on the first two principal components of the motion.'
+                  )
 
   def _getVisualizeDict(self):
     return {
       'displayPDB': self._showPDB,
+      'displayProgress': self._showProgress,
+      'displayMovieAnalysis': self._showMovieAnalysis,
     }
 
   def _validate(self):
     if (self.displayPDB == VOLUME_CHIMERA
-            and find_executable(Chimera.getProgram()) is None):
+            and Plugin.findProgram(Chimera.getProgram()) is None):
       return ["chimera is not available. "
               "Either install it or choose option 'slices'. "]
     return []
@@ -73,25 +103,109 @@ class viewerImodfitVMD(EmProtocolViewer):
   # =========================================================================
 
   def _showPDB(self, paramName=None):
+    if self._getOutputPDB() is None:
+      return [self._getMissingOutputMessage()]
     if self.displayPDB == VOLUME_CHIMERA:
       return self._showPDBChimera()
 
     elif self.displayPDB == VOLUME_VMD:
       return self._showPDBVMD()
 
+  def _getOutputPDB(self, displayOutput=None):
+    """ Returns the fitted or movie structure output or, for protocols with output sets, the chosen structure of
+    the set. None if the protocol has not that output """
+    displayOutput = self.displayOutput.get() if displayOutput is None else displayOutput
+    outputName = 'fittedAtomStruct' if displayOutput == FITTED_PDB else 'movieAtomStruct'
+    output = getattr(self.protocol, outputName, None)
+    if output is None and getattr(self.protocol, outputName + 's', None) is not None:
+      structs = [struct.clone() for struct in getattr(self.protocol, outputName + 's')]
+      if 1 <= self.structureNumber.get() <= len(structs):
+        output = structs[self.structureNumber.get() - 1]
+    return output
+
+  def _getMissingOutputMessage(self):
+    return self.errorMessage('The protocol has no such output structure. For output sets, choose a number between '
+                             '1 and the size of the set', title='Missing output')
+
+  def _getTrajectoryFile(self, outputPDB):
+    """ DCD trajectory of a compacted movie, or None """
+    trajectoryFile = getattr(outputPDB, '_trajectoryFile', None)
+    return trajectoryFile.get() if trajectoryFile is not None else None
+
+  def _getResidueScores(self, outputPDB):
+    """ (attribute file, B-factor pdb) with the residue scores of the fitted structure if they have to be
+    displayed, or None """
+    if self.displayOutput.get() == FITTED_PDB and self.colorByScore.get() \
+            and hasattr(outputPDB, '_residueScoresFile'):
+      return outputPDB._residueScoresFile.get(), outputPDB._residueScoresPdb.get()
+    return None
+
   def _showPDBChimera(self):
     """ Create a chimera script to visualize selected PDB. """
-    if self.displayOutput.get() == FITTED_PDB:
-      outputPDB = self.protocol.fittedPDB
-    elif self.displayOutput.get() == MOVIE_PDB:
-      outputPDB = self.protocol.moviePDB
-    return [ChimeraView(outputPDB.getFileName())]
+    outputPDB = self._getOutputPDB()
+    residueScores = self._getResidueScores(outputPDB)
+    if residueScores is not None:
+      scriptFile = self.protocol._getExtraPath('chimera_residue_cc.cxc')
+      with open(scriptFile, 'w') as f:
+        f.write('open "%s"\n' % os.path.abspath(outputPDB.getFileName()))
+        f.write('open "%s"\n' % os.path.abspath(residueScores[0]))
+        f.write('color byattribute r:imodfitcc palette red:white:blue range 0,1\n')
+      return [ChimeraView(scriptFile)]
+
+    trajectoryFile = self._getTrajectoryFile(outputPDB)
+    if trajectoryFile is None:
+      return [ChimeraView(outputPDB.getFileName())]
+
+    scriptFile = self.protocol._getExtraPath('chimera_movie.cxc')
+    with open(scriptFile, 'w') as f:
+      f.write('open "%s"\n' % os.path.abspath(outputPDB.getFileName()))
+      f.write('open "%s" structureModel #1\n' % os.path.abspath(trajectoryFile))
+    return [ChimeraView(scriptFile)]
 
   def _showPDBVMD(self):
-    if self.displayOutput.get() == FITTED_PDB:
-      outputPDB = self.protocol.fittedPDB
-    elif self.displayOutput.get() == MOVIE_PDB:
-      outputPDB = self.protocol.moviePDB
-    vmdV = VmdViewer(project=self.getProject())
-    vmdV.visualize(outputPDB)
+    outputPDB = self._getOutputPDB()
+    residueScores = self._getResidueScores(outputPDB)
+    trajectoryFile = self._getTrajectoryFile(outputPDB)
+    if residueScores is not None:
+      scriptFile = self.protocol._getExtraPath('vmd_residue_cc.tcl')
+      with open(scriptFile, 'w') as f:
+        f.write('mol new "%s" type pdb\n' % os.path.abspath(residueScores[1]))
+        f.write('mol delrep 0 top\nmol representation NewCartoon\nmol color Beta\nmol addrep top\n')
+        f.write('mol scaleminmax top 0 0.0 1.0\ncolor scale method RWB\n')
+      VmdView('-e "%s"' % scriptFile).show()
+    elif trajectoryFile is None:
+      vmdV = VmdViewer(project=self.getProject())
+      vmdV.visualize(outputPDB)
+    else:
+      VmdView('"%s" -dcd "%s"' % (outputPDB.getFileName(), trajectoryFile)).show()
+
+  # =========================================================================
+  # ShowProgress
+  # =========================================================================
+
+  def _showProgress(self, paramName=None):
+    plotter = EmPlotter(x=1, y=2, windowTitle='iMODfit progress')
+    scoreAx = plotter.createSubPlot('Score', 'Iteration', 'Score')
+    speedAx = plotter.createSubPlot('Throughput', 'Time (s)', 'Iteration')
+    for label, progressFile in self.protocol._getProgressFiles():
+      progress = readProgress(progressFile)
+      if progress:
+        iterations, scores, elapsed = zip(*progress)
+        scoreAx.plot(iterations, scores, label=label)
+        speedAx.plot(elapsed, iterations, label=label)
+    scoreAx.legend()
+    speedAx.legend()
+    return [plotter]
+
+  # =========================================================================
+  # ShowMovieAnalysis
+  # =========================================================================
 
+  def _showMovieAnalysis(self, paramName=None):
+    moviePDB = self._getOutputPDB(MOVIE_PDB)
+    analysisFile = getattr(moviePDB, '_analysisFile', None)
+    if analysisFile is None:
+      return [self.errorMessage('The movie has not been analysed', title='Movie analysis')]
+    plotter = EmPlotter(x=2, y=2, windowTitle='iMODfit movie analysis')
+    plotFrameAnalysis(readFrameAnalysis(analysisFile.get()), plotter.createSubPlot)
+    return [plotter]